@@ -0,0 +1,266 @@
+"""
+Gateway de IA (LLM) usado pelo server.py.
+
+Todas as chamadas ao modelo passam por llm_complete/llm_stream, que adicionam:
+- cache de respostas (TTL + LRU) por chave explícita ou pelo prompt
+- coalescência: pedidos idênticos em andamento aguardam a mesma chamada
+- limite de chamadas simultâneas por empresa
+- backend plugável (LLM_BACKEND=fake responde localmente, para testes offline;
+  outros backends podem ser registrados em LLM_BACKENDS/LLM_STREAM_BACKENDS)
+
+Fica fora do server.py para poder ser testado sem FastAPI/Mongo
+(ver tests/test_llm_gateway.py); as dependências de cada backend
+(emergentintegrations, httpx) só são importadas quando ele é usado.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "emergent")  # emergent | openai | fake
+LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "openai")
+LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-4o-mini")
+LLM_OPENAI_BASE_URL = os.environ.get("LLM_OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "120"))
+LLM_CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", str(6 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "500"))
+LLM_MAX_CONCURRENCY_PER_COMPANY = int(os.environ.get("LLM_MAX_CONCURRENCY_PER_COMPANY", "2"))
+
+_llm_cache = OrderedDict()  # chave -> (expira_em, resposta)
+_llm_inflight = {}  # chave -> asyncio.Future
+_llm_company_slots = {}  # company_id -> asyncio.Semaphore
+llm_stats = {"hits": 0, "misses": 0, "coalesced": 0, "calls": 0, "errors": 0}
+
+
+async def _llm_backend_emergent(prompt: str, system_message: str, session_id: str) -> str:
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    
+    chat = LlmChat(
+        api_key=os.environ.get('OPENAI_API_KEY'),
+        session_id=session_id,
+        system_message=system_message
+    ).with_model(LLM_PROVIDER, LLM_MODEL)
+    return await chat.send_message(UserMessage(text=prompt))
+
+
+async def _llm_stream_emergent(prompt: str, system_message: str, session_id: str):
+    # A integração não expõe streaming: a resposta completa sai como um único bloco
+    yield await _llm_backend_emergent(prompt, system_message, session_id)
+
+
+def _llm_openai_request(prompt: str, system_message: str, stream: bool = False) -> dict:
+    return {
+        "url": f"{LLM_OPENAI_BASE_URL}/chat/completions",
+        "headers": {"Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY', '')}"},
+        "json": {
+            "model": LLM_MODEL,
+            "stream": stream,
+            "messages": [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": prompt}
+            ]
+        }
+    }
+
+
+async def _llm_backend_openai(prompt: str, system_message: str, session_id: str) -> str:
+    """API compatível com OpenAI chamada diretamente (permite streaming real de tokens)"""
+    import httpx
+    
+    async with httpx.AsyncClient(timeout=LLM_TIMEOUT_SECONDS) as http:
+        response = await http.post(**_llm_openai_request(prompt, system_message))
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+
+async def _llm_stream_openai(prompt: str, system_message: str, session_id: str):
+    import httpx
+    
+    request = _llm_openai_request(prompt, system_message, stream=True)
+    async with httpx.AsyncClient(timeout=LLM_TIMEOUT_SECONDS) as http:
+        async with http.stream("POST", **request) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                choices = json.loads(payload).get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+
+
+async def _llm_backend_fake(prompt: str, system_message: str, session_id: str) -> str:
+    """Resposta determinística sem rede (testes e desenvolvimento offline)"""
+    digest = hashlib.sha256(f"{system_message}\n{prompt}".encode("utf-8")).hexdigest()[:12]
+    return f"[resposta simulada {digest}] {session_id}: análise gerada localmente sem chamar o modelo."
+
+
+async def _llm_stream_fake(prompt: str, system_message: str, session_id: str):
+    text = await _llm_backend_fake(prompt, system_message, session_id)
+    for word in re.findall(r"\S+\s*", text):
+        await asyncio.sleep(0)
+        yield word
+
+
+LLM_BACKENDS = {
+    "emergent": _llm_backend_emergent,
+    "openai": _llm_backend_openai,
+    "fake": _llm_backend_fake,
+}
+
+LLM_STREAM_BACKENDS = {
+    "emergent": _llm_stream_emergent,
+    "openai": _llm_stream_openai,
+    "fake": _llm_stream_fake,
+}
+
+
+def llm_cache_key(*parts) -> str:
+    """Chave de cache a partir de partes arbitrárias (ex.: tipo, empresa, mês, prompt)"""
+    return hashlib.sha256(json.dumps(parts, default=str, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _llm_cache_get(key: str) -> Optional[str]:
+    entry = _llm_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, text = entry
+    if expires_at < time.monotonic():
+        _llm_cache.pop(key, None)
+        return None
+    _llm_cache.move_to_end(key)
+    return text
+
+
+def _llm_cache_put(key: str, text: str):
+    _llm_cache[key] = (time.monotonic() + LLM_CACHE_TTL_SECONDS, text)
+    _llm_cache.move_to_end(key)
+    while len(_llm_cache) > LLM_CACHE_MAX_ENTRIES:
+        _llm_cache.popitem(last=False)
+
+
+def _llm_company_slot(company_id: Optional[str]) -> asyncio.Semaphore:
+    slot_key = company_id or "_global"
+    if slot_key not in _llm_company_slots:
+        _llm_company_slots[slot_key] = asyncio.Semaphore(LLM_MAX_CONCURRENCY_PER_COMPANY)
+    return _llm_company_slots[slot_key]
+
+
+async def llm_complete(
+    prompt: str,
+    system_message: str,
+    session_id: str,
+    company_id: Optional[str] = None,
+    cache_key: Optional[str] = None
+) -> str:
+    """Enviar um prompt ao modelo via gateway (cache, coalescência e limite por empresa)"""
+    key = cache_key or llm_cache_key("prompt", system_message, prompt)
+    
+    cached = _llm_cache_get(key)
+    if cached is not None:
+        llm_stats["hits"] += 1
+        return cached
+    
+    # Mesmo pedido já em andamento: aguardar o resultado dele
+    inflight = _llm_inflight.get(key)
+    if inflight is not None:
+        llm_stats["coalesced"] += 1
+        return await asyncio.shield(inflight)
+    
+    llm_stats["misses"] += 1
+    future = asyncio.get_running_loop().create_future()
+    _llm_inflight[key] = future
+    try:
+        backend = LLM_BACKENDS.get(LLM_BACKEND, _llm_backend_emergent)
+        async with _llm_company_slot(company_id):
+            llm_stats["calls"] += 1
+            text = await asyncio.wait_for(backend(prompt, system_message, session_id), LLM_TIMEOUT_SECONDS)
+        _llm_cache_put(key, text)
+        future.set_result(text)
+        return text
+    except Exception as e:
+        llm_stats["errors"] += 1
+        future.set_exception(e)
+        future.exception()  # Evita aviso de exceção não lida quando ninguém aguardava
+        raise
+    finally:
+        # Chamada cancelada (shutdown, cliente desconectou): liberar quem aguardava
+        if not future.done():
+            future.cancel()
+        _llm_inflight.pop(key, None)
+
+
+async def llm_stream(
+    prompt: str,
+    system_message: str,
+    session_id: str,
+    company_id: Optional[str] = None,
+    cache_key: Optional[str] = None
+):
+    """Mesmo que llm_complete, mas entrega a resposta em pedaços à medida que chegam"""
+    key = cache_key or llm_cache_key("prompt", system_message, prompt)
+    
+    cached = _llm_cache_get(key)
+    if cached is not None:
+        llm_stats["hits"] += 1
+    elif key in _llm_inflight:
+        llm_stats["coalesced"] += 1
+        cached = await asyncio.shield(_llm_inflight[key])
+    if cached is not None:
+        yield cached
+        return
+    
+    llm_stats["misses"] += 1
+    # Registrado como em andamento, para que llm_complete/llm_stream do mesmo
+    # pedido aguardem esta resposta em vez de chamar o modelo de novo
+    future = asyncio.get_running_loop().create_future()
+    _llm_inflight[key] = future
+    backend = LLM_STREAM_BACKENDS.get(LLM_BACKEND, _llm_stream_emergent)
+    stream = backend(prompt, system_message, session_id)
+    chunks = []
+    try:
+        async with _llm_company_slot(company_id):
+            llm_stats["calls"] += 1
+            # Mesmo limite de tempo de llm_complete, para a resposta inteira
+            deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), deadline - time.monotonic())
+                except StopAsyncIteration:
+                    break
+                chunks.append(chunk)
+                yield chunk
+        text = "".join(chunks)
+        _llm_cache_put(key, text)
+        future.set_result(text)
+    except Exception as e:
+        llm_stats["errors"] += 1
+        future.set_exception(e)
+        future.exception()  # Evita aviso de exceção não lida quando ninguém aguardava
+        raise
+    finally:
+        # Cliente desconectou ou a tarefa foi cancelada: libera quem aguardava
+        if not future.done():
+            future.cancel()
+        _llm_inflight.pop(key, None)
+        await stream.aclose()
+
+
+def llm_gateway_status() -> dict:
+    """Contadores e estado do gateway (para o endpoint de administração)"""
+    return {
+        **llm_stats,
+        "backend": LLM_BACKEND,
+        "model": f"{LLM_PROVIDER}/{LLM_MODEL}",
+        "cache_entries": len(_llm_cache),
+        "in_flight": len(_llm_inflight),
+        "companies_limited": sum(1 for slot in _llm_company_slots.values() if slot.locked())
+    }
@@ -0,0 +1,95 @@
+"""
+Stub local da API de pagamentos do Mercado Pago, para desenvolvimento e testes.
+
+Implementa apenas o que o server.py usa:
+- POST /v1/payments       (cria pagamento PIX pendente, respeita X-Idempotency-Key)
+- GET  /v1/payments/{id}  (consulta pagamento)
+- POST /stub/payments/{id}/approve  (simula a aprovação, para testar o webhook)
+
+Variáveis de ambiente:
+- STUB_DELAY_SECONDS: atraso artificial por requisição (simula gateway lento)
+- STUB_FAILURE_RATE: fração (0-1) de requisições que respondem 503 (testa retentativas)
+
+Uso:
+    uvicorn mercadopago_stub:app --port 8099
+    MERCADO_PAGO_API_URL=http://localhost:8099 uvicorn server:app --port 8001
+"""
+
+import asyncio
+import base64
+import os
+import random
+from datetime import datetime, timezone
+from itertools import count
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+STUB_DELAY_SECONDS = float(os.environ.get("STUB_DELAY_SECONDS", "0"))
+STUB_FAILURE_RATE = float(os.environ.get("STUB_FAILURE_RATE", "0"))
+
+app = FastAPI(title="Mercado Pago stub")
+
+payments = {}
+payments_by_idempotency_key = {}
+_next_id = count(1000000001)
+
+
+@app.middleware("http")
+async def simulate_gateway(request: Request, call_next):
+    """Aplicar atraso e falhas simuladas"""
+    if STUB_DELAY_SECONDS:
+        await asyncio.sleep(STUB_DELAY_SECONDS)
+    if STUB_FAILURE_RATE and random.random() < STUB_FAILURE_RATE:
+        return JSONResponse(status_code=503, content={"message": "stub: service unavailable"})
+    return await call_next(request)
+
+
+@app.post("/v1/payments", status_code=201)
+async def create_payment(request: Request):
+    data = await request.json()
+    idempotency_key = request.headers.get("X-Idempotency-Key")
+    if idempotency_key and idempotency_key in payments_by_idempotency_key:
+        return payments[payments_by_idempotency_key[idempotency_key]]
+
+    if not data.get("transaction_amount"):
+        raise HTTPException(status_code=400, detail="transaction_amount is required")
+
+    payment_id = next(_next_id)
+    qr_code = f"00020126STUBPIX{payment_id}"
+    payment = {
+        "id": payment_id,
+        "status": "pending",
+        "status_detail": "pending_waiting_transfer",
+        "transaction_amount": data["transaction_amount"],
+        "description": data.get("description"),
+        "payment_method_id": data.get("payment_method_id", "pix"),
+        "payer": data.get("payer", {}),
+        "date_created": datetime.now(timezone.utc).isoformat(),
+        "point_of_interaction": {
+            "transaction_data": {
+                "qr_code": qr_code,
+                "qr_code_base64": base64.b64encode(qr_code.encode()).decode(),
+            }
+        },
+    }
+    payments[payment_id] = payment
+    if idempotency_key:
+        payments_by_idempotency_key[idempotency_key] = payment_id
+    return payment
+
+
+@app.get("/v1/payments/{payment_id}")
+async def get_payment(payment_id: int):
+    if payment_id not in payments:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    return payments[payment_id]
+
+
+@app.post("/stub/payments/{payment_id}/approve")
+async def approve_payment(payment_id: int):
+    if payment_id not in payments:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    payments[payment_id]["status"] = "approved"
+    payments[payment_id]["status_detail"] = "accredited"
+    return payments[payment_id]
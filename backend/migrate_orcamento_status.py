@@ -0,0 +1,84 @@
+"""
+Script de migração para normalizar o status dos orçamentos:
+1. orcamentos: status com variações ("aprovado", "Finalizado", "recusado"...)
+   passa ao valor canônico (RASCUNHO, ENVIADO, NEGOCIACAO, APROVADO, NAO_APROVADO)
+2. orcamentos sem status recebem RASCUNHO (padrão do modelo)
+
+O valor anterior fica em status_original. Valores não reconhecidos são
+apenas reportados. Pode ser executado mais de uma vez.
+"""
+
+import asyncio
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+import re
+import unicodedata
+
+load_dotenv()
+
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+
+ORCAMENTO_STATUS = ("RASCUNHO", "ENVIADO", "NEGOCIACAO", "APROVADO", "NAO_APROVADO")
+
+# Mesma tabela de server.ORCAMENTO_STATUS_ALIASES
+ORCAMENTO_STATUS_ALIASES = {
+    "rascunho": "RASCUNHO",
+    "enviado": "ENVIADO",
+    "negociacao": "NEGOCIACAO",
+    "em_negociacao": "NEGOCIACAO",
+    "aprovado": "APROVADO",
+    "aceito": "APROVADO",
+    "finalizado": "APROVADO",
+    "nao_aprovado": "NAO_APROVADO",
+    "recusado": "NAO_APROVADO",
+    "reprovado": "NAO_APROVADO",
+}
+
+
+def normalizar_status_orcamento(status):
+    """Mesma regra de server.normalizar_status_orcamento"""
+    if not isinstance(status, str) or not status:
+        return None
+    chave = unicodedata.normalize('NFKD', status).encode('ascii', 'ignore').decode('ascii').lower()
+    chave = re.sub(r'[^a-z0-9\s_-]', '', chave)
+    chave = re.sub(r'[\s_-]+', '_', chave).strip('_')
+    return ORCAMENTO_STATUS_ALIASES.get(chave)
+
+
+async def migrate_orcamento_status():
+    """Converter cada valor distinto de status para o canônico"""
+
+    print("🔍 Iniciando normalização do status dos orçamentos...\n")
+
+    total = 0
+    for valor in await db.orcamentos.distinct("status"):
+        if valor in ORCAMENTO_STATUS:
+            continue
+        canonico = normalizar_status_orcamento(valor)
+        if not canonico:
+            quantidade = await db.orcamentos.count_documents({"status": valor})
+            print(f"⚠️ Status não reconhecido: {valor!r} ({quantidade} orçamentos)")
+            continue
+        result = await db.orcamentos.update_many(
+            {"status": valor},
+            {"$set": {"status": canonico, "status_original": valor}}
+        )
+        total += result.modified_count
+        print(f"✅ {valor!r} -> {canonico}: {result.modified_count} orçamentos")
+
+    result = await db.orcamentos.update_many(
+        {"$or": [{"status": {"$exists": False}}, {"status": None}, {"status": ""}]},
+        {"$set": {"status": "RASCUNHO"}}
+    )
+    total += result.modified_count
+    print(f"✅ sem status -> RASCUNHO: {result.modified_count} orçamentos")
+
+    print(f"\n{'='*60}")
+    print(f"✅ Migração concluída! {total} orçamentos atualizados")
+    print(f"{'='*60}\n")
+
+if __name__ == "__main__":
+    asyncio.run(migrate_orcamento_status())
@@ -0,0 +1,72 @@
+"""
+Script de migração para normalizar o campo de empresa (tenant) por coleção:
+1. orcamentos: empresa_id (documentos antigos foram gravados com company_id)
+
+Copia o campo legado para o canônico quando este não existe e remove o
+campo legado, para que toda consulta por empresa use um único prefixo de
+índice (ver server.TENANT_FIELDS). Documentos com os dois campos e valores
+diferentes são apenas reportados, para conferência manual.
+Pode ser executado mais de uma vez.
+"""
+
+import asyncio
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+
+# (coleção, campo canônico, campo legado)
+MIGRATIONS = [
+    ("orcamentos", "empresa_id", "company_id"),
+]
+
+
+async def migrate_collection(collection_name, canonical_field, legacy_field):
+    """Normalizar o campo de empresa de uma coleção"""
+    collection = db[collection_name]
+
+    # 1. Só o campo legado: copiar para o canônico e remover o legado
+    copied = await collection.update_many(
+        {canonical_field: {"$exists": False}, legacy_field: {"$exists": True}},
+        [{"$set": {canonical_field: f"${legacy_field}"}}, {"$unset": legacy_field}]
+    )
+
+    # 2. Os dois campos com o mesmo valor: remover o legado
+    duplicated = await collection.update_many(
+        {legacy_field: {"$exists": True}, "$expr": {"$eq": [f"${canonical_field}", f"${legacy_field}"]}},
+        {"$unset": {legacy_field: ""}}
+    )
+
+    # 3. Os dois campos com valores diferentes: reportar
+    conflicts = await collection.find(
+        {legacy_field: {"$exists": True}, canonical_field: {"$exists": True}},
+        {"_id": 0, "id": 1, canonical_field: 1, legacy_field: 1}
+    ).to_list(None)
+    for doc in conflicts:
+        print(f"⚠️ {collection_name} {doc.get('id')}: {canonical_field}={doc.get(canonical_field)} "
+              f"{legacy_field}={doc.get(legacy_field)}")
+
+    return copied.modified_count, duplicated.modified_count, len(conflicts)
+
+
+async def migrate_tenant_fields():
+    """Migrar todas as coleções com campo de empresa legado"""
+
+    print("🔍 Iniciando normalização do campo de empresa...\n")
+
+    for collection_name, canonical_field, legacy_field in MIGRATIONS:
+        copied, duplicated, conflicts = await migrate_collection(collection_name, canonical_field, legacy_field)
+        print(f"✅ {collection_name}: {copied} copiados de {legacy_field}, "
+              f"{duplicated} com {legacy_field} redundante removido, {conflicts} conflitos\n")
+
+    print(f"{'='*60}")
+    print("✅ Migração concluída!")
+    print(f"{'='*60}\n")
+
+if __name__ == "__main__":
+    asyncio.run(migrate_tenant_fields())
@@ -0,0 +1,112 @@
+"""
+Resumos mensais de lançamentos (coleção monthly_summaries).
+
+Totais por empresa × mês × tipo × categoria × status × cancelado. A API os
+mantém incrementalmente ($inc em server.apply_transaction_to_summary) e
+rebuild_company_summaries os reconstrói a partir de transactions; o mesmo
+código é usado pelo server.py e pelo script rebuild_monthly_summaries.py.
+
+A reconstrução não apaga os resumos em uso: os totais são calculados em
+monthly_summaries_staging (marcados com o id da reconstrução) e só depois
+trocados. Resumos que receberam $inc durante a reconstrução são mantidos
+como estão, para que nenhum lançamento gravado nesse meio-tempo se perca;
+a próxima reconstrução os corrige, se for o caso.
+"""
+
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+SUMMARY_COLLECTION = "monthly_summaries"
+STAGING_COLLECTION = "monthly_summaries_staging"
+
+# Ordem dos campos do _id: precisa ser a mesma em monthly_summary_key e no $group
+KEY_FIELDS = ("company_id", "month", "type", "category", "status", "cancelled")
+
+
+def monthly_summary_key(transaction: dict) -> Optional[dict]:
+    """Chave (_id) do resumo de um lançamento"""
+    date_str = transaction.get("date")
+    if not transaction.get("company_id") or not isinstance(date_str, str) or len(date_str) < 7:
+        return None
+    category = transaction.get("category")
+    if category is None:
+        category = transaction.get("category_name")
+    return {
+        "company_id": transaction["company_id"],
+        "month": date_str[:7],
+        "type": transaction.get("type"),
+        "category": category,
+        "status": transaction.get("status"),
+        "cancelled": transaction.get("cancelled") is True,
+    }
+
+
+def staging_pipeline(company_id: str, build_id: str) -> list:
+    """Agregar os lançamentos da empresa em monthly_summaries_staging"""
+    return [
+        {"$match": {"company_id": company_id, "date": {"$type": "string"}}},
+        {"$group": {
+            "_id": {
+                "company_id": "$company_id",
+                "month": {"$substrCP": ["$date", 0, 7]},
+                "type": {"$ifNull": ["$type", None]},
+                "category": {"$ifNull": ["$category", {"$ifNull": ["$category_name", None]}]},
+                "status": {"$ifNull": ["$status", None]},
+                "cancelled": {"$eq": ["$cancelled", True]}
+            },
+            "total": {"$sum": "$amount"},
+            "count": {"$sum": 1}
+        }},
+        {"$project": {
+            "_id": {"build": {"$literal": build_id}, "key": "$_id"},
+            "build": {"$literal": build_id},
+            "total": 1,
+            "count": 1
+        }},
+        {"$merge": {"into": STAGING_COLLECTION, "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+
+
+def swap_pipeline(build_id: str, started_at: datetime) -> list:
+    """Copiar os resumos reconstruídos para monthly_summaries (sem sobrescrever os alterados durante o rebuild)"""
+    return [
+        {"$match": {"build": build_id}},
+        {"$project": {
+            "_id": {field: f"$_id.key.{field}" for field in KEY_FIELDS},
+            **{field: f"$_id.key.{field}" for field in KEY_FIELDS},
+            "total": 1,
+            "count": 1,
+            # Relógio da aplicação, o mesmo do $inc da API (não o $$NOW do banco)
+            "updated_at": {"$literal": started_at}
+        }},
+        {"$merge": {
+            "into": SUMMARY_COLLECTION,
+            "whenMatched": [{"$replaceWith": {
+                "$cond": [{"$gt": ["$updated_at", {"$literal": started_at}]}, "$$ROOT", "$$new"]
+            }}],
+            "whenNotMatched": "insert"
+        }}
+    ]
+
+
+async def rebuild_company_summaries(db, company_id: str) -> int:
+    """Reconstruir os resumos mensais de uma empresa; retorna quantos resumos ela tem"""
+    build_id = uuid.uuid4().hex
+    started_at = datetime.now(timezone.utc)
+    staging = db[STAGING_COLLECTION]
+    summaries = db[SUMMARY_COLLECTION]
+    try:
+        await db.transactions.aggregate(staging_pipeline(company_id, build_id)).to_list(None)
+        await staging.aggregate(swap_pipeline(build_id, started_at)).to_list(None)
+    finally:
+        await staging.delete_many({"build": build_id})
+
+    # Resumos que não vieram da reconstrução nem foram alterados desde o início dela
+    await summaries.delete_many({"company_id": company_id, "updated_at": {"$lt": started_at}})
+    await db.monthly_summaries_meta.update_one(
+        {"company_id": company_id},
+        {"$set": {"company_id": company_id, "built_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    return await summaries.count_documents({"company_id": company_id})
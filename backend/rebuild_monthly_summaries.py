@@ -0,0 +1,45 @@
+"""
+Script para reconstruir a coleção monthly_summaries a partir de transactions.
+
+Os resumos guardam os totais de lançamentos por empresa × mês × tipo ×
+categoria × status × cancelado e são mantidos incrementalmente pela API.
+Use este script após importações diretas no banco ou se os totais divergirem.
+A reconstrução é a mesma da API (monthly_summaries.rebuild_company_summaries)
+e pode rodar com o servidor no ar.
+
+Uso: python rebuild_monthly_summaries.py [company_id]
+"""
+
+import asyncio
+import sys
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+
+from monthly_summaries import rebuild_company_summaries
+
+load_dotenv()
+
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url)
+db = client[os.environ['DB_NAME']]
+
+
+async def rebuild_monthly_summaries(company_ids=None):
+    """Reconstruir os resumos das empresas informadas (ou de todas)"""
+
+    print("🔍 Reconstruindo resumos mensais...\n")
+
+    if not company_ids:
+        company_ids = await db.transactions.distinct("company_id")
+
+    for company_id in company_ids:
+        total = await rebuild_company_summaries(db, company_id)
+        print(f"✅ {company_id}: {total} resumos")
+
+    print(f"\n{'='*60}")
+    print(f"✅ Reconstrução concluída! {len(company_ids)} empresas")
+    print(f"{'='*60}\n")
+
+if __name__ == "__main__":
+    asyncio.run(rebuild_monthly_summaries(sys.argv[1:]))
@@ -1,34 +1,58 @@
 from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Request, Form, Body
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import asyncio
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
 import re
+import json
+import hashlib
 import unicodedata
+import mimetypes
+import copy
+import csv
+import gzip
+import tempfile
+from collections import OrderedDict
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta, date
-import mercadopago
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+import httpx
 from openpyxl import Workbook
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.lib import colors
-from io import BytesIO
+from io import BytesIO, StringIO
 import base64
 from fastapi.responses import StreamingResponse, FileResponse, HTMLResponse
 import aiofiles
 from urllib.parse import quote
 
+try:
+    import brotli
+except ImportError:  # sem brotli, os PWAs são servidos só com gzip
+    brotli = None
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Lê as variáveis LLM_* na importação: precisa vir depois do load_dotenv
+from llm_gateway import llm_cache_key, llm_complete, llm_gateway_status, llm_stream
+from monthly_summaries import monthly_summary_key, rebuild_company_summaries
+
 
 # ========== FUNÇÃO PARA GERAR SLUG ==========
 def generate_slug(text: str) -> str:
@@ -68,14 +92,33 @@ async def generate_unique_slug(base_name: str, db) -> str:
         counter += 1
 
 
+# ========== FUNÇÕES DE PERÍODO (MÊS) ==========
+def next_month(month: str) -> str:
+    """Retorna o mês seguinte no formato YYYY-MM. Ex: "2025-12" -> "2026-01" """
+    year, month_num = int(month[:4]), int(month[5:7])
+    if month_num == 12:
+        return f"{year + 1}-01"
+    return f"{year}-{month_num + 1:02d}"
+
+
+def month_range(month: str, end_month: Optional[str] = None) -> dict:
+    """
+    Converte um mês (YYYY-MM) em um filtro de intervalo [início, fim) sobre
+    campos de data em string ISO (YYYY-MM-DD ou timestamp ISO).
+    Diferente do $regex de prefixo, o intervalo usa o índice como range scan.
+    Se end_month for informado, o intervalo cobre de month até end_month inclusive.
+    """
+    end_month = end_month or month
+    if not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", month) or not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", end_month):
+        raise HTTPException(status_code=400, detail="Mês inválido: use o formato YYYY-MM")
+    return {"$gte": month, "$lt": next_month(end_month)}
+
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
-# Mercado Pago SDK
-sdk = mercadopago.SDK(os.environ.get('MERCADO_PAGO_ACCESS_TOKEN'))
-
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -464,7 +507,7 @@ class Orcamento(BaseModel):
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class OrcamentoStatusUpdate(BaseModel):
-    status: str  # ENVIADO, APROVADO, NAO_APROVADO
+    status: str  # RASCUNHO, ENVIADO, NEGOCIACAO, APROVADO, NAO_APROVADO (ver ORCAMENTO_STATUS)
     canal_envio: Optional[str] = None
 
 # ========== MODELS: MATERIAIS ==========
@@ -1010,6 +1053,227 @@ class ClienteCronogramaToken(BaseModel):
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 
+# ========== ÍNDICES DO MONGODB ==========
+# Registro declarativo dos índices usados pelas rotas. Cada entrada é
+# (nome, chaves, opções). Os nomes levam o prefixo "ll_" para que o
+# provisionamento saiba quais índices são gerenciados por ele.
+
+INDEX_PREFIX = "ll_"
+
+INDEX_REGISTRY = {
+    "transactions": [
+        ("ll_company_date", [("company_id", ASCENDING), ("date", DESCENDING)], {}),
+        ("ll_company_status_date", [("company_id", ASCENDING), ("status", ASCENDING), ("date", ASCENDING)], {}),
+        ("ll_company_competence", [("company_id", ASCENDING), ("competence_month", ASCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+        ("ll_conta", [("conta_id", ASCENDING)], {"sparse": True}),
+    ],
+    "contas": [
+        ("ll_company_tipo_vencimento", [("company_id", ASCENDING), ("tipo", ASCENDING), ("data_vencimento", ASCENDING)], {}),
+        ("ll_company_status_vencimento", [("company_id", ASCENDING), ("status", ASCENDING), ("data_vencimento", ASCENDING)], {}),
+        ("ll_company_tipo_status_vencimento", [("company_id", ASCENDING), ("tipo", ASCENDING), ("status", ASCENDING), ("data_vencimento", ASCENDING)], {}),
+        # Varredura diária de atrasadas (status + vencimento, sem empresa)
+        ("ll_status_vencimento", [("status", ASCENDING), ("data_vencimento", ASCENDING)], {}),
+        ("ll_company_pagamento", [("company_id", ASCENDING), ("data_pagamento", ASCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+        ("ll_orcamento", [("orcamento_id", ASCENDING)], {"sparse": True}),
+        ("ll_custo_fixo", [("custo_fixo_id", ASCENDING), ("data_vencimento", ASCENDING)], {"sparse": True}),
+    ],
+    "orcamentos": [
+        ("ll_empresa_created", [("empresa_id", ASCENDING), ("created_at", DESCENDING)], {}),
+        ("ll_empresa_status", [("empresa_id", ASCENDING), ("status", ASCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+        ("ll_numero", [("numero_orcamento", ASCENDING)], {}),
+        ("ll_share_token", [("pdf_share_token", ASCENDING)], {"sparse": True}),
+        ("ll_vendedor", [("vendedor_id", ASCENDING)], {"sparse": True}),
+    ],
+    "monthly_summaries": [
+        ("ll_company_month", [("company_id", ASCENDING), ("month", ASCENDING)], {}),
+    ],
+    "monthly_summaries_meta": [
+        ("ll_company", [("company_id", ASCENDING)], {}),
+    ],
+    "monthly_summaries_staging": [
+        ("ll_build", [("build", ASCENDING)], {}),
+    ],
+    "scheduler_runs": [
+        ("ll_task_started", [("task", ASCENDING), ("started_at", DESCENDING)], {}),
+        ("ll_started", [("started_at", DESCENDING)], {}),
+    ],
+    "jobs": [
+        ("ll_id", [("id", ASCENDING)], {}),
+        ("ll_status_created", [("status", ASCENDING), ("created_at", ASCENDING)], {}),
+    ],
+    "orcamento_materiais": [
+        ("ll_orcamento", [("id_orcamento", ASCENDING)], {}),
+    ],
+    "service_price_table": [
+        ("ll_company_description", [("company_id", ASCENDING), ("description", ASCENDING)], {}),
+        ("ll_company_category", [("company_id", ASCENDING), ("category", ASCENDING)], {}),
+        ("ll_company_created", [("company_id", ASCENDING), ("created_at", DESCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+    ],
+    "cronogramas": [
+        ("ll_orcamento_data", [("orcamento_id", ASCENDING), ("data", DESCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+    ],
+    "notificacoes": [
+        ("ll_company_lida_created", [("company_id", ASCENDING), ("lida", ASCENDING), ("created_at", DESCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+    ],
+    "companies": [
+        ("ll_id", [("id", ASCENDING)], {}),
+        ("ll_user", [("user_id", ASCENDING)], {}),
+        ("ll_slug", [("slug", ASCENDING)], {"sparse": True}),
+    ],
+    "users": [
+        ("ll_email", [("email", ASCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+    ],
+    "subscriptions": [
+        ("ll_user", [("user_id", ASCENDING)], {}),
+        ("ll_status", [("status", ASCENDING)], {}),
+    ],
+    "clientes": [
+        ("ll_empresa", [("empresa_id", ASCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+    ],
+    "funcionarios": [
+        ("ll_empresa_nome", [("empresa_id", ASCENDING), ("nome_completo", ASCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+        ("ll_login", [("login_email", ASCENDING)], {"sparse": True}),
+    ],
+    "expense_categories": [
+        ("ll_company_name", [("company_id", ASCENDING), ("name", ASCENDING)], {}),
+        ("ll_id", [("id", ASCENDING)], {}),
+    ],
+    "markup_profiles": [
+        ("ll_company_periodo", [("company_id", ASCENDING), ("year", DESCENDING), ("month", DESCENDING)], {}),
+    ],
+    "custos_fixos_recorrentes": [
+        ("ll_empresa_status", [("empresa_id", ASCENDING), ("status", ASCENDING)], {}),
+    ],
+    "orcamento_config": [
+        ("ll_company", [("company_id", ASCENDING)], {}),
+    ],
+    "monthly_goals": [
+        ("ll_company_month", [("company_id", ASCENDING), ("month", ASCENDING)], {}),
+    ],
+    "cliente_cronograma_tokens": [
+        ("ll_token", [("token", ASCENDING)], {}),
+        ("ll_orcamento", [("orcamento_id", ASCENDING)], {}),
+    ],
+    "pre_orcamentos": [
+        ("ll_vendedor", [("vendedor_id", ASCENDING)], {}),
+        ("ll_empresa", [("empresa_id", ASCENDING)], {}),
+    ],
+    "agenda_vendedor": [
+        ("ll_vendedor_data", [("vendedor_id", ASCENDING), ("data", ASCENDING)], {}),
+    ],
+}
+
+# Estado do último provisionamento (exposto em /api/admin/indexes)
+index_build_status = {
+    "state": "pending",
+    "started_at": None,
+    "finished_at": None,
+    "total": sum(len(specs) for specs in INDEX_REGISTRY.values()),
+    "done": 0,
+    "created": [],
+    "rebuilt": [],
+    "unchanged": [],
+    "errors": [],
+}
+
+# Referência da tarefa em andamento (sem ela o event loop pode descartar a tarefa)
+_index_build_task: Optional[asyncio.Task] = None
+
+
+def _index_matches(existing: dict, keys: list, options: dict) -> bool:
+    """Compara um índice existente (index_information) com a especificação desejada"""
+    if [tuple(k) for k in existing.get("key", [])] != [tuple(k) for k in keys]:
+        return False
+    for option in ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression"):
+        if existing.get(option) != options.get(option):
+            # unique/sparse ausentes equivalem a False
+            if option in ("unique", "sparse") and not existing.get(option) and not options.get(option):
+                continue
+            return False
+    return True
+
+
+async def ensure_indexes():
+    """
+    Reconciliar os índices existentes com o INDEX_REGISTRY.
+    - Cria os índices que faltam
+    - Recria índices gerenciados ("ll_") cuja definição mudou
+    - Remove índices gerenciados que saíram do registro
+    Índices criados manualmente (sem o prefixo) nunca são tocados.
+    """
+    status = index_build_status
+    status.update({
+        "state": "running",
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "finished_at": None,
+        "done": 0,
+        "created": [],
+        "rebuilt": [],
+        "unchanged": [],
+        "errors": [],
+    })
+    total = status["total"]
+    
+    for collection_name, specs in INDEX_REGISTRY.items():
+        collection = db[collection_name]
+        try:
+            existing = await collection.index_information()
+        except Exception as e:
+            status["errors"].append(f"{collection_name}: {e}")
+            status["done"] += len(specs)
+            logger.error(f"⚠️ Índices: erro ao listar {collection_name}: {e}")
+            continue
+        
+        desired_names = {name for name, _, _ in specs}
+        
+        # Remover índices gerenciados que não fazem mais parte do registro
+        for name in existing:
+            if name.startswith(INDEX_PREFIX) and name not in desired_names:
+                try:
+                    await collection.drop_index(name)
+                    logger.info(f"🗑️ Índice obsoleto removido: {collection_name}.{name}")
+                except Exception as e:
+                    status["errors"].append(f"{collection_name}.{name}: {e}")
+        
+        for name, keys, options in specs:
+            full_name = f"{collection_name}.{name}"
+            started = time.monotonic()
+            try:
+                current = existing.get(name)
+                if current and _index_matches(current, keys, options):
+                    status["unchanged"].append(full_name)
+                else:
+                    if current:
+                        await collection.drop_index(name)
+                    await collection.create_index(keys, name=name, background=True, **options)
+                    (status["rebuilt"] if current else status["created"]).append(full_name)
+                    logger.info(
+                        f"🔧 [{status['done'] + 1}/{total}] Índice {'recriado' if current else 'criado'}: "
+                        f"{full_name} ({time.monotonic() - started:.2f}s)"
+                    )
+            except Exception as e:
+                status["errors"].append(f"{full_name}: {e}")
+                logger.error(f"⚠️ Erro ao criar índice {full_name}: {e}")
+            status["done"] += 1
+    
+    status["state"] = "error" if status["errors"] else "ok"
+    status["finished_at"] = datetime.now(timezone.utc).isoformat()
+    logger.info(
+        f"✅ Índices provisionados: {len(status['created'])} criados, {len(status['rebuilt'])} recriados, "
+        f"{len(status['unchanged'])} sem alteração, {len(status['errors'])} erros"
+    )
+    return status
+
+
 # ========== STARTUP: CRIAR PRIMEIRO ADMIN ==========
 
 @app.on_event("startup")
@@ -1037,6 +1301,224 @@ async def create_first_admin():
         # Não falha o startup se não conseguir criar admin
         # Pode ser um problema temporário de conexão com MongoDB
 
+def start_index_build() -> asyncio.Task:
+    """Executar ensure_indexes em segundo plano, guardando a referência da tarefa"""
+    global _index_build_task
+    _index_build_task = asyncio.create_task(ensure_indexes())
+    return _index_build_task
+
+
+@app.on_event("startup")
+async def provision_indexes():
+    """Provisionar índices em segundo plano para não atrasar o startup"""
+    start_index_build()
+
+# ========== ACESSO A DADOS POR EMPRESA (TENANT) ==========
+# Cada coleção tem um único campo de empresa. Consultas por empresa passam
+# por tenant_query/tenant_find, para sempre usarem o prefixo dos índices
+# compostos (ex.: orcamentos.ll_empresa_created) em vez de $or entre
+# empresa_id e company_id. Documentos antigos de orçamentos gravados com
+# company_id são normalizados por migrate_tenant_fields.py.
+
+TENANT_FIELDS = {
+    "transactions": "company_id",
+    "contas": "company_id",
+    "service_price_table": "company_id",
+    "orcamentos": "empresa_id",
+    "pre_orcamentos": "empresa_id",
+    "clientes": "empresa_id",
+}
+
+
+def tenant_query(collection_name: str, tenant_id: str, query: Optional[dict] = None) -> dict:
+    """Filtro da coleção restrito à empresa, pelo campo canônico"""
+    return {TENANT_FIELDS[collection_name]: tenant_id, **(query or {})}
+
+
+def tenant_find(collection_name: str, tenant_id: str, query: Optional[dict] = None, projection: Optional[dict] = None):
+    """find() restrito à empresa (projeção padrão sem _id)"""
+    return db[collection_name].find(
+        tenant_query(collection_name, tenant_id, query),
+        projection if projection is not None else {"_id": 0}
+    )
+
+
+def tenant_aggregate(collection_name: str, tenant_id: str, pipeline: list, query: Optional[dict] = None):
+    """aggregate() com o $match da empresa (e do filtro opcional) como primeiro estágio"""
+    return db[collection_name].aggregate(
+        [{"$match": tenant_query(collection_name, tenant_id, query)}] + pipeline
+    )
+
+
+# ========== FILA DE JOBS EM SEGUNDO PLANO ==========
+# Importações grandes rodam fora da requisição HTTP. O job é gravado em
+# db.jobs (com o payload) e processado por workers asyncio do próprio
+# processo; o front acompanha o progresso em GET /api/jobs/{job_id}.
+# Quem executa um job grava worker_id + lease_until e renova a concessão
+# enquanto trabalha; outro processo só assume um job "executando" quando a
+# concessão expirou (processo caiu). Assim uma segunda réplica ou um restart
+# gradual não executa em paralelo um job que ainda está rodando. Jobs
+# pendentes ou com concessão expirada são retomados no startup e
+# periodicamente pelo agendador (os handlers ignoram itens já gravados).
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "1"))
+JOB_PROGRESS_INTERVAL = 2.0  # segundos entre gravações de progresso
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "60"))
+
+_job_owner_id = str(uuid.uuid4())  # identifica este processo nas concessões
+
+# tipo do job -> async handler(job, on_progress) que retorna o resultado
+JOB_HANDLERS = {}
+
+_job_queue: Optional[asyncio.Queue] = None
+_job_worker_tasks = []
+
+
+async def enqueue_job(kind: str, company_id: str, payload: dict, total: int = 0) -> dict:
+    """Gravar um job e colocá-lo na fila; retorna o documento sem o payload"""
+    if kind not in JOB_HANDLERS:
+        raise HTTPException(status_code=400, detail=f"Tipo de job desconhecido: {kind}")
+    
+    job = {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "company_id": company_id,
+        "status": "pendente",  # pendente, executando, concluido, erro
+        "processed": 0,
+        "total": total,
+        "errors": [],
+        "result": None,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "started_at": None,
+        "finished_at": None,
+    }
+    await db.jobs.insert_one({**job, "payload": payload})
+    if _job_queue is not None:
+        await _job_queue.put(job["id"])
+    return job
+
+
+def _job_lease_until() -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+
+
+def _job_claimable_query() -> dict:
+    """Jobs que podem ser assumidos: pendentes ou executando com concessão expirada"""
+    return {"$or": [
+        {"status": "pendente"},
+        # lease_until ausente: job interrompido antes de existirem concessões
+        {"status": "executando", "lease_until": None},
+        {"status": "executando", "lease_until": {"$lt": datetime.now(timezone.utc).isoformat()}},
+    ]}
+
+
+async def _run_job(job_id: str):
+    """Executar um job da fila e gravar status, progresso e resultado"""
+    job = await db.jobs.find_one_and_update(
+        {"id": job_id, **_job_claimable_query()},
+        {"$set": {
+            "status": "executando",
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "worker_id": _job_owner_id,
+            "lease_until": _job_lease_until()
+        }},
+        projection={"_id": 0}
+    )
+    if not job:
+        return
+    
+    owned = {"id": job_id, "worker_id": _job_owner_id}
+    last_progress = 0.0
+    
+    async def renew_lease(fields: Optional[dict] = None):
+        result = await db.jobs.update_one(owned, {"$set": {**(fields or {}), "lease_until": _job_lease_until()}})
+        if result.matched_count == 0:
+            logger.warning(f"⚠️ Job {job_id}: concessão perdida para outro processo")
+    
+    async def on_progress(processed: int, total: int):
+        nonlocal last_progress
+        now = time.monotonic()
+        if processed < total and now - last_progress < JOB_PROGRESS_INTERVAL:
+            return
+        last_progress = now
+        await renew_lease({"processed": processed, "total": total})
+    
+    async def heartbeat():
+        # Renova a concessão mesmo quando o handler passa muito tempo sem progresso
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await renew_lease()
+            except Exception as e:
+                logger.error(f"⚠️ Job {job_id}: erro ao renovar concessão: {e}")
+    
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        result = await JOB_HANDLERS[job["kind"]](job, on_progress)
+        update = {
+            "status": "concluido",
+            "result": result,
+            "errors": (result or {}).get("errors", []) if isinstance(result, dict) else [],
+        }
+    except HTTPException as e:
+        update = {"status": "erro", "errors": [e.detail]}
+    except Exception as e:
+        logger.error(f"❌ Job {job_id} ({job['kind']}) falhou: {e}")
+        update = {"status": "erro", "errors": [str(e)]}
+    finally:
+        heartbeat_task.cancel()
+    
+    update["finished_at"] = datetime.now(timezone.utc).isoformat()
+    await db.jobs.update_one(owned, {"$set": update, "$unset": {"payload": "", "lease_until": ""}})
+
+
+async def recuperar_jobs_pendentes() -> dict:
+    """Colocar na fila local os jobs pendentes ou com concessão expirada"""
+    if _job_queue is None:
+        return {"enfileirados": 0}
+    enfileirados = 0
+    async for job in db.jobs.find(_job_claimable_query(), {"_id": 0, "id": 1}).sort("created_at", 1):
+        await _job_queue.put(job["id"])
+        enfileirados += 1
+    return {"enfileirados": enfileirados}
+
+
+async def _job_worker(worker_id: int):
+    """Consumir a fila de jobs até o shutdown"""
+    while True:
+        job_id = await _job_queue.get()
+        try:
+            await _run_job(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Worker {worker_id}: erro ao executar job {job_id}: {e}")
+        finally:
+            _job_queue.task_done()
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    """Iniciar os workers e retomar jobs pendentes/com concessão expirada"""
+    global _job_queue
+    _job_queue = asyncio.Queue()
+    for worker_id in range(max(1, JOB_WORKERS)):
+        _job_worker_tasks.append(asyncio.create_task(_job_worker(worker_id)))
+    
+    try:
+        await recuperar_jobs_pendentes()
+    except Exception as e:
+        logger.error(f"⚠️ Erro ao retomar jobs pendentes: {e}")
+
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status e progresso de um job em segundo plano"""
+    job = await db.jobs.find_one({"id": job_id}, {"_id": 0, "payload": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return job
+
 # ========== ROTAS DE AUTENTICAÇÃO ==========
 
 @api_router.get("/")
@@ -1102,6 +1584,102 @@ async def login(credentials: UserLogin):
         "role": user['role']
     }
 
+# ========== CACHE DE LEITURAS FREQUENTES ==========
+# Empresa por id, configuração de orçamento e alíquota de ISS do markup são
+# lidas em quase toda requisição de orçamento, métricas e DRE. Ficam num
+# cache em memória (TTL + LRU) por processo; as rotas que alteram esses
+# dados chamam invalidate_read_cache. O TTL limita a defasagem caso haja
+# mais de um processo servindo a API.
+
+READ_CACHE_TTL_SECONDS = int(os.environ.get("READ_CACHE_TTL_SECONDS", "300"))
+READ_CACHE_MAX_ENTRIES = int(os.environ.get("READ_CACHE_MAX_ENTRIES", "2000"))
+
+_read_caches = {}  # nome -> OrderedDict((company_id, ...) -> (expira_em, valor))
+read_cache_stats = {}  # nome -> {"hits", "misses", "invalidations", "evictions"}
+
+
+async def cached_read(cache_name: str, key: tuple, loader, cache_none: bool = True):
+    """
+    Ler via cache (read-through). key começa sempre pelo company_id, para a
+    invalidação por empresa. Retorna uma cópia: quem chama pode alterá-la.
+    """
+    cache = _read_caches.setdefault(cache_name, OrderedDict())
+    stats = read_cache_stats.setdefault(cache_name, {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0})
+    
+    entry = cache.get(key)
+    if entry is not None and entry[0] >= time.monotonic():
+        cache.move_to_end(key)
+        stats["hits"] += 1
+        return copy.deepcopy(entry[1])
+    
+    stats["misses"] += 1
+    value = await loader()
+    if value is not None or cache_none:
+        cache[key] = (time.monotonic() + READ_CACHE_TTL_SECONDS, value)
+        cache.move_to_end(key)
+        while len(cache) > READ_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+            stats["evictions"] += 1
+    return copy.deepcopy(value)
+
+
+def invalidate_read_cache(cache_name: str, company_id: Optional[str] = None):
+    """Descartar as entradas de uma empresa (ou todas, sem company_id) no cache indicado"""
+    cache = _read_caches.get(cache_name)
+    if not cache:
+        return
+    for key in [k for k in cache if company_id is None or k[0] == company_id]:
+        del cache[key]
+        read_cache_stats[cache_name]["invalidations"] += 1
+
+
+async def get_company_cached(company_id: str) -> Optional[dict]:
+    """Empresa por id (sem _id); empresa inexistente não é guardada"""
+    return await cached_read(
+        "companies", (company_id,),
+        lambda: db.companies.find_one({"id": company_id}, {"_id": 0}),
+        cache_none=False
+    )
+
+
+async def get_company_by_slug(slug: str) -> Optional[dict]:
+    """Empresa pelo slug (slug -> id em cache, dados via get_company_cached)"""
+    async def load_id():
+        empresa = await db.companies.find_one({"slug": slug}, {"_id": 0, "id": 1})
+        return empresa["id"] if empresa else None
+    
+    company_id = await cached_read("company_slugs", (slug,), load_id, cache_none=False)
+    return await get_company_cached(company_id) if company_id else None
+
+
+async def get_aliquota_iss(company_id: str, year: Optional[int] = None, month: Optional[int] = None) -> float:
+    """Alíquota de ISS do perfil de markup do mês (ou de qualquer perfil, sem mês); padrão 3%"""
+    query = {"company_id": company_id}
+    if year is not None:
+        query.update({"year": year, "month": month})
+    
+    markup_config = await cached_read(
+        "markup_iss", (company_id, year, month),
+        lambda: db.markup_profiles.find_one(query, {"_id": 0, "taxes": 1})
+    )
+    if markup_config and markup_config.get("taxes"):
+        return markup_config["taxes"].get("iss_rate", 0.03)
+    return 0.03
+
+
+@api_router.get("/admin/read-cache")
+async def admin_read_cache_stats(user_id: str):
+    """Métricas do cache de leituras frequentes"""
+    await verify_admin(user_id)
+    return {
+        "ttl_seconds": READ_CACHE_TTL_SECONDS,
+        "max_entries": READ_CACHE_MAX_ENTRIES,
+        "caches": {
+            name: {**read_cache_stats.get(name, {}), "entries": len(cache)}
+            for name, cache in _read_caches.items()
+        }
+    }
+
 # ========== ROTAS DE EMPRESAS ==========
 
 @api_router.post("/companies")
@@ -1403,11 +1981,112 @@ async def update_company(company_id: str, company_data: CompanyCreate):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Empresa não encontrada")
     
+    invalidate_pdf_cache(company_id=company_id)
+    invalidate_read_cache("companies", company_id)
+    invalidate_read_cache("company_slugs")  # o slug pode ter mudado
+    
     # Atualizar localStorage do frontend (retornar dados atualizados)
     updated_company = await db.companies.find_one({"id": company_id}, {"_id": 0})
     
     return {"message": "Empresa atualizada com sucesso!", "company": updated_company}
 
+# ========== RESUMOS MENSAIS (MONTHLY_SUMMARIES) ==========
+# Totais pré-agregados de lançamentos por empresa × mês × tipo × categoria ×
+# status × cancelado. Mantidos incrementalmente pelas rotas que gravam em
+# transactions; a primeira leitura de uma empresa reconstrói os resumos a
+# partir dos lançamentos brutos (ver monthly_summaries.py).
+
+_monthly_summaries_ready = set()
+_monthly_summaries_lock = asyncio.Lock()
+
+
+async def apply_transaction_to_summary(transaction: dict, sign: int = 1):
+    """Somar (sign=1) ou subtrair (sign=-1) um lançamento do seu resumo mensal"""
+    key = monthly_summary_key(transaction)
+    if not key:
+        return
+    amount = transaction.get("amount")
+    if not isinstance(amount, (int, float)):
+        amount = 0
+    try:
+        await db.monthly_summaries.update_one(
+            {"_id": key},
+            {
+                "$inc": {"total": sign * amount, "count": sign},
+                "$set": {**key, "updated_at": datetime.now(timezone.utc)}
+            },
+            upsert=True
+        )
+    except Exception as e:
+        # O resumo pode ser reconstruído; não falhar a gravação do lançamento
+        logger.error(f"⚠️ Erro ao atualizar resumo mensal: {e}")
+
+
+async def rebuild_monthly_summaries(company_id: str) -> int:
+    """Reconstruir os resumos mensais de uma empresa a partir dos lançamentos"""
+    total = await rebuild_company_summaries(db, company_id)
+    _monthly_summaries_ready.add(company_id)
+    return total
+
+
+async def ensure_monthly_summaries(company_id: str):
+    """Garantir que os resumos da empresa existem (constrói na primeira leitura)"""
+    if company_id in _monthly_summaries_ready:
+        return
+    async with _monthly_summaries_lock:
+        if company_id in _monthly_summaries_ready:
+            return
+        meta = await db.monthly_summaries_meta.find_one({"company_id": company_id}, {"_id": 1})
+        if meta:
+            _monthly_summaries_ready.add(company_id)
+        else:
+            await rebuild_monthly_summaries(company_id)
+
+
+async def get_monthly_totals(
+    company_id: str,
+    month: str,
+    end_month: Optional[str] = None,
+    status: Optional[str] = "realizado",
+    exclude_cancelled: bool = True,
+    types: Optional[List[str]] = None,
+    group_by: tuple = ("month", "type")
+) -> List[dict]:
+    """
+    Totais de lançamentos lidos dos resumos mensais.
+    Retorna uma linha por combinação de group_by: {"month", "type", ..., "total", "count"}.
+    """
+    await ensure_monthly_summaries(company_id)
+    
+    match = {"company_id": company_id, "month": {"$gte": month, "$lte": end_month or month}}
+    if status:
+        match["status"] = status
+    if exclude_cancelled:
+        match["cancelled"] = False
+    if types:
+        match["type"] = {"$in": types}
+    
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {field: f"${field}" for field in group_by},
+            "total": {"$sum": "$total"},
+            "count": {"$sum": "$count"}
+        }}
+    ]
+    results = await db.monthly_summaries.aggregate(pipeline).to_list(None)
+    return [{**r["_id"], "total": r["total"], "count": r["count"]} for r in results if r["count"] > 0]
+
+
+def totals_by_type(rows: List[dict]) -> dict:
+    """Somar linhas de get_monthly_totals por tipo (receita/custo/despesa)"""
+    totals = {"receita": 0, "custo": 0, "despesa": 0}
+    for row in rows:
+        if row.get("type") in totals:
+            totals[row["type"]] += row["total"]
+    return totals
+
+
 # ========== ROTAS DE LANÇAMENTOS ==========
 
 @api_router.post("/transactions")
@@ -1447,6 +2126,7 @@ async def create_transaction(transaction_data: TransactionCreate):
         doc = transaction.model_dump()
         doc['created_at'] = doc['created_at'].isoformat()
         await db.transactions.insert_one(doc)
+        await apply_transaction_to_summary(doc)
         
         return {"message": "Lançamento criado com sucesso!", "transaction_id": transaction.id}
     
@@ -1461,7 +2141,7 @@ async def get_transactions(company_id: str, month: Optional[str] = None):
     query = {"company_id": company_id}
     
     if month:
-        query["date"] = {"$regex": f"^{month}"}
+        query["date"] = month_range(month)
     
     # Limitar a 500 transações e ordenar por data decrescente
     transactions = await db.transactions.find(
@@ -1498,14 +2178,19 @@ async def update_transaction(transaction_id: str, transaction_data: TransactionC
             "category": category.get("name")  # Legado
         })
         
-        result = await db.transactions.update_one(
+        # Documento anterior, para mover o valor entre os resumos mensais
+        old_doc = await db.transactions.find_one_and_update(
             {"id": transaction_id},
-            {"$set": update_doc}
+            {"$set": update_doc},
+            projection={"_id": 0}
         )
         
-        if result.matched_count == 0:
+        if not old_doc:
             raise HTTPException(status_code=404, detail="Lançamento não encontrado")
         
+        await apply_transaction_to_summary(old_doc, -1)
+        await apply_transaction_to_summary({**old_doc, **update_doc})
+        
         return {"message": "Lançamento atualizado com sucesso!"}
     
     except HTTPException:
@@ -1516,55 +2201,32 @@ async def update_transaction(transaction_id: str, transaction_data: TransactionC
 
 @api_router.delete("/transactions/{transaction_id}")
 async def delete_transaction(transaction_id: str):
-    result = await db.transactions.delete_one({"id": transaction_id})
+    old_doc = await db.transactions.find_one_and_delete({"id": transaction_id}, projection={"_id": 0})
     
-    if result.deleted_count == 0:
+    if not old_doc:
         raise HTTPException(status_code=404, detail="Lançamento não encontrado")
     
+    await apply_transaction_to_summary(old_doc, -1)
+    
     return {"message": "Lançamento excluído com sucesso!"}
 
 # ========== ROTAS DE MÉTRICAS ==========
 
 @api_router.get("/metrics/{company_id}/{month}")
 async def get_metrics(company_id: str, month: str):
-    # Usar aggregation para calcular no banco ao invés de em Python
-    # Excluir lançamentos cancelados
-    pipeline = [
-        {"$match": {
-            "company_id": company_id,
-            "date": {"$regex": f"^{month}"},
-            "status": "realizado",
-            "cancelled": {"$ne": True}  # Excluir cancelados
-        }},
-        {"$group": {
-            "_id": "$type",
-            "total": {"$sum": "$amount"}
-        }}
-    ]
+    # Totais pré-agregados (resumos mensais), excluindo lançamentos cancelados
+    month_range(month)  # valida o formato do mês
+    totals = totals_by_type(await get_monthly_totals(company_id, month))
     
-    results = await db.transactions.aggregate(pipeline).to_list(None)
-    
-    # Buscar alíquota de ISS da configuração de markup
+    # Buscar alíquota de ISS da configuração de markup (padrão 3%)
     year, month_num = month.split("-")
-    markup_config = await db.markup_profiles.find_one(
-        {"company_id": company_id, "year": int(year), "month": int(month_num)},
-        {"_id": 0, "taxes": 1}
-    )
-    
-    # Alíquota padrão de ISS se não houver configuração
-    aliquota_iss = 0.03  # 3%
-    if markup_config and markup_config.get("taxes"):
-        aliquota_iss = markup_config["taxes"].get("iss_rate", 0.03)
+    aliquota_iss = await get_aliquota_iss(company_id, int(year), int(month_num))
     
     metrics = {"faturamento": 0, "custos": 0, "despesas": 0, "lucro_liquido": 0, "impostos": 0, "receita_liquida": 0}
     
-    for result in results:
-        if result['_id'] == 'receita':
-            metrics['faturamento'] = result['total']
-        elif result['_id'] == 'custo':
-            metrics['custos'] = result['total']
-        elif result['_id'] == 'despesa':
-            metrics['despesas'] = result['total']
+    metrics['faturamento'] = totals['receita']
+    metrics['custos'] = totals['custo']
+    metrics['despesas'] = totals['despesa']
     
     # Calcular impostos sobre vendas (ISS)
     metrics['impostos'] = round(metrics['faturamento'] * aliquota_iss, 2)
@@ -1767,29 +2429,95 @@ async def delete_custom_category(category_id: str):
 
 # ========== ROTAS DE ORÇAMENTOS ==========
 
+# ========== CONTADORES SEQUENCIAIS ==========
+# db.counters guarda um documento por sequência ({_id, seq}); o próximo
+# número sai de um único find_one_and_update com $inc, seguro sob
+# concorrência. Na primeira vez, a sequência é semeada com o maior número
+# já existente para continuar a numeração atual.
+
+async def next_sequence(counter_id: str, seed_fn) -> int:
+    """Próximo valor da sequência counter_id (seed_fn retorna o último número já usado)"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": counter_id},
+        {"$inc": {"seq": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if counter:
+        return counter["seq"]
+    
+    # Primeiro uso: semear com a numeração existente
+    try:
+        await db.counters.insert_one({"_id": counter_id, "seq": await seed_fn()})
+    except DuplicateKeyError:
+        pass  # Outra requisição semeou antes
+    
+    counter = await db.counters.find_one_and_update(
+        {"_id": counter_id},
+        {"$inc": {"seq": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+
+async def bump_sequence(counter_id: str, value: int):
+    """Garantir que a sequência não volte a gerar um número já usado manualmente"""
+    await db.counters.update_one({"_id": counter_id}, {"$max": {"seq": value}})
+
+
+async def max_sequence_number(collection, query: dict, field: str) -> int:
+    """Maior sufixo numérico (após o último '-') de field entre os documentos"""
+    maior = 0
+    async for doc in collection.find(query, {"_id": 0, field: 1}):
+        try:
+            maior = max(maior, int(str(doc.get(field, "")).split("-")[-1]))
+        except ValueError:
+            continue
+    return maior
+
+
+# ========== STATUS DE ORÇAMENTOS ==========
+# O campo status guarda sempre um valor canônico (maiúsculo, sem acento),
+# para que relatórios filtrem por igualdade no índice ll_empresa_status e
+# contem com $group no banco. Dados antigos com variações ("aprovado",
+# "Finalizado", "recusado"...) são convertidos por migrate_orcamento_status.py.
+
+ORCAMENTO_STATUS = ("RASCUNHO", "ENVIADO", "NEGOCIACAO", "APROVADO", "NAO_APROVADO")
+
+# Variações encontradas nos dados -> valor canônico (chave já normalizada)
+ORCAMENTO_STATUS_ALIASES = {
+    "rascunho": "RASCUNHO",
+    "enviado": "ENVIADO",
+    "negociacao": "NEGOCIACAO",
+    "em_negociacao": "NEGOCIACAO",
+    "aprovado": "APROVADO",
+    "aceito": "APROVADO",
+    "finalizado": "APROVADO",
+    "nao_aprovado": "NAO_APROVADO",
+    "recusado": "NAO_APROVADO",
+    "reprovado": "NAO_APROVADO",
+}
+
+
+def normalizar_status_orcamento(status: Optional[str]) -> Optional[str]:
+    """Valor canônico do status (None se não reconhecido)"""
+    if not status:
+        return None
+    return ORCAMENTO_STATUS_ALIASES.get(generate_slug(status.replace("_", " ")).replace("-", "_"))
+
+
 async def gerar_numero_orcamento(empresa_id: str):
     """Gerar número sequencial de orçamento (formato: LL-YYYY-NNNN)"""
     ano_atual = datetime.now().year
     
-    # Buscar último orçamento do ano
-    ultimo_orcamento = await db.orcamentos.find_one(
-        {
-            "empresa_id": empresa_id,
-            "numero_orcamento": {"$regex": f"^LL-{ano_atual}-"}
-        },
-        sort=[("created_at", -1)]
+    proximo_numero = await next_sequence(
+        f"orcamento:{empresa_id}:{ano_atual}",
+        lambda: max_sequence_number(
+            db.orcamentos,
+            tenant_query("orcamentos", empresa_id, {"numero_orcamento": {"$regex": f"^LL-{ano_atual}-"}}),
+            "numero_orcamento"
+        )
     )
     
-    if ultimo_orcamento:
-        # Extrair número do último orçamento
-        try:
-            ultimo_numero = int(ultimo_orcamento['numero_orcamento'].split('-')[-1])
-            proximo_numero = ultimo_numero + 1
-        except:
-            proximo_numero = 1
-    else:
-        proximo_numero = 1
-    
     return f"LL-{ano_atual}-{proximo_numero:04d}"
 
 @api_router.post("/orcamentos")
@@ -1858,10 +2586,10 @@ async def get_orcamentos(
     cliente: Optional[str] = None
 ):
     """Listar orçamentos com filtros"""
-    query = {"empresa_id": empresa_id}
+    query = tenant_query("orcamentos", empresa_id)
     
     if status:
-        query["status"] = status
+        query["status"] = normalizar_status_orcamento(status) or status
     if cliente:
         query["cliente_nome"] = {"$regex": cliente, "$options": "i"}
     if data_inicio and data_fim:
@@ -1897,6 +2625,8 @@ async def update_orcamento(orcamento_id: str, orcamento_data: OrcamentoCreate):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Orçamento não encontrado")
     
+    invalidate_pdf_cache(orcamento_id=orcamento_id)
+    
     return {"message": "Orçamento atualizado com sucesso!"}
 
 @api_router.delete("/orcamento/{orcamento_id}")
@@ -1907,6 +2637,8 @@ async def delete_orcamento(orcamento_id: str):
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Orçamento não encontrado")
     
+    invalidate_pdf_cache(orcamento_id=orcamento_id)
+    
     return {"message": "Orçamento excluído com sucesso!"}
 
 @api_router.patch("/orcamento/{orcamento_id}/status")
@@ -1917,27 +2649,35 @@ async def update_orcamento_status(orcamento_id: str, status_data: OrcamentoStatu
     if not orcamento:
         raise HTTPException(status_code=404, detail="Orçamento não encontrado")
     
+    status = normalizar_status_orcamento(status_data.status)
+    if not status:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Status inválido. Use: {', '.join(ORCAMENTO_STATUS)}"
+        )
+    
     update_fields = {
-        "status": status_data.status,
+        "status": status,
         "updated_at": datetime.now(timezone.utc).isoformat()
     }
     
     # Atualizar datas específicas baseado no status
-    if status_data.status == "ENVIADO":
+    if status == "ENVIADO":
         update_fields['enviado_em'] = datetime.now(timezone.utc).isoformat()
         if status_data.canal_envio:
             update_fields['canal_envio'] = status_data.canal_envio
-    elif status_data.status == "APROVADO":
+    elif status == "APROVADO":
         update_fields['aprovado_em'] = datetime.now(timezone.utc).isoformat()
         # NOTA: A comissão do vendedor é gerada proporcionalmente quando cada parcela é paga
         # Lógica implementada no endpoint update_status_conta_receber (PATCH /api/contas/receber/status)
         
-    elif status_data.status == "NAO_APROVADO":
+    elif status == "NAO_APROVADO":
         update_fields['nao_aprovado_em'] = datetime.now(timezone.utc).isoformat()
     
     await db.orcamentos.update_one({"id": orcamento_id}, {"$set": update_fields})
+    invalidate_pdf_cache(orcamento_id=orcamento_id)
     
-    return {"message": f"Status atualizado para {status_data.status}!"}
+    return {"message": f"Status atualizado para {status}!"}
 
 
 def generate_pdf_with_reportlab(orcamento: dict, empresa: dict, materiais: list = None, config: dict = None) -> bytes:
@@ -1972,6 +2712,8 @@ def generate_pdf_with_reportlab(orcamento: dict, empresa: dict, materiais: list
         try:
             capa_path = Path(ROOT_DIR) / capa_personalizada_url.lstrip('/')
             if capa_path.exists():
+                # Usar a versão A4 gerada no upload (capas antigas usam o original)
+                capa_path = image_rendition_path(capa_path, "a4")
                 # Desenha a imagem personalizada em tela cheia como capa
                 c.drawImage(str(capa_path), 0, 0, width=width, height=height, preserveAspectRatio=False)
                 c.showPage()  # Finaliza a página de capa e inicia uma nova
@@ -2431,37 +3173,298 @@ def generate_pdf_with_reportlab(orcamento: dict, empresa: dict, materiais: list
     buffer.seek(0)
     return buffer.getvalue()
 
-@api_router.get("/orcamento/{orcamento_id}/pdf")
-async def generate_orcamento_pdf(orcamento_id: str):
-    """Gerar PDF do orçamento usando apenas o modelo clássico em ReportLab (modelo antigo)."""
-    # Buscar orçamento
-    orcamento = await db.orcamentos.find_one({"id": orcamento_id}, {"_id": 0})
-    
-    if not orcamento:
-        raise HTTPException(status_code=404, detail="Orçamento não encontrado")
-    
-    # Buscar dados da empresa
-    empresa = await db.companies.find_one({"id": orcamento['empresa_id']}, {"_id": 0})
-    
-    if not empresa:
-        empresa = {"name": "Empresa"}
+# ========== POOL DE RENDERIZAÇÃO DE PDF ==========
+# generate_pdf_with_reportlab é CPU-bound e síncrona. Executá-la dentro do
+# handler async travaria o event loop do worker; por isso a renderização roda
+# em um pool de processos dedicado, com fila limitada e timeout.
+
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_RENDER_MAX_QUEUE = int(os.environ.get('PDF_RENDER_MAX_QUEUE', 32))
+PDF_RENDER_TIMEOUT = float(os.environ.get('PDF_RENDER_TIMEOUT', 60))
+
+_pdf_render_pool = None
+_pdf_render_slots = asyncio.Semaphore(PDF_RENDER_WORKERS)
+
+pdf_render_stats = {
+    "workers": PDF_RENDER_WORKERS,
+    "max_queue": PDF_RENDER_MAX_QUEUE,
+    "timeout_seconds": PDF_RENDER_TIMEOUT,
+    "queued": 0,
+    "running": 0,
+    "completed": 0,
+    "failed": 0,
+    "timeouts": 0,
+    "rejected": 0,
+    "total_render_seconds": 0.0,
+}
+
+
+def get_pdf_render_pool() -> ProcessPoolExecutor:
+    """Criar o pool de processos sob demanda (spawn evita herdar threads do Motor)"""
+    global _pdf_render_pool
+    if _pdf_render_pool is None:
+        _pdf_render_pool = ProcessPoolExecutor(
+            max_workers=PDF_RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pdf_render_pool
+
+
+def discard_pdf_render_pool(pool: Optional[ProcessPoolExecutor] = None, kill: bool = False):
+    """
+    Descartar o pool (padrão: o atual); um novo é criado na próxima renderização.
+    Com kill=True encerra também os processos: após um timeout o worker
+    continuaria renderizando e os próximos jobs ficariam presos atrás dele.
+    """
+    global _pdf_render_pool
+    pool = pool or _pdf_render_pool
+    if pool is None:
+        return
+    if _pdf_render_pool is pool:
+        _pdf_render_pool = None
+    if kill:
+        # ProcessPoolExecutor não expõe os processos antes do Python 3.14
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            try:
+                process.kill()
+            except Exception:
+                pass
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def render_pdf_orcamento(orcamento: dict, empresa: dict, materiais: list = None, config: dict = None) -> bytes:
+    """
+    Renderizar o PDF do orçamento no pool de processos.
+    - 503 se a fila estiver cheia
+    - 504 se a renderização passar de PDF_RENDER_TIMEOUT segundos
+    """
+    stats = pdf_render_stats
     
-    # Buscar materiais do orçamento
-    materiais = await db.orcamento_materiais.find(
-        {"id_orcamento": orcamento_id},
-        {"_id": 0}
-    ).to_list(1000)
+    if stats["queued"] >= PDF_RENDER_MAX_QUEUE:
+        stats["rejected"] += 1
+        raise HTTPException(status_code=503, detail="Servidor ocupado gerando PDFs. Tente novamente em instantes.")
     
-    # Buscar configuração de orçamento (cores, textos, logo, capa) usando a função que garante valores padrão
-    config = await get_orcamento_config(empresa.get('id'))
+    stats["queued"] += 1
+    try:
+        await _pdf_render_slots.acquire()
+    finally:
+        stats["queued"] -= 1
     
-    # Gerar PDF usando o modelo clássico em ReportLab
-    pdf_bytes = generate_pdf_with_reportlab(orcamento, empresa, materiais, config)
+    stats["running"] += 1
+    started = time.monotonic()
+    try:
+        loop = asyncio.get_running_loop()
+        pool = get_pdf_render_pool()
+        future = loop.run_in_executor(
+            pool, generate_pdf_with_reportlab, orcamento, empresa, materiais, config
+        )
+        pdf_bytes = await asyncio.wait_for(future, timeout=PDF_RENDER_TIMEOUT)
+        stats["completed"] += 1
+        return pdf_bytes
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        # O processo seguiria renderizando com o slot já liberado: encerrar o pool
+        # (renderizações em andamento nele falham com BrokenProcessPool)
+        discard_pdf_render_pool(pool, kill=True)
+        logger.error(f"⚠️ Timeout ao gerar PDF do orçamento {orcamento.get('id')}; pool de renderização reiniciado")
+        raise HTTPException(status_code=504, detail="Tempo esgotado ao gerar o PDF")
+    except BrokenProcessPool:
+        # Um worker morreu (ex: falta de memória); descartar o pool para recriar na próxima chamada
+        stats["failed"] += 1
+        discard_pdf_render_pool(pool)
+        logger.error("⚠️ Pool de renderização de PDF quebrado, será recriado")
+        raise HTTPException(status_code=500, detail="Erro ao gerar o PDF")
+    except Exception:
+        stats["failed"] += 1
+        raise
+    finally:
+        stats["running"] -= 1
+        stats["total_render_seconds"] += time.monotonic() - started
+        _pdf_render_slots.release()
+
+
+@api_router.get("/admin/pdf-render")
+async def admin_pdf_render_stats(user_id: str):
+    """Métricas do pool de renderização de PDF"""
+    await verify_admin(user_id)
+    finished = pdf_render_stats["completed"] + pdf_render_stats["failed"] + pdf_render_stats["timeouts"]
+    return {
+        **pdf_render_stats,
+        "avg_render_seconds": round(pdf_render_stats["total_render_seconds"] / finished, 3) if finished else 0
+    }
+
+
+# ========== CACHE DE PDF DOS ORÇAMENTOS ==========
+# PDFs renderizados ficam em memória (LRU limitado por bytes), endereçados
+# pelo hash do conteúdo que entra no PDF: orçamento, empresa, materiais e
+# configuração. O índice por orcamento_id responde sem renderizar nem buscar
+# materiais/configuração: basta conferir o updated_at do orçamento no banco
+# (find_one com projeção), que muda em toda alteração do orçamento ou dos seus
+# materiais, inclusive feita por outro processo. Alterações da empresa e da
+# configuração só invalidam o processo que as recebeu; nos demais a entrada
+# expira em PDF_CACHE_TTL_SECONDS.
+
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+PDF_CACHE_TTL_SECONDS = int(os.environ.get('PDF_CACHE_TTL_SECONDS', '300'))
+
+# Campos do orçamento que não aparecem no PDF e mudam a cada compartilhamento
+PDF_CACHE_IGNORED_FIELDS = ("pdf_share_token", "pdf_share_expiration")
+
+_pdf_cache = OrderedDict()  # chave (sha256) -> bytes do PDF
+_pdf_cache_index = {}  # orcamento_id -> {"key", "company_id", "numero_orcamento", "updated_at", "expires_at"}
+
+pdf_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "entries": 0, "bytes": 0}
+
+
+def pdf_cache_key(orcamento: dict, empresa: dict, materiais: list, config: dict) -> str:
+    """Hash do conteúdo que determina o PDF"""
+    payload = {
+        "orcamento": {k: v for k, v in orcamento.items() if k not in PDF_CACHE_IGNORED_FIELDS},
+        "empresa": empresa,
+        "materiais": materiais,
+        # Os previews em base64 são derivados das URLs, que já identificam as imagens
+        "config": {k: v for k, v in config.items() if k not in ("logo_preview", "capa_preview")},
+    }
+    raw = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def pdf_cache_lookup(orcamento_id: str, orcamento: Optional[dict] = None):
+    """
+    Retorna (bytes, entrada do índice) se o PDF do orçamento estiver em cache e
+    ainda corresponder ao orçamento no banco (mesmo updated_at, dentro do TTL).
+    Se o orçamento já foi lido, passe-o para evitar a consulta.
+    """
+    entry = _pdf_cache_index.get(orcamento_id)
+    if entry:
+        pdf_bytes = _pdf_cache.get(entry["key"])
+        if pdf_bytes is not None and time.monotonic() < entry["expires_at"]:
+            if orcamento is None:
+                orcamento = await db.orcamentos.find_one({"id": orcamento_id}, {"_id": 0, "updated_at": 1})
+            if orcamento is not None and orcamento.get("updated_at") == entry["updated_at"]:
+                _pdf_cache.move_to_end(entry["key"])
+                pdf_cache_stats["hits"] += 1
+                return pdf_bytes, entry
+        invalidate_pdf_cache(orcamento_id=orcamento_id)
+    pdf_cache_stats["misses"] += 1
+    return None, None
+
+
+def pdf_cache_store(orcamento: dict, key: str, pdf_bytes: bytes):
+    """Guardar o PDF renderizado, removendo os menos usados se passar do limite"""
+    if len(pdf_bytes) > PDF_CACHE_MAX_BYTES:
+        return
+    
+    previous = _pdf_cache_index.get(orcamento["id"])
+    if previous and previous["key"] != key:
+        _pdf_cache_discard(previous["key"])
+    
+    if key not in _pdf_cache:
+        _pdf_cache[key] = pdf_bytes
+        pdf_cache_stats["bytes"] += len(pdf_bytes)
+    _pdf_cache.move_to_end(key)
+    _pdf_cache_index[orcamento["id"]] = {
+        "key": key,
+        "company_id": orcamento.get("empresa_id"),
+        "numero_orcamento": orcamento.get("numero_orcamento"),
+        "updated_at": orcamento.get("updated_at"),
+        "expires_at": time.monotonic() + PDF_CACHE_TTL_SECONDS,
+    }
+    
+    while pdf_cache_stats["bytes"] > PDF_CACHE_MAX_BYTES and _pdf_cache:
+        oldest_key = next(iter(_pdf_cache))
+        _pdf_cache_discard(oldest_key)
+        pdf_cache_stats["evictions"] += 1
+    
+    pdf_cache_stats["entries"] = len(_pdf_cache)
+
+
+def _pdf_cache_discard(key: str):
+    pdf_bytes = _pdf_cache.pop(key, None)
+    if pdf_bytes is not None:
+        pdf_cache_stats["bytes"] -= len(pdf_bytes)
+    pdf_cache_stats["entries"] = len(_pdf_cache)
+
+
+def invalidate_pdf_cache(orcamento_id: str = None, company_id: str = None):
+    """Invalidar o PDF de um orçamento ou de todos os orçamentos de uma empresa"""
+    if orcamento_id:
+        ids = [orcamento_id]
+    elif company_id:
+        ids = [oid for oid, entry in _pdf_cache_index.items() if entry["company_id"] == company_id]
+    else:
+        return
+    
+    for oid in ids:
+        entry = _pdf_cache_index.pop(oid, None)
+        if entry:
+            _pdf_cache_discard(entry["key"])
+
+
+async def touch_orcamento(orcamento_id: str):
+    """Atualizar o updated_at do orçamento (ex.: materiais alterados), invalidando o PDF em todos os processos"""
+    await db.orcamentos.update_one(
+        {"id": orcamento_id},
+        {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    invalidate_pdf_cache(orcamento_id=orcamento_id)
+
+
+async def get_pdf_orcamento(orcamento: dict) -> bytes:
+    """Buscar os dados do orçamento e renderizar o PDF (ou reaproveitar do cache)"""
+    # Buscar dados da empresa
+    empresa = await get_company_cached(orcamento['empresa_id'])
+    
+    if not empresa:
+        empresa = {"name": "Empresa"}
+    
+    # Buscar materiais do orçamento
+    materiais = await db.orcamento_materiais.find(
+        {"id_orcamento": orcamento['id']},
+        {"_id": 0}
+    ).to_list(1000)
+    
+    # Buscar configuração de orçamento (cores, textos, logo, capa) usando a função que garante valores padrão
+    config = await get_orcamento_config(empresa.get('id'))
+    
+    key = pdf_cache_key(orcamento, empresa, materiais, config)
+    pdf_bytes = _pdf_cache.get(key)
+    if pdf_bytes is None:
+        # Gerar PDF usando o modelo clássico em ReportLab (que inclui a capa)
+        pdf_bytes = await render_pdf_orcamento(orcamento, empresa, materiais, config)
+    pdf_cache_store(orcamento, key, pdf_bytes)
+    
+    return pdf_bytes
+
+
+@api_router.get("/admin/pdf-cache")
+async def admin_pdf_cache_stats(user_id: str):
+    """Métricas do cache de PDF"""
+    await verify_admin(user_id)
+    return {**pdf_cache_stats, "max_bytes": PDF_CACHE_MAX_BYTES}
+
+
+@api_router.get("/orcamento/{orcamento_id}/pdf")
+async def generate_orcamento_pdf(orcamento_id: str):
+    """Gerar PDF do orçamento usando apenas o modelo clássico em ReportLab (modelo antigo)."""
+    # PDF já renderizado e ainda válido: responder sem renderizar de novo
+    pdf_bytes, cached = await pdf_cache_lookup(orcamento_id)
+    if pdf_bytes is not None:
+        numero_orcamento = cached.get('numero_orcamento') or orcamento_id
+    else:
+        # Buscar orçamento
+        orcamento = await db.orcamentos.find_one({"id": orcamento_id}, {"_id": 0})
+        
+        if not orcamento:
+            raise HTTPException(status_code=404, detail="Orçamento não encontrado")
+        
+        pdf_bytes = await get_pdf_orcamento(orcamento)
+        numero_orcamento = orcamento.get('numero_orcamento', orcamento_id)
     
     return StreamingResponse(
         BytesIO(pdf_bytes),
         media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename=orcamento_{orcamento.get('numero_orcamento', orcamento_id)}.pdf"}
+        headers={"Content-Disposition": f"attachment; filename=orcamento_{numero_orcamento}.pdf"}
     )
 
 
@@ -2590,7 +3593,7 @@ async def generate_orcamento_html(orcamento_id: str):
         raise HTTPException(status_code=404, detail="Orçamento não encontrado")
     
     # Buscar dados da empresa
-    empresa = await db.companies.find_one({"id": orcamento['empresa_id']}, {"_id": 0})
+    empresa = await get_company_cached(orcamento['empresa_id'])
     
     if not empresa:
         empresa = {"name": "Empresa"}
@@ -2639,24 +3642,14 @@ async def generate_orcamento_html(orcamento_id: str):
     
     # Verificar se tem logo configurada e converter para Base64
     logo_url = config.get('logo_url', '')
-    logo_base64 = None
     tem_logo = False
     
     if logo_url:
         try:
-            # Tentar carregar logo do disco e converter para base64
-            logo_path = Path(ROOT_DIR) / logo_url.lstrip('/')
-            if logo_path.exists():
-                import base64
-                with open(logo_path, 'rb') as f:
-                    logo_data = f.read()
-                    logo_base64 = base64.b64encode(logo_data).decode('utf-8')
-                    # Detectar tipo de imagem
-                    ext = logo_path.suffix.lower()
-                    mime_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif', '.svg': 'image/svg+xml'}
-                    mime_type = mime_types.get(ext, 'image/jpeg')
-                    logo_url = f"data:{mime_type};base64,{logo_base64}"
-                    tem_logo = True
+            # Logo já codificada em cache (data URI ou URL cacheável)
+            logo_src = await image_asset_src(logo_url)
+            logo_url = logo_src or ''
+            tem_logo = bool(logo_src)
         except Exception as e:
             logger.warning(f"Erro ao carregar logo: {e}")
             logo_url = ''
@@ -2739,40 +3732,32 @@ async def generate_orcamento_html(orcamento_id: str):
     if capa_personalizada_url:
         # Carregar imagem de capa personalizada
         try:
-            capa_path = Path(ROOT_DIR) / capa_personalizada_url.lstrip('/')
-            if capa_path.exists():
-                import base64
-                with open(capa_path, 'rb') as f:
-                    capa_data = f.read()
-                    capa_base64 = base64.b64encode(capa_data).decode('utf-8')
-                    ext = capa_path.suffix.lower()
-                    mime_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png'}
-                    mime_type = mime_types.get(ext, 'image/jpeg')
-                    
-                    # Gerar HTML da capa personalizada com informações da empresa sobrepostas
-                    logo_capa_html = f'<img src="{logo_url}" alt="Logo" style="max-width:150px;max-height:100px;object-fit:contain;margin-bottom:15px;" />' if tem_logo else ''
-                    
-                    capa_html = f'''
-                    <section class="flow-item cover-page">
-                        <div class="card" style="position:relative;height:100%;display:flex;flex-direction:column;justify-content:flex-start;align-items:center;overflow:hidden;min-height:260mm;padding:0;">
-                            <!-- Imagem de fundo -->
-                            <img src="data:{mime_type};base64,{capa_base64}" alt="Capa do Orçamento" style="width:100%;height:100%;object-fit:cover;position:absolute;top:0;left:0;z-index:1;" />
-                            
-                            <!-- Overlay com informações da empresa (topo) -->
-                            <div style="position:relative;z-index:10;text-align:center;padding:30px 25px;margin-top:25px;background:rgba(255,255,255,0.95);border-radius:12px;max-width:80%;box-shadow:0 4px 20px rgba(0,0,0,0.15);">
-                                {logo_capa_html}
-                                {f'<div style="font-size:24px;font-weight:700;color:#333;margin-bottom:8px;">{nome_fantasia}</div>' if nome_fantasia else ''}
-                                <div style="font-size:18px;font-weight:600;color:#555;margin-bottom:8px;">{razao_social}</div>
-                                {f'<div style="font-size:14px;color:#666;margin-bottom:5px;">CNPJ: {cnpj_empresa}</div>' if cnpj_empresa else ''}
-                                {f'<div style="font-size:14px;color:#666;">Tel: {telefone_empresa}</div>' if telefone_empresa else ''}
-                            </div>
-                            
-                            <!-- Título "Proposta Comercial" centralizado -->
-                            <div style="position:absolute;top:50%;left:50%;transform:translate(-50%,-50%);z-index:10;text-align:center;padding:30px 60px;background:rgba(255,255,255,0.85);border-radius:12px;box-shadow:0 4px 20px rgba(0,0,0,0.15);">
-                                <div style="font-size:48px;font-weight:700;color:#333;letter-spacing:2px;">PROPOSTA COMERCIAL</div>
-                            </div>
+            capa_src = await image_asset_src(capa_personalizada_url, 'a4')
+            if capa_src:
+                # Gerar HTML da capa personalizada com informações da empresa sobrepostas
+                logo_capa_html = f'<img src="{logo_url}" alt="Logo" style="max-width:150px;max-height:100px;object-fit:contain;margin-bottom:15px;" />' if tem_logo else ''
+                
+                capa_html = f'''
+                <section class="flow-item cover-page">
+                    <div class="card" style="position:relative;height:100%;display:flex;flex-direction:column;justify-content:flex-start;align-items:center;overflow:hidden;min-height:260mm;padding:0;">
+                        <!-- Imagem de fundo -->
+                        <img src="{capa_src}" alt="Capa do Orçamento" style="width:100%;height:100%;object-fit:cover;position:absolute;top:0;left:0;z-index:1;" />
+                        
+                        <!-- Overlay com informações da empresa (topo) -->
+                        <div style="position:relative;z-index:10;text-align:center;padding:30px 25px;margin-top:25px;background:rgba(255,255,255,0.95);border-radius:12px;max-width:80%;box-shadow:0 4px 20px rgba(0,0,0,0.15);">
+                            {logo_capa_html}
+                            {f'<div style="font-size:24px;font-weight:700;color:#333;margin-bottom:8px;">{nome_fantasia}</div>' if nome_fantasia else ''}
+                            <div style="font-size:18px;font-weight:600;color:#555;margin-bottom:8px;">{razao_social}</div>
+                            {f'<div style="font-size:14px;color:#666;margin-bottom:5px;">CNPJ: {cnpj_empresa}</div>' if cnpj_empresa else ''}
+                            {f'<div style="font-size:14px;color:#666;">Tel: {telefone_empresa}</div>' if telefone_empresa else ''}
                         </div>
-                    </section>'''
+                        
+                        <!-- Título "Proposta Comercial" centralizado -->
+                        <div style="position:absolute;top:50%;left:50%;transform:translate(-50%,-50%);z-index:10;text-align:center;padding:30px 60px;background:rgba(255,255,255,0.85);border-radius:12px;box-shadow:0 4px 20px rgba(0,0,0,0.15);">
+                            <div style="font-size:48px;font-weight:700;color:#333;letter-spacing:2px;">PROPOSTA COMERCIAL</div>
+                        </div>
+                    </div>
+                </section>'''
         except Exception as e:
             logger.warning(f"Erro ao carregar capa personalizada: {e}")
     
@@ -3113,7 +4098,7 @@ async def enviar_orcamento_whatsapp(orcamento_id: str):
         raise HTTPException(status_code=404, detail="Orçamento não encontrado")
     
     # Buscar empresa para pegar o nome
-    empresa = await db.companies.find_one({"id": orcamento['empresa_id']}, {"_id": 0})
+    empresa = await get_company_cached(orcamento['empresa_id'])
     nome_empresa = empresa.get('razao_social') or empresa.get('name', 'Empresa') if empresa else 'Empresa'
     
     # Gerar token único para este PDF
@@ -3157,6 +4142,28 @@ async def enviar_orcamento_whatsapp(orcamento_id: str):
 
 # ========== ACEITE DE ORÇAMENTO ==========
 
+async def run_in_transaction(fn):
+    """
+    Executar fn(session) em uma transação do MongoDB.
+    Em servidor standalone (sem replica set) executa fn(None) sem transação;
+    por isso fn deve ser idempotente.
+    """
+    try:
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                return await fn(session)
+    except OperationFailure as e:
+        # 20 = IllegalOperation: transações exigem replica set ou mongos
+        if e.code != 20:
+            raise
+    return await fn(None)
+
+
+def aceite_doc_id(orcamento_id: str, parte: str) -> str:
+    """ID determinístico dos documentos gerados pelo aceite (retry não duplica)"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"orcamento:{orcamento_id}:aceite:{parte}"))
+
+
 @api_router.post("/orcamento/{orcamento_id}/aceitar")
 async def aceitar_orcamento(orcamento_id: str, request: Request):
     """
@@ -3177,7 +4184,7 @@ async def aceitar_orcamento(orcamento_id: str, request: Request):
         return {"message": "Orçamento já foi aceito anteriormente", "already_accepted": True}
     
     # Buscar empresa
-    empresa = await db.companies.find_one({"id": orcamento['empresa_id']}, {"_id": 0})
+    empresa = await get_company_cached(orcamento['empresa_id'])
     if not empresa:
         raise HTTPException(status_code=404, detail="Empresa não encontrada")
     
@@ -3187,8 +4194,8 @@ async def aceitar_orcamento(orcamento_id: str, request: Request):
     # Data atual
     agora = datetime.now(timezone.utc)
     
-    # Gerar parcelas no Contas a Receber
-    contas_geradas = []
+    # Gerar parcelas no Contas a Receber (gravadas de uma vez abaixo)
+    contas = []
     
     forma_pagamento = orcamento.get('forma_pagamento', 'avista')
     valor_total = orcamento.get('preco_praticado', 0)
@@ -3201,7 +4208,7 @@ async def aceitar_orcamento(orcamento_id: str, request: Request):
     if forma_pagamento == 'avista':
         # Pagamento único
         conta = {
-            "id": str(uuid.uuid4()),
+            "id": aceite_doc_id(orcamento_id, "avista"),
             "company_id": orcamento['empresa_id'],
             "user_id": orcamento['usuario_id'],
             "tipo": "RECEBER",
@@ -3217,13 +4224,12 @@ async def aceitar_orcamento(orcamento_id: str, request: Request):
             "created_at": agora.isoformat(),
             "updated_at": agora.isoformat()
         }
-        await db.contas.insert_one(conta)
-        contas_geradas.append(conta['id'])
+        contas.append(conta)
     else:
         # Entrada + Parcelas
         if valor_entrada > 0:
             conta_entrada = {
-                "id": str(uuid.uuid4()),
+                "id": aceite_doc_id(orcamento_id, "entrada"),
                 "company_id": orcamento['empresa_id'],
                 "user_id": orcamento['usuario_id'],
                 "tipo": "RECEBER",
@@ -3239,8 +4245,7 @@ async def aceitar_orcamento(orcamento_id: str, request: Request):
                 "created_at": agora.isoformat(),
                 "updated_at": agora.isoformat()
             }
-            await db.contas.insert_one(conta_entrada)
-            contas_geradas.append(conta_entrada['id'])
+            contas.append(conta_entrada)
         
         # Criar cada parcela
         for i, parcela in enumerate(parcelas):
@@ -3248,7 +4253,7 @@ async def aceitar_orcamento(orcamento_id: str, request: Request):
             data_vencimento = data_entrada + timedelta(days=30 * (i + 1))
             
             conta_parcela = {
-                "id": str(uuid.uuid4()),
+                "id": aceite_doc_id(orcamento_id, f"parcela-{i + 1}"),
                 "company_id": orcamento['empresa_id'],
                 "user_id": orcamento['usuario_id'],
                 "tipo": "RECEBER",
@@ -3264,21 +4269,40 @@ async def aceitar_orcamento(orcamento_id: str, request: Request):
                 "created_at": agora.isoformat(),
                 "updated_at": agora.isoformat()
             }
-            await db.contas.insert_one(conta_parcela)
-            contas_geradas.append(conta_parcela['id'])
+            contas.append(conta_parcela)
+    
+    contas_geradas = [c['id'] for c in contas]
+    
+    # Gravar contas e aprovar o orçamento juntos (transação quando houver replica set).
+    # As contas usam _id determinístico com upsert/$setOnInsert: repetir o aceite
+    # depois de uma falha parcial não duplica parcelas.
+    async def gravar_aceite(session):
+        if contas:
+            await db.contas.bulk_write(
+                [UpdateOne({"_id": c['id']}, {"$setOnInsert": c}, upsert=True) for c in contas],
+                ordered=False,
+                session=session
+            )
+        result = await db.orcamentos.update_one(
+            {"id": orcamento_id, "status": {"$ne": "APROVADO"}},
+            {"$set": {
+                "status": "APROVADO",
+                "aprovado_em": agora.isoformat(),
+                "aceito_em": agora.isoformat(),
+                "aceito_por_ip": client_ip,
+                "contas_receber_geradas": contas_geradas,
+                "updated_at": agora.isoformat()
+            }},
+            session=session
+        )
+        return result.modified_count > 0
     
-    # Atualizar status do orçamento
-    await db.orcamentos.update_one(
-        {"id": orcamento_id},
-        {"$set": {
-            "status": "APROVADO",
-            "aprovado_em": agora.isoformat(),
-            "aceito_em": agora.isoformat(),
-            "aceito_por_ip": client_ip,
-            "contas_receber_geradas": contas_geradas,
-            "updated_at": agora.isoformat()
-        }}
-    )
+    aprovado_agora = await run_in_transaction(gravar_aceite)
+    invalidate_pdf_cache(orcamento_id=orcamento_id)
+    
+    if not aprovado_agora:
+        # Aceite concorrente chegou primeiro
+        return {"message": "Orçamento já foi aceito anteriormente", "already_accepted": True}
     
     # NOTA: A comissão do vendedor é gerada PROPORCIONALMENTE quando cada parcela é paga
     # Lógica implementada no endpoint update_status_conta_receber (PATCH /api/contas/receber/status)
@@ -3311,7 +4335,7 @@ Acesse o sistema para mais detalhes."""
     
     # Criar notificação no sistema com mais detalhes
     notificacao = {
-        "id": str(uuid.uuid4()),
+        "id": aceite_doc_id(orcamento_id, "notificacao"),
         "company_id": orcamento['empresa_id'],
         "user_id": orcamento['usuario_id'],
         "tipo": "ORCAMENTO_ACEITO",
@@ -3326,7 +4350,11 @@ Acesse o sistema para mais detalhes."""
         "whatsapp_url": whatsapp_url,
         "created_at": agora.isoformat()
     }
-    await db.notificacoes.insert_one(notificacao)
+    await db.notificacoes.update_one(
+        {"_id": notificacao['id']},
+        {"$setOnInsert": notificacao},
+        upsert=True
+    )
     
     response = {
         "message": "Orçamento aceito com sucesso!",
@@ -3396,22 +4424,9 @@ async def share_orcamento_pdf(token: str):
     if int(time.time()) > expiration:
         raise HTTPException(status_code=410, detail="Link expirado. Solicite um novo ao vendedor.")
     
-    # Buscar empresa
-    empresa = await db.companies.find_one({"id": orcamento['empresa_id']}, {"_id": 0})
-    if not empresa:
-        empresa = {"name": "Empresa"}
-    
-    # Buscar materiais do orçamento
-    materiais = await db.orcamento_materiais.find(
-        {"id_orcamento": orcamento['id']},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    # Buscar configuração de orçamento com valores padrão garantidos
-    config = await get_orcamento_config(empresa.get('id'))
-    
-    # Gerar PDF usando ReportLab (que inclui a capa)
-    pdf_bytes = generate_pdf_with_reportlab(orcamento, empresa, materiais, config)
+    pdf_bytes, _ = await pdf_cache_lookup(orcamento['id'], orcamento)
+    if pdf_bytes is None:
+        pdf_bytes = await get_pdf_orcamento(orcamento)
     
     return StreamingResponse(
         BytesIO(pdf_bytes),
@@ -3519,6 +4534,7 @@ async def add_material_to_orcamento(orcamento_id: str, material_data: OrcamentoM
     doc = orcamento_material.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.orcamento_materiais.insert_one(doc)
+    await touch_orcamento(orcamento_id)
     
     # Se id_material não existe (material novo), criar material no catálogo
     if not material_data.id_material:
@@ -3567,6 +4583,8 @@ async def remove_material_from_orcamento(orcamento_id: str, orcamento_material_i
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Material não encontrado no orçamento")
     
+    await touch_orcamento(orcamento_id)
+    
     return {"message": "Material removido do orçamento com sucesso!"}
 
 # ========== ENDPOINTS: CONFIGURAÇÃO DO SISTEMA ==========
@@ -3614,6 +4632,236 @@ async def update_subscription_price(price_data: PriceUpdate):
     
     return {"message": "Preço atualizado com sucesso!", "new_price": new_price}
 
+# ========== PIPELINE DE IMAGENS ENVIADAS ==========
+# Fotos de celular e capas chegam com vários MB, EXIF e resolução muito acima
+# do necessário. No upload a imagem é rotacionada conforme o EXIF, reduzida,
+# recomprimida sem metadados e, no caso da capa, ganha versões "a4" (PDF e
+# HTML do orçamento) e "preview" (tela de configuração), gravadas ao lado do
+# arquivo como <nome>_<versão>.<ext> e servidas por get_image_asset.
+
+UPLOAD_IMAGE_MAX_SIZE = (2480, 3508)  # A4 a 300 dpi
+UPLOAD_LOGO_MAX_SIZE = (1200, 1200)
+UPLOAD_IMAGE_RENDITIONS = {
+    "a4": (1240, 1754),  # A4 a 150 dpi, suficiente para a capa
+    "preview": (480, 680),  # Miniatura da tela de configuração
+}
+UPLOAD_JPEG_QUALITY = 85
+
+
+def _encode_processed_image(img, keep_alpha: bool):
+    """Salvar sem metadados: PNG se tiver transparência, JPEG progressivo caso contrário"""
+    out = BytesIO()
+    if keep_alpha:
+        img.save(out, format='PNG', optimize=True)
+        return out.getvalue(), '.png'
+    img.convert('RGB').save(out, format='JPEG', quality=UPLOAD_JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), '.jpg'
+
+
+def process_uploaded_image(content: bytes, max_size: tuple = UPLOAD_IMAGE_MAX_SIZE, renditions: tuple = ("a4", "preview")):
+    """
+    Normalizar a imagem enviada.
+    Retorna (bytes, extensão, {versão: bytes}) ou None se não for uma imagem que o Pillow consiga abrir.
+    """
+    try:
+        from PIL import Image, ImageOps
+        with Image.open(BytesIO(content)) as original:
+            img = ImageOps.exif_transpose(original)
+            img.load()
+    except Exception as e:
+        logger.warning(f"Imagem não processada, salvando original: {e}")
+        return None
+    
+    keep_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    if keep_alpha and img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    
+    main = img.copy()
+    main.thumbnail(max_size)
+    data, ext = _encode_processed_image(main, keep_alpha)
+    
+    versions = {}
+    for name in renditions:
+        version = img.copy()
+        version.thumbnail(UPLOAD_IMAGE_RENDITIONS[name])
+        versions[name] = _encode_processed_image(version, keep_alpha)[0]
+    
+    return data, ext, versions
+
+
+async def save_uploaded_image(content: bytes, directory: Path, stem: str, original_ext: str,
+                              max_size: tuple = UPLOAD_IMAGE_MAX_SIZE, renditions: tuple = ("a4", "preview")):
+    """
+    Processar e gravar a imagem e suas versões.
+    Retorna (nome do arquivo principal, {versão: nome do arquivo}).
+    """
+    processed = await asyncio.to_thread(process_uploaded_image, content, max_size, renditions)
+    directory.mkdir(parents=True, exist_ok=True)
+    
+    if processed is None:
+        filename = f"{stem}{original_ext}"
+        async with aiofiles.open(directory / filename, 'wb') as f:
+            await f.write(content)
+        return filename, {}
+    
+    data, ext, versions = processed
+    filename = f"{stem}{ext}"
+    async with aiofiles.open(directory / filename, 'wb') as f:
+        await f.write(data)
+    
+    version_files = {}
+    for name, version_data in versions.items():
+        version_filename = f"{stem}_{name}{ext}"
+        async with aiofiles.open(directory / version_filename, 'wb') as f:
+            await f.write(version_data)
+        version_files[name] = version_filename
+    
+    return filename, version_files
+
+
+def image_rendition_path(path: Path, rendition: str) -> Path:
+    """Caminho da versão reduzida, se existir; caso contrário (uploads antigos) o próprio arquivo"""
+    candidate = path.with_name(f"{path.stem}_{rendition}{path.suffix}")
+    return candidate if candidate.exists() else path
+
+
+# ========== CACHE DE IMAGENS (LOGO E CAPA) ==========
+# Logo e capa eram lidas do disco e convertidas para base64 a cada
+# visualização. Agora cada variante é codificada uma vez (no upload ou no
+# primeiro acesso) e mantida em um LRU limitado por bytes. A entrada é
+# validada pelo mtime do arquivo, então sobrescrever o arquivo também invalida.
+
+ASSET_CACHE_MAX_BYTES = int(os.environ.get('ASSET_CACHE_MAX_BYTES', 48 * 1024 * 1024))
+# Se "false", o HTML do orçamento referencia /api/assets/... (cacheável com ETag) em vez de embutir base64
+INLINE_ORCAMENTO_IMAGES = os.environ.get('INLINE_ORCAMENTO_IMAGES', 'true').lower() == 'true'
+
+# Variantes: None = arquivo original; as demais são as versões gravadas no
+# upload (uploads antigos, sem a versão no disco, são reduzidos na hora)
+IMAGE_ASSET_VARIANTS = {"original": None, **UPLOAD_IMAGE_RENDITIONS}
+
+IMAGE_MIME_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif', '.svg': 'image/svg+xml', '.webp': 'image/webp'}
+
+_asset_cache = OrderedDict()  # (caminho, variante) -> entrada
+asset_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "entries": 0, "bytes": 0}
+
+
+def _resolve_upload_url(url: str) -> Optional[Path]:
+    """Converter /uploads/... em caminho no disco, sem sair da pasta de uploads"""
+    if not url:
+        return None
+    uploads_root = (Path(ROOT_DIR) / "uploads").resolve()
+    path = (Path(ROOT_DIR) / url.lstrip('/')).resolve()
+    if uploads_root not in path.parents:
+        return None
+    return path
+
+
+def _encode_image_asset(path: Path, variant: str) -> dict:
+    """Ler (e reduzir, se for o caso) a imagem e gerar o base64. Executado fora do event loop."""
+    box = IMAGE_ASSET_VARIANTS[variant]
+    source = image_rendition_path(path, variant) if box else path
+    data = source.read_bytes()
+    mime_type = IMAGE_MIME_TYPES.get(source.suffix.lower(), 'image/jpeg')
+    
+    # Sem versão gravada no upload: reduzir a partir do original
+    if box and source == path and mime_type in ('image/jpeg', 'image/png', 'image/webp'):
+        try:
+            from PIL import Image
+            with Image.open(BytesIO(data)) as img:
+                if img.width > box[0] or img.height > box[1]:
+                    img.thumbnail(box)
+                    data, ext = _encode_processed_image(img, keep_alpha=mime_type == 'image/png')
+                    mime_type = IMAGE_MIME_TYPES[ext]
+        except Exception as e:
+            logger.warning(f"Erro ao reduzir imagem {path.name}: {e}")
+    
+    return {
+        "data": data,
+        "mime_type": mime_type,
+        "etag": hashlib.sha1(data).hexdigest(),
+        "data_uri": f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}",
+    }
+
+
+async def get_image_asset(url: str, variant: str = "original") -> Optional[dict]:
+    """Buscar a variante codificada de uma imagem enviada (logo/capa)"""
+    if variant not in IMAGE_ASSET_VARIANTS:
+        return None
+    path = _resolve_upload_url(url)
+    if not path:
+        return None
+    try:
+        mtime = path.stat().st_mtime_ns
+    except OSError:
+        return None
+    
+    key = (str(path), variant)
+    entry = _asset_cache.get(key)
+    if entry and entry["mtime"] == mtime:
+        _asset_cache.move_to_end(key)
+        asset_cache_stats["hits"] += 1
+        return entry
+    
+    asset_cache_stats["misses"] += 1
+    entry = await asyncio.to_thread(_encode_image_asset, path, variant)
+    entry["mtime"] = mtime
+    entry["size"] = len(entry["data"]) + len(entry["data_uri"])
+    
+    _asset_cache_discard(key)
+    _asset_cache[key] = entry
+    asset_cache_stats["bytes"] += entry["size"]
+    while asset_cache_stats["bytes"] > ASSET_CACHE_MAX_BYTES and len(_asset_cache) > 1:
+        _asset_cache_discard(next(iter(_asset_cache)))
+        asset_cache_stats["evictions"] += 1
+    asset_cache_stats["entries"] = len(_asset_cache)
+    return entry
+
+
+def _asset_cache_discard(key):
+    entry = _asset_cache.pop(key, None)
+    if entry:
+        asset_cache_stats["bytes"] -= entry["size"]
+    asset_cache_stats["entries"] = len(_asset_cache)
+
+
+def invalidate_image_asset(url: str):
+    """Remover todas as variantes de uma imagem do cache"""
+    path = _resolve_upload_url(url)
+    if path:
+        for variant in IMAGE_ASSET_VARIANTS:
+            _asset_cache_discard((str(path), variant))
+
+
+async def image_data_uri(url: str, variant: str = "original") -> Optional[str]:
+    """data: URI da imagem (base64 já codificado em cache)"""
+    entry = await get_image_asset(url, variant)
+    return entry["data_uri"] if entry else None
+
+
+async def image_asset_src(url: str, variant: str = "original") -> Optional[str]:
+    """src para <img>: data URI embutido ou URL cacheável, conforme INLINE_ORCAMENTO_IMAGES"""
+    entry = await get_image_asset(url, variant)
+    if not entry:
+        return None
+    if INLINE_ORCAMENTO_IMAGES:
+        return entry["data_uri"]
+    return f"/api/assets/{variant}/{url.lstrip('/')}?v={entry['etag'][:12]}"
+
+
+@api_router.get("/assets/{variant}/{file_path:path}")
+async def serve_image_asset(variant: str, file_path: str, request: Request):
+    """Servir variante de logo/capa com ETag e cache de longa duração"""
+    entry = await get_image_asset(f"/{file_path}", variant)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Arquivo não encontrado")
+    
+    etag = f'"{entry["etag"]}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["data"], media_type=entry["mime_type"], headers=headers)
+
+
 # ========== ENDPOINTS: CONFIGURAÇÃO DE ORÇAMENTO ==========
 
 @api_router.post("/upload-logo")
@@ -3626,19 +4874,17 @@ async def upload_logo(file: UploadFile = File(...)):
         
         # Gerar nome único para o arquivo
         file_extension = file.filename.split('.')[-1]
-        unique_filename = f"logo_{uuid.uuid4()}.{file_extension}"
-        file_path = Path(ROOT_DIR) / "uploads" / unique_filename
         
-        # Criar diretório se não existir
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Salvar arquivo
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
+        # Processar (reduzir, remover metadados) e salvar arquivo
+        content = await file.read()
+        unique_filename, _ = await save_uploaded_image(
+            content, Path(ROOT_DIR) / "uploads", f"logo_{uuid.uuid4()}", f".{file_extension}",
+            max_size=UPLOAD_LOGO_MAX_SIZE, renditions=()
+        )
         
         # Retornar URL do arquivo
         logo_url = f"/uploads/{unique_filename}"
+        await get_image_asset(logo_url)
         
         return {"logo_url": logo_url, "message": "Logo enviada com sucesso!"}
     
@@ -3666,15 +4912,15 @@ async def upload_capa(file: UploadFile = File(...)):
         
         # Gerar nome único
         ext = Path(file.filename).suffix.lower()
-        unique_filename = f"capa_{uuid.uuid4().hex}{ext}"
-        file_path = uploads_dir / unique_filename
         
-        # Salvar arquivo
-        async with aiofiles.open(file_path, 'wb') as f:
-            await f.write(content)
+        # Processar (versões A4 e preview, sem metadados) e salvar arquivo
+        unique_filename, _ = await save_uploaded_image(content, uploads_dir, f"capa_{uuid.uuid4().hex}", ext)
         
         # Retornar URL do arquivo
         capa_url = f"/uploads/capas/{unique_filename}"
+        # Pré-codificar as variantes usadas no HTML e na tela de configuração
+        await get_image_asset(capa_url, "a4")
+        await get_image_asset(capa_url, "preview")
         
         return {"capa_url": capa_url, "message": "Capa enviada com sucesso!"}
     
@@ -3687,7 +4933,10 @@ async def upload_capa(file: UploadFile = File(...)):
 @api_router.get("/orcamento-config/{company_id}")
 async def get_orcamento_config(company_id: str):
     """Buscar configuração de orçamento da empresa"""
-    config = await db.orcamento_config.find_one({"company_id": company_id}, {"_id": 0})
+    config = await cached_read(
+        "orcamento_config", (company_id,),
+        lambda: db.orcamento_config.find_one({"company_id": company_id}, {"_id": 0})
+    )
     
     if not config:
         # Retornar configuração padrão se não existir
@@ -3711,34 +4960,20 @@ async def get_orcamento_config(company_id: str):
     if 'capa_personalizada_url' not in config:
         config['capa_personalizada_url'] = None
     
-    # Converter logo para base64 para preview
+    # Previews em base64 (codificados uma vez por upload e mantidos em cache)
     if config.get('logo_url'):
         try:
-            logo_path = Path(ROOT_DIR) / config['logo_url'].lstrip('/')
-            if logo_path.exists():
-                with open(logo_path, 'rb') as f:
-                    logo_data = f.read()
-                    logo_base64 = base64.b64encode(logo_data).decode('utf-8')
-                    # Detectar tipo de imagem
-                    ext = logo_path.suffix.lower()
-                    mime_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif', '.svg': 'image/svg+xml'}
-                    mime_type = mime_types.get(ext, 'image/jpeg')
-                    config['logo_preview'] = f"data:{mime_type};base64,{logo_base64}"
+            logo_preview = await image_data_uri(config['logo_url'])
+            if logo_preview:
+                config['logo_preview'] = logo_preview
         except Exception as e:
             logger.warning(f"Erro ao gerar preview da logo: {e}")
     
-    # Converter capa personalizada para base64 para preview
     if config.get('capa_personalizada_url'):
         try:
-            capa_path = Path(ROOT_DIR) / config['capa_personalizada_url'].lstrip('/')
-            if capa_path.exists():
-                with open(capa_path, 'rb') as f:
-                    capa_data = f.read()
-                    capa_base64 = base64.b64encode(capa_data).decode('utf-8')
-                    ext = capa_path.suffix.lower()
-                    mime_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png'}
-                    mime_type = mime_types.get(ext, 'image/jpeg')
-                    config['capa_preview'] = f"data:{mime_type};base64,{capa_base64}"
+            capa_preview = await image_data_uri(config['capa_personalizada_url'], 'preview')
+            if capa_preview:
+                config['capa_preview'] = capa_preview
         except Exception as e:
             logger.warning(f"Erro ao gerar preview da capa: {e}")
     
@@ -3755,10 +4990,17 @@ async def create_or_update_orcamento_config(config_data: OrcamentoConfigCreate,
         update_doc = config_data.model_dump()
         update_doc['updated_at'] = datetime.now(timezone.utc).isoformat()
         
+        # Imagens substituídas não serão mais usadas
+        for field in ('logo_url', 'capa_personalizada_url'):
+            if existing.get(field) and existing.get(field) != update_doc.get(field):
+                invalidate_image_asset(existing[field])
+        
         await db.orcamento_config.update_one(
             {"company_id": company_id},
             {"$set": update_doc}
         )
+        invalidate_pdf_cache(company_id=company_id)
+        invalidate_read_cache("orcamento_config", company_id)
         
         return {"message": "Configuração atualizada com sucesso!"}
     else:
@@ -3773,6 +5015,8 @@ async def create_or_update_orcamento_config(config_data: OrcamentoConfigCreate,
         doc['updated_at'] = doc['updated_at'].isoformat()
         
         await db.orcamento_config.insert_one(doc)
+        invalidate_pdf_cache(company_id=company_id)
+        invalidate_read_cache("orcamento_config", company_id)
         
         return {"message": "Configuração criada com sucesso!"}
 
@@ -4076,6 +5320,8 @@ async def reopen_markup_month(profile_id: str):
             {"$set": {
                 "is_closed": False,
                 "closed_at": None,
+                # Marca a reabertura manual: o fechamento automático não fecha de novo
+                "reopened_at": datetime.now(timezone.utc).isoformat(),
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }}
         )
@@ -4245,6 +5491,7 @@ async def create_or_update_markup_profile(data: MarkupProfileCreate):
                 {"id": existing["id"]},
                 {"$set": profile_data}
             )
+            invalidate_read_cache("markup_iss", data.company_id)
             return {
                 "message": "Perfil de markup atualizado com sucesso!",
                 "markup_multiplier": markup_multiplier,
@@ -4278,6 +5525,7 @@ async def create_or_update_markup_profile(data: MarkupProfileCreate):
             doc['updated_at'] = doc['updated_at'].isoformat()
             
             await db.markup_profiles.insert_one(doc)
+            invalidate_read_cache("markup_iss", data.company_id)
             
             return {
                 "message": "Perfil de markup criado com sucesso!",
@@ -4608,75 +5856,111 @@ async def delete_internal_material(material_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ========== GATEWAY DE IA (LLM) ==========
+# Cache, coalescência, limite por empresa e backends ficam em llm_gateway.py.
+
+def sse_event(event: str, data) -> str:
+    """Formatar um evento server-sent events"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+
+def llm_sse_response(metrics: dict, llm_request: dict) -> StreamingResponse:
+    """Resposta SSE: bloco de métricas primeiro, depois os tokens do modelo"""
+    async def eventos():
+        yield sse_event("metrics", metrics)
+        try:
+            async for chunk in llm_stream(**llm_request):
+                yield sse_event("token", {"text": chunk})
+            yield sse_event("done", {})
+        except Exception as e:
+            logger.error(f"Erro no streaming de IA ({llm_request['session_id']}): {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+    
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@api_router.get("/admin/llm")
+async def admin_llm_stats(user_id: str):
+    """Estatísticas do gateway de IA"""
+    await verify_admin(user_id)
+    return llm_gateway_status()
+
+
+async def _preparar_ai_analysis(data: dict):
+    """Métricas do mês e pedido ao gateway de IA para a análise rápida"""
+    company_id = data['company_id']
+    month = data['month']
+    
+    # Totais pré-agregados (resumos mensais)
+    month_range(month)  # valida o formato do mês
+    totals = totals_by_type(await get_monthly_totals(company_id, month, exclude_cancelled=False))
+    faturamento = totals['receita']
+    custos = totals['custo']
+    despesas = totals['despesa']
+    
+    lucro = faturamento - custos - despesas
+    
+    # Prompt para ChatGPT
+    prompt = f"""
+    Analise os seguintes dados financeiros de uma empresa no mês {month}:
+    
+    - Faturamento Total: R$ {faturamento:,.2f}
+    - Custos Totais: R$ {custos:,.2f}
+    - Despesas Totais: R$ {despesas:,.2f}
+    - Lucro Líquido: R$ {lucro:,.2f}
+    
+    Por favor, forneça:
+    1. Pontos de atenção nos números apresentados
+    2. Oportunidades de economia
+    3. Sugestões para melhorar a gestão financeira
+    4. Insights sobre o negócio
+    
+    Seja objetivo e prático nas recomendações.
+    """
+    
+    metrics = {"faturamento": faturamento, "custos": custos, "despesas": despesas, "lucro": lucro}
+    # Gateway de IA (cache por empresa + mês + dados do prompt)
+    llm_request = {
+        "prompt": prompt,
+        "system_message": "Você é um especialista em análise financeira empresarial.",
+        "session_id": f"analysis-{company_id}-{month}",
+        "company_id": company_id,
+        "cache_key": llm_cache_key("ai_analysis", company_id, month, prompt)
+    }
+    return metrics, llm_request
+
+
 @api_router.post("/ai-analysis")
 async def ai_analysis(data: dict):
     try:
-        company_id = data['company_id']
-        month = data['month']
-        
-        # Usar aggregation para calcular métricas
-        pipeline = [
-            {"$match": {
-                "company_id": company_id,
-                "date": {"$regex": f"^{month}"},
-                "status": "realizado"
-            }},
-            {"$group": {
-                "_id": "$type",
-                "total": {"$sum": "$amount"}
-            }}
-        ]
-        
-        results = await db.transactions.aggregate(pipeline).to_list(None)
-        
-        faturamento = 0
-        custos = 0
-        despesas = 0
-        
-        for result in results:
-            if result['_id'] == 'receita':
-                faturamento = result['total']
-            elif result['_id'] == 'custo':
-                custos = result['total']
-            elif result['_id'] == 'despesa':
-                despesas = result['total']
-        
-        lucro = faturamento - custos - despesas
-        
-        # Prompt para ChatGPT
-        prompt = f"""
-        Analise os seguintes dados financeiros de uma empresa no mês {month}:
-        
-        - Faturamento Total: R$ {faturamento:,.2f}
-        - Custos Totais: R$ {custos:,.2f}
-        - Despesas Totais: R$ {despesas:,.2f}
-        - Lucro Líquido: R$ {lucro:,.2f}
-        
-        Por favor, forneça:
-        1. Pontos de atenção nos números apresentados
-        2. Oportunidades de economia
-        3. Sugestões para melhorar a gestão financeira
-        4. Insights sobre o negócio
-        
-        Seja objetivo e prático nas recomendações.
-        """
-        
-        # Usar Emergent LLM Chat
-        chat = LlmChat(
-            api_key=os.environ.get('OPENAI_API_KEY'),
-            session_id=f"analysis-{company_id}-{month}",
-            system_message="Você é um especialista em análise financeira empresarial."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        user_message = UserMessage(text=prompt)
-        analysis = await chat.send_message(user_message)
+        _, llm_request = await _preparar_ai_analysis(data)
+        analysis = await llm_complete(**llm_request)
         
         return {"analysis": analysis}
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro na análise IA: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro ao analisar: {str(e)}")
 
+
+@api_router.post("/ai-analysis/stream")
+async def ai_analysis_stream(data: dict):
+    """Análise IA via server-sent events (métricas primeiro, depois os tokens)"""
+    try:
+        metrics, llm_request = await _preparar_ai_analysis(data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erro na análise IA: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Erro ao analisar: {str(e)}")
+    return llm_sse_response(metrics, llm_request)
+
 # ========== EXPLICAÇÃO DE TERMOS FINANCEIROS ==========
 
 @api_router.post("/financial-term-explanation")
@@ -4714,15 +5998,13 @@ async def explain_financial_term(data: dict):
             Seja específico e prático, ajudando o empresário a entender como aplicar isso no seu negócio.
             """
         
-        # Usar Emergent LLM Chat
-        chat = LlmChat(
-            api_key=os.environ.get('OPENAI_API_KEY'),
+        # Gateway de IA (a explicação depende só do termo e do setor)
+        explanation = await llm_complete(
+            prompt,
+            system_message="Você é um consultor financeiro especializado em educação empresarial. Seu objetivo é explicar conceitos financeiros de forma clara e aplicada à realidade das empresas.",
             session_id=f"term-explanation-{term}",
-            system_message="Você é um consultor financeiro especializado em educação empresarial. Seu objetivo é explicar conceitos financeiros de forma clara e aplicada à realidade das empresas."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        user_message = UserMessage(text=prompt)
-        explanation = await chat.send_message(user_message)
+            cache_key=llm_cache_key("term", term.strip().lower(), (business_sector or "").strip().lower())
+        )
         
         return {"explanation": explanation, "term": term}
     
@@ -4739,32 +6021,12 @@ async def calculate_business_health_score(data: dict):
         company_id = data['company_id']
         month = data.get('month', datetime.now(timezone.utc).strftime('%Y-%m'))
         
-        # Usar aggregation para calcular métricas
-        pipeline = [
-            {"$match": {
-                "company_id": company_id,
-                "date": {"$regex": f"^{month}"},
-                "status": "realizado"
-            }},
-            {"$group": {
-                "_id": "$type",
-                "total": {"$sum": "$amount"}
-            }}
-        ]
-        
-        results = await db.transactions.aggregate(pipeline).to_list(None)
-        
-        faturamento = 0
-        custos = 0
-        despesas = 0
-        
-        for result in results:
-            if result['_id'] == 'receita':
-                faturamento = result['total']
-            elif result['_id'] == 'custo':
-                custos = result['total']
-            elif result['_id'] == 'despesa':
-                despesas = result['total']
+        # Totais pré-agregados (resumos mensais)
+        month_range(month)  # valida o formato do mês
+        totals = totals_by_type(await get_monthly_totals(company_id, month, exclude_cancelled=False))
+        faturamento = totals['receita']
+        custos = totals['custo']
+        despesas = totals['despesa']
         
         lucro = faturamento - custos - despesas
         
@@ -4826,14 +6088,13 @@ async def calculate_business_health_score(data: dict):
         Seja objetivo e prático.
         """
         
-        chat = LlmChat(
-            api_key=os.environ.get('OPENAI_API_KEY'),
+        analysis = await llm_complete(
+            prompt,
+            system_message="Você é um consultor financeiro especializado em análise de saúde empresarial.",
             session_id=f"health-score-{company_id}-{month}",
-            system_message="Você é um consultor financeiro especializado em análise de saúde empresarial."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        user_message = UserMessage(text=prompt)
-        analysis = await chat.send_message(user_message)
+            company_id=company_id,
+            cache_key=llm_cache_key("health_score", company_id, month, prompt)
+        )
         
         return {
             "score_analysis": analysis,
@@ -4847,6 +6108,8 @@ async def calculate_business_health_score(data: dict):
             }
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao calcular score: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
@@ -4857,47 +6120,17 @@ async def generate_intelligent_alerts(data: dict):
     try:
         company_id = data['company_id']
         month = data.get('month', datetime.now(timezone.utc).strftime('%Y-%m'))
+        month_range(month)  # valida o formato do mês
         
         # Calcular mês anterior
         date_obj = datetime.strptime(month, '%Y-%m')
         previous_month = (date_obj.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
         
-        # Buscar dados de ambos os meses em uma query com aggregation
-        pipeline = [
-            {"$match": {
-                "company_id": company_id,
-                "date": {"$regex": f"^({month}|{previous_month})"},
-                "status": "realizado"
-            }},
-            {"$project": {
-                "month": {"$substr": ["$date", 0, 7]},
-                "type": 1,
-                "amount": 1
-            }},
-            {"$group": {
-                "_id": {
-                    "month": "$month",
-                    "type": "$type"
-                },
-                "total": {"$sum": "$amount"}
-            }}
-        ]
-        
-        results = await db.transactions.aggregate(pipeline).to_list(None)
+        # Buscar dados de ambos os meses nos resumos mensais
+        results = await get_monthly_totals(company_id, previous_month, month, exclude_cancelled=False)
         
-        # Processar resultados da aggregation
-        current_metrics = {"receita": 0, "custo": 0, "despesa": 0}
-        previous_metrics = {"receita": 0, "custo": 0, "despesa": 0}
-        
-        for result in results:
-            month_type = result['_id']['month']
-            transaction_type = result['_id']['type']
-            total = result['total']
-            
-            if month_type == month:
-                current_metrics[transaction_type] = total
-            elif month_type == previous_month:
-                previous_metrics[transaction_type] = total
+        current_metrics = totals_by_type([r for r in results if r['month'] == month])
+        previous_metrics = totals_by_type([r for r in results if r['month'] == previous_month])
         
         # Métricas atuais
         faturamento_atual = current_metrics['receita']
@@ -4912,23 +6145,11 @@ async def generate_intelligent_alerts(data: dict):
         lucro_anterior = faturamento_anterior - custos_anterior - despesas_anterior
         
         # Buscar top 5 categorias de custos/despesas do mês atual
-        category_pipeline = [
-            {"$match": {
-                "company_id": company_id,
-                "date": {"$regex": f"^{month}"},
-                "status": "realizado",
-                "type": {"$in": ["custo", "despesa"]}
-            }},
-            {"$group": {
-                "_id": "$category",
-                "total": {"$sum": "$amount"}
-            }},
-            {"$sort": {"total": -1}},
-            {"$limit": 5}
-        ]
-        
-        top_expenses_result = await db.transactions.aggregate(category_pipeline).to_list(None)
-        top_expenses = [(r['_id'], r['total']) for r in top_expenses_result]
+        top_expenses_result = await get_monthly_totals(
+            company_id, month, exclude_cancelled=False, types=["custo", "despesa"], group_by=("category",)
+        )
+        top_expenses_result.sort(key=lambda r: r['total'], reverse=True)
+        top_expenses = [(r['category'], r['total']) for r in top_expenses_result[:5]]
         
         # Prompt para IA detectar alertas
         prompt = f"""
@@ -4980,188 +6201,270 @@ async def generate_intelligent_alerts(data: dict):
         Seja direto e prático.
         """
         
-        chat = LlmChat(
-            api_key=os.environ.get('OPENAI_API_KEY'),
+        alerts_analysis = await llm_complete(
+            prompt,
+            system_message="Você é um sistema de alerta financeiro inteligente.",
             session_id=f"alerts-{company_id}-{month}",
-            system_message="Você é um sistema de alerta financeiro inteligente."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        user_message = UserMessage(text=prompt)
-        alerts_analysis = await chat.send_message(user_message)
+            company_id=company_id,
+            cache_key=llm_cache_key("alerts", company_id, month, prompt)
+        )
         
         return {"alerts": alerts_analysis}
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao gerar alertas: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
 
+async def _preparar_analise_completa(data: dict):
+    """Métricas e pedido ao gateway de IA para a análise completa do negócio"""
+    company_id = data['company_id']
+    month = data.get('month', datetime.now(timezone.utc).strftime('%Y-%m'))
+    business_sector = data.get('business_sector', 'não informado')
+    
+    # Buscar todos os dados necessários (totais por categoria dos resumos mensais)
+    month_range(month)  # valida o formato do mês
+    category_totals = await get_monthly_totals(
+        company_id, month, exclude_cancelled=False, group_by=("type", "category")
+    )
+    
+    company = await get_company_cached(company_id)
+    
+    # Calcular métricas
+    totals = totals_by_type(category_totals)
+    faturamento = totals['receita']
+    custos = totals['custo']
+    despesas = totals['despesa']
+    lucro = faturamento - custos - despesas
+    
+    margem_liquida = (lucro / faturamento * 100) if faturamento > 0 else 0
+    margem_bruta = ((faturamento - custos) / faturamento * 100) if faturamento > 0 else 0
+    
+    # Análise por categoria
+    category_analysis = {}
+    for row in category_totals:
+        cat = row['category']
+        if cat not in category_analysis:
+            category_analysis[cat] = {'receita': 0, 'custo': 0, 'despesa': 0}
+        category_analysis[cat][row['type']] = category_analysis[cat].get(row['type'], 0) + row['total']
+    
+    # Buscar últimos 6 meses para tendência (query única otimizada)
+    months_list = []
+    for i in range(6):
+        m = (datetime.strptime(month, '%Y-%m').replace(day=1) - timedelta(days=30*i)).strftime('%Y-%m')
+        months_list.append(m)
+    
+    # Totais por mês dos resumos mensais
+    monthly_rows = await get_monthly_totals(
+        company_id, min(months_list), max(months_list), exclude_cancelled=False
+    )
+    months_agg = {}
+    for row in monthly_rows:
+        months_agg.setdefault(row['month'], {"_id": row['month'], "data": []})
+        months_agg[row['month']]["data"].append({"type": row['type'], "amount": row['total']})
+    months_agg = sorted(months_agg.values(), key=lambda m: m['_id'], reverse=True)
+    
+    # Processar resultados
+    all_months_data = []
+    for month_data in months_agg:
+        m = month_data['_id']
+        faturamento_mes = sum([d['amount'] for d in month_data['data'] if d['type'] == 'receita'])
+        custos_despesas = sum([d['amount'] for d in month_data['data'] if d['type'] in ['custo', 'despesa']])
+        all_months_data.append({"month": m, "faturamento": faturamento_mes, "lucro": faturamento_mes - custos_despesas})
+    
+    # Prompt completo para análise detalhada
+    prompt = f"""
+    Você é um CONSULTOR FINANCEIRO SÊNIOR analisando a empresa {company.get('name', 'Cliente')} do setor {business_sector}.
+    
+    Gere uma ANÁLISE FINANCEIRA COMPLETA E PROFUNDA baseada nos dados:
+    
+    📊 MÉTRICAS DO MÊS {month}:
+    - Faturamento: R$ {faturamento:,.2f}
+    - Custos: R$ {custos:,.2f}
+    - Despesas: R$ {despesas:,.2f}
+    - Lucro Líquido: R$ {lucro:,.2f}
+    - Margem Bruta: {margem_bruta:.1f}%
+    - Margem Líquida: {margem_liquida:.1f}%
+    
+    📈 TENDÊNCIA (6 MESES):
+    {chr(10).join([f"- {m['month']}: Fat R$ {m['faturamento']:,.2f} | Lucro R$ {m['lucro']:,.2f}" for m in all_months_data])}
+    
+    Sua análise DEVE incluir:
+    
+    ## 1. DIAGNÓSTICO GERAL
+    - Visão geral da saúde financeira
+    - Pontos fortes
+    - Pontos fracos
+    
+    ## 2. ANÁLISE DE MARGENS
+    - Interpretação das margens
+    - Comparação com setor {business_sector}
+    - Se está saudável ou perigoso
+    
+    ## 3. GARGALOS IDENTIFICADOS
+    - Principais problemas
+    - Impacto no lucro
+    - Risco para o negócio
+    
+    ## 4. TENDÊNCIAS
+    - Crescimento ou queda
+    - Sazonalidade detectada
+    - Padrões importantes
+    
+    ## 5. PREVISÃO (30/60/90 DIAS)
+    - Projeção de faturamento
+    - Projeção de lucro
+    - Probabilidade de atingir meta
+    
+    ## 6. RECOMENDAÇÕES ESTRATÉGICAS
+    - 5 ações prioritárias
+    - Ordem de importância
+    - Impacto esperado
+    
+    ## 7. OPORTUNIDADES
+    - Onde pode melhorar
+    - Como aumentar lucro
+    - Otimizações possíveis
+    
+    Seja PROFUNDO, ESPECÍFICO para o setor {business_sector} e PRÁTICO.
+    Use linguagem clara mas profissional.
+    """
+    
+    metrics = {
+        "faturamento": faturamento,
+        "custos": custos,
+        "despesas": despesas,
+        "lucro": lucro,
+        "margem_liquida": margem_liquida,
+        "margem_bruta": margem_bruta
+    }
+    llm_request = {
+        "prompt": prompt,
+        "system_message": "Você é um consultor financeiro sênior com 20 anos de experiência. Suas análises são profundas, práticas e adaptadas ao setor do cliente.",
+        "session_id": f"complete-analysis-{company_id}-{month}",
+        "company_id": company_id,
+        "cache_key": llm_cache_key("complete_analysis", company_id, month, prompt)
+    }
+    return metrics, llm_request
+
+
 @api_router.post("/complete-business-analysis")
 async def generate_complete_analysis(data: dict):
     """Gerar Análise Completa do Negócio com IA"""
     try:
-        company_id = data['company_id']
-        month = data.get('month', datetime.now(timezone.utc).strftime('%Y-%m'))
-        business_sector = data.get('business_sector', 'não informado')
-        
-        # Buscar todos os dados necessários
-        transactions = await db.transactions.find({
-            "company_id": company_id,
-            "date": {"$regex": f"^{month}"},
-            "status": "realizado"
-        }, {"_id": 0}).to_list(1000)
-        
-        company = await db.companies.find_one({"id": company_id}, {"_id": 0})
-        
-        # Calcular métricas
-        faturamento = sum([t['amount'] for t in transactions if t['type'] == 'receita'])
-        custos = sum([t['amount'] for t in transactions if t['type'] == 'custo'])
-        despesas = sum([t['amount'] for t in transactions if t['type'] == 'despesa'])
-        lucro = faturamento - custos - despesas
-        
-        margem_liquida = (lucro / faturamento * 100) if faturamento > 0 else 0
-        margem_bruta = ((faturamento - custos) / faturamento * 100) if faturamento > 0 else 0
-        
-        # Análise por categoria
-        category_analysis = {}
-        for t in transactions:
-            cat = t['category']
-            if cat not in category_analysis:
-                category_analysis[cat] = {'receita': 0, 'custo': 0, 'despesa': 0}
-            category_analysis[cat][t['type']] += t['amount']
-        
-        # Buscar últimos 6 meses para tendência (query única otimizada)
-        months_list = []
-        for i in range(6):
-            m = (datetime.strptime(month, '%Y-%m').replace(day=1) - timedelta(days=30*i)).strftime('%Y-%m')
-            months_list.append(m)
-        
-        # Usar aggregation para calcular métricas de todos os meses em uma query
-        pipeline = [
-            {"$match": {
-                "company_id": company_id,
-                "status": "realizado",
-                "date": {"$regex": f"^({'|'.join(months_list)})"}
-            }},
-            {"$project": {
-                "month": {"$substr": ["$date", 0, 7]},
-                "type": 1,
-                "amount": 1
-            }},
-            {"$group": {
-                "_id": {
-                    "month": "$month",
-                    "type": "$type"
-                },
-                "total": {"$sum": "$amount"}
-            }},
-            {"$group": {
-                "_id": "$_id.month",
-                "data": {
-                    "$push": {
-                        "type": "$_id.type",
-                        "amount": "$total"
-                    }
-                }
-            }},
-            {"$sort": {"_id": -1}}
-        ]
-        
-        months_agg = await db.transactions.aggregate(pipeline).to_list(None)
-        
-        # Processar resultados
-        all_months_data = []
-        for month_data in months_agg:
-            m = month_data['_id']
-            faturamento = sum([d['amount'] for d in month_data['data'] if d['type'] == 'receita'])
-            custos_despesas = sum([d['amount'] for d in month_data['data'] if d['type'] in ['custo', 'despesa']])
-            lucro = faturamento - custos_despesas
-            all_months_data.append({"month": m, "faturamento": faturamento, "lucro": lucro})
-        
-        # Prompt completo para análise detalhada
-        prompt = f"""
-        Você é um CONSULTOR FINANCEIRO SÊNIOR analisando a empresa {company.get('name', 'Cliente')} do setor {business_sector}.
-        
-        Gere uma ANÁLISE FINANCEIRA COMPLETA E PROFUNDA baseada nos dados:
-        
-        📊 MÉTRICAS DO MÊS {month}:
-        - Faturamento: R$ {faturamento:,.2f}
-        - Custos: R$ {custos:,.2f}
-        - Despesas: R$ {despesas:,.2f}
-        - Lucro Líquido: R$ {lucro:,.2f}
-        - Margem Bruta: {margem_bruta:.1f}%
-        - Margem Líquida: {margem_liquida:.1f}%
-        
-        📈 TENDÊNCIA (6 MESES):
-        {chr(10).join([f"- {m['month']}: Fat R$ {m['faturamento']:,.2f} | Lucro R$ {m['lucro']:,.2f}" for m in all_months_data])}
-        
-        Sua análise DEVE incluir:
-        
-        ## 1. DIAGNÓSTICO GERAL
-        - Visão geral da saúde financeira
-        - Pontos fortes
-        - Pontos fracos
-        
-        ## 2. ANÁLISE DE MARGENS
-        - Interpretação das margens
-        - Comparação com setor {business_sector}
-        - Se está saudável ou perigoso
-        
-        ## 3. GARGALOS IDENTIFICADOS
-        - Principais problemas
-        - Impacto no lucro
-        - Risco para o negócio
-        
-        ## 4. TENDÊNCIAS
-        - Crescimento ou queda
-        - Sazonalidade detectada
-        - Padrões importantes
-        
-        ## 5. PREVISÃO (30/60/90 DIAS)
-        - Projeção de faturamento
-        - Projeção de lucro
-        - Probabilidade de atingir meta
-        
-        ## 6. RECOMENDAÇÕES ESTRATÉGICAS
-        - 5 ações prioritárias
-        - Ordem de importância
-        - Impacto esperado
-        
-        ## 7. OPORTUNIDADES
-        - Onde pode melhorar
-        - Como aumentar lucro
-        - Otimizações possíveis
-        
-        Seja PROFUNDO, ESPECÍFICO para o setor {business_sector} e PRÁTICO.
-        Use linguagem clara mas profissional.
-        """
-        
-        chat = LlmChat(
-            api_key=os.environ.get('OPENAI_API_KEY'),
-            session_id=f"complete-analysis-{company_id}-{month}",
-            system_message="Você é um consultor financeiro sênior com 20 anos de experiência. Suas análises são profundas, práticas e adaptadas ao setor do cliente."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        user_message = UserMessage(text=prompt)
-        complete_analysis = await chat.send_message(user_message)
+        metrics, llm_request = await _preparar_analise_completa(data)
+        complete_analysis = await llm_complete(**llm_request)
         
         return {
             "analysis": complete_analysis,
-            "metrics": {
-                "faturamento": faturamento,
-                "custos": custos,
-                "despesas": despesas,
-                "lucro": lucro,
-                "margem_liquida": margem_liquida,
-                "margem_bruta": margem_bruta
-            }
+            "metrics": metrics
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro na análise completa: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
 
+
+@api_router.post("/complete-business-analysis/stream")
+async def generate_complete_analysis_stream(data: dict):
+    """Análise Completa via server-sent events (métricas primeiro, depois os tokens)"""
+    try:
+        metrics, llm_request = await _preparar_analise_completa(data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erro na análise completa: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
+    return llm_sse_response(metrics, llm_request)
+
 # ========== ASSINATURA E PAGAMENTO ==========
 
+# ===== CLIENTE ASSÍNCRONO DO MERCADO PAGO =====
+# Substitui o SDK síncrono (que bloqueava o event loop durante a chamada HTTP).
+# Usa um httpx.AsyncClient compartilhado (pool de conexões) com timeout e
+# retentativas com backoff para erros de rede, 429 e 5xx. As respostas têm o
+# mesmo formato do SDK: {"status": <http status>, "response": <json>}.
+# MERCADO_PAGO_API_URL permite apontar para o stub local (mercadopago_stub.py).
+
+MERCADO_PAGO_API_URL = os.environ.get("MERCADO_PAGO_API_URL", "https://api.mercadopago.com")
+MERCADO_PAGO_TIMEOUT = float(os.environ.get("MERCADO_PAGO_TIMEOUT", "10"))
+MERCADO_PAGO_MAX_RETRIES = int(os.environ.get("MERCADO_PAGO_MAX_RETRIES", "3"))
+MERCADO_PAGO_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class MercadoPagoError(Exception):
+    """Falha ao falar com o Mercado Pago (rede, timeout ou resposta de erro)"""
+
+
+class MercadoPagoClient:
+    """Cliente assíncrono mínimo da API de pagamentos do Mercado Pago"""
+    
+    def __init__(self, access_token: Optional[str], base_url: str, timeout: float, max_retries: int):
+        self.access_token = access_token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._http: Optional[httpx.AsyncClient] = None
+    
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                headers={"Authorization": f"Bearer {self.access_token}"}
+            )
+        return self._http
+    
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(min(0.5 * 2 ** (attempt - 1), 4.0))
+            try:
+                response = await self._client().request(method, path, **kwargs)
+            except httpx.TransportError as e:  # conexão, timeout
+                last_error = e
+                logger.warning(f"Mercado Pago {method} {path}: {e!r} (tentativa {attempt + 1})")
+                continue
+            
+            if response.status_code in MERCADO_PAGO_RETRY_STATUS and attempt < self.max_retries:
+                last_error = MercadoPagoError(f"HTTP {response.status_code}")
+                logger.warning(f"Mercado Pago {method} {path}: HTTP {response.status_code} (tentativa {attempt + 1})")
+                continue
+            
+            try:
+                body = response.json()
+            except ValueError:
+                body = {"message": response.text}
+            return {"status": response.status_code, "response": body}
+        
+        raise MercadoPagoError(f"Mercado Pago indisponível: {last_error}")
+    
+    async def create_payment(self, payment_data: dict, idempotency_key: Optional[str] = None) -> dict:
+        # A chave de idempotência torna seguro repetir o POST nas retentativas
+        headers = {"X-Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        return await self._request("POST", "/v1/payments", json=payment_data, headers=headers)
+    
+    async def get_payment(self, payment_id) -> dict:
+        return await self._request("GET", f"/v1/payments/{payment_id}")
+    
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+
+
+mercado_pago = MercadoPagoClient(
+    os.environ.get("MERCADO_PAGO_ACCESS_TOKEN"),
+    MERCADO_PAGO_API_URL,
+    MERCADO_PAGO_TIMEOUT,
+    MERCADO_PAGO_MAX_RETRIES
+)
+
+
 # Função helper para verificar e atualizar status de trial expirado
 async def check_and_update_trial_status(user_id: str):
     """Verifica se o trial expirou e atualiza o status automaticamente"""
@@ -5244,8 +6547,10 @@ async def create_payment(data: dict):
             }
         }
         
-        payment_response = sdk.payment().create(payment_data)
+        payment_response = await mercado_pago.create_payment(payment_data)
         payment = payment_response["response"]
+        if payment_response["status"] >= 400:
+            raise MercadoPagoError(payment.get("message") or f"HTTP {payment_response['status']}")
         
         # Extrair QR Code
         qr_code = payment.get('point_of_interaction', {}).get('transaction_data', {}).get('qr_code', '')
@@ -5270,7 +6575,7 @@ async def webhook(data: dict):
             payment_id = data['data']['id']
             
             # Buscar informações do pagamento
-            payment_info = sdk.payment().get(payment_id)
+            payment_info = await mercado_pago.get_payment(payment_id)
             payment = payment_info['response']
             
             if payment['status'] == 'approved':
@@ -5286,6 +6591,50 @@ async def webhook(data: dict):
 
 # ========== CONTAS A PAGAR E RECEBER ==========
 
+# Status de contas ainda não quitadas
+CONTAS_STATUS_EM_ABERTO = ["PENDENTE", "ATRASADO", "PARCIAL"]
+
+# Dia (YYYY-MM-DD) da última varredura de atrasadas feita por este processo
+_contas_atrasadas_varridas_em: Optional[str] = None
+
+
+async def varrer_contas_atrasadas(force: bool = False) -> int:
+    """
+    Marcar como ATRASADO, em um único update_many, as contas PENDENTE vencidas.
+    Roda uma vez por dia (agendador ou primeira leitura do dia). Contas
+    inseridas já vencidas depois da varredura continuam PENDENTE até a do dia
+    seguinte, por isso filtro_contas_atrasadas também as considera.
+    """
+    global _contas_atrasadas_varridas_em
+    hoje = datetime.now().strftime("%Y-%m-%d")
+    if not force and _contas_atrasadas_varridas_em == hoje:
+        return 0
+    
+    result = await db.contas.update_many(
+        {"status": "PENDENTE", "data_vencimento": {"$lt": hoje}},
+        {"$set": {"status": "ATRASADO", "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    _contas_atrasadas_varridas_em = hoje
+    if result.modified_count:
+        logger.info(f"⏰ {result.modified_count} conta(s) marcada(s) como ATRASADO")
+    return result.modified_count
+
+
+async def filtro_contas_atrasadas(hoje_str: str, incluir_parciais: bool = False) -> dict:
+    """
+    Filtro de contas vencidas e não quitadas (garante a varredura do dia antes).
+    Inclui PENDENTE vencida: contas geradas depois da varredura (recorrentes,
+    comissões, parcelas do aceite) só viram ATRASADO na varredura seguinte.
+    Continua servido pelo índice (company_id, status, data_vencimento).
+    """
+    await varrer_contas_atrasadas()
+    status = CONTAS_STATUS_EM_ABERTO if incluir_parciais else ["PENDENTE", "ATRASADO"]
+    return {
+        "status": {"$in": status},
+        "data_vencimento": {"$lt": hoje_str}
+    }
+
+
 async def create_lancamento_from_conta(conta: dict, tipo_lancamento: str):
     """Criar lançamento financeiro automaticamente quando conta é paga/recebida"""
     # Determinar mês de competência a partir da data
@@ -5347,16 +6696,23 @@ async def create_lancamento_from_conta(conta: dict, tipo_lancamento: str):
     doc = transaction.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.transactions.insert_one(doc)
+    await apply_transaction_to_summary(doc)
     
     return transaction.id
 
 async def cancel_lancamento_from_conta(conta_id: str):
     """Marcar lançamento como cancelado quando conta volta para PENDENTE"""
-    result = await db.transactions.update_one(
-        {"conta_id": conta_id},
-        {"$set": {"cancelled": True}}
+    old_doc = await db.transactions.find_one_and_update(
+        {"conta_id": conta_id, "cancelled": {"$ne": True}},
+        {"$set": {"cancelled": True}},
+        projection={"_id": 0}
     )
-    return result.modified_count > 0
+    if not old_doc:
+        return False
+    
+    await apply_transaction_to_summary(old_doc, -1)
+    await apply_transaction_to_summary({**old_doc, "cancelled": True})
+    return True
 
 @api_router.get("/contas/categorias")
 async def get_categorias_contas():
@@ -5427,7 +6783,7 @@ async def get_contas_pagar(
     if status:
         query["status"] = status
     if mes:
-        query["data_vencimento"] = {"$regex": f"^{mes}"}
+        query["data_vencimento"] = month_range(mes)
     if categoria:
         query["categoria"] = categoria
     
@@ -5462,6 +6818,10 @@ async def update_conta_pagar(conta_id: str, conta_data: ContaCreate):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Conta não encontrada")
     
+    # Vencimento no passado: já fica ATRASADO (mesma regra da criação)
+    if update_doc['data_vencimento'] < dt.now().strftime("%Y-%m-%d"):
+        await db.contas.update_one({"id": conta_id, "status": "PENDENTE"}, {"$set": {"status": "ATRASADO"}})
+    
     return {"message": "Conta atualizada com sucesso!"}
 
 @api_router.delete("/contas/pagar/{conta_id}")
@@ -5520,6 +6880,10 @@ async def update_status_conta_pagar(conta_id: str, status_data: ContaStatusUpdat
         update_fields['data_pagamento'] = None
         update_fields['lancamento_id'] = None
     
+    # PENDENTE com vencimento no passado fica ATRASADO (mesma regra da criação)
+    if update_fields['status'] == "PENDENTE" and conta.get('data_vencimento', '') < dt.now().strftime("%Y-%m-%d"):
+        update_fields['status'] = "ATRASADO"
+    
     await db.contas.update_one({"id": conta_id}, {"$set": update_fields})
     
     return {"message": "Status atualizado com sucesso!"}
@@ -5560,7 +6924,7 @@ async def get_contas_receber(
     if status:
         query["status"] = status
     if mes:
-        query["data_vencimento"] = {"$regex": f"^{mes}"}
+        query["data_vencimento"] = month_range(mes)
     if categoria:
         query["categoria"] = categoria
     
@@ -5595,6 +6959,10 @@ async def update_conta_receber(conta_id: str, conta_data: ContaCreate):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Conta não encontrada")
     
+    # Vencimento no passado: já fica ATRASADO (mesma regra da criação)
+    if update_doc['data_vencimento'] < dt.now().strftime("%Y-%m-%d"):
+        await db.contas.update_one({"id": conta_id, "status": "PENDENTE"}, {"$set": {"status": "ATRASADO"}})
+    
     return {"message": "Conta atualizada com sucesso!"}
 
 @api_router.delete("/contas/receber/{conta_id}")
@@ -5754,6 +7122,10 @@ async def update_status_conta_receber(conta_id: str, status_data: ContaStatusUpd
         update_fields['data_pagamento'] = None
         update_fields['lancamento_id'] = None
     
+    # PENDENTE com vencimento no passado fica ATRASADO (mesma regra da criação)
+    if update_fields['status'] == "PENDENTE" and conta.get('data_vencimento', '') < dt.now().strftime("%Y-%m-%d"):
+        update_fields['status'] = "ATRASADO"
+    
     await db.contas.update_one({"id": conta_id}, {"$set": update_fields})
     
     return {"message": "Status atualizado com sucesso!"}
@@ -5768,26 +7140,26 @@ async def get_resumo_contas(company_id: str):
     hoje = datetime.now().strftime("%Y-%m-%d")
     proximos_7d = (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d")
     
+    filtro_atrasadas = await filtro_contas_atrasadas(hoje, incluir_parciais=True)
+    
     # Contas a pagar atrasadas
     atrasados_pagar = await db.contas.count_documents({
         "company_id": company_id,
         "tipo": "PAGAR",
-        "status": {"$nin": ["PAGO", "CANCELADO"]},
-        "data_vencimento": {"$lt": hoje}
+        **filtro_atrasadas
     })
     
     # Contas a receber atrasadas
     atrasados_receber = await db.contas.count_documents({
         "company_id": company_id,
         "tipo": "RECEBER",
-        "status": {"$nin": ["RECEBIDO", "PAGO", "CANCELADO"]},
-        "data_vencimento": {"$lt": hoje}
+        **filtro_atrasadas
     })
     
     # Contas vencendo nos próximos 7 dias
     vencendo_7d = await db.contas.count_documents({
         "company_id": company_id,
-        "status": {"$nin": ["PAGO", "RECEBIDO", "CANCELADO"]},
+        "status": {"$in": CONTAS_STATUS_EM_ABERTO},
         "data_vencimento": {"$gte": hoje, "$lte": proximos_7d}
     })
     
@@ -5806,7 +7178,7 @@ async def get_resumo_mensal(company_id: str, mes: str):
         {"$match": {
             "company_id": company_id,
             "tipo": "PAGAR",
-            "data_vencimento": {"$regex": f"^{mes}"}
+            "data_vencimento": month_range(mes)
         }},
         {"$group": {
             "_id": "$status",
@@ -5820,7 +7192,7 @@ async def get_resumo_mensal(company_id: str, mes: str):
         {"$match": {
             "company_id": company_id,
             "tipo": "RECEBER",
-            "data_vencimento": {"$regex": f"^{mes}"}
+            "data_vencimento": month_range(mes)
         }},
         {"$group": {
             "_id": "$status",
@@ -5922,7 +7294,7 @@ async def get_fluxo_caixa_projetado(company_id: str, meses: int = 6):
             {"$match": {
                 "company_id": company_id,
                 "tipo": "RECEBER",
-                "data_vencimento": {"$regex": f"^{mes_str}"}
+                "data_vencimento": month_range(mes_str)
             }},
             {"$group": {
                 "_id": None,
@@ -5935,7 +7307,7 @@ async def get_fluxo_caixa_projetado(company_id: str, meses: int = 6):
             {"$match": {
                 "company_id": company_id,
                 "tipo": "PAGAR",
-                "data_vencimento": {"$regex": f"^{mes_str}"}
+                "data_vencimento": month_range(mes_str)
             }},
             {"$group": {
                 "_id": None,
@@ -5988,7 +7360,7 @@ async def get_fluxo_caixa_dashboard(
     
     # ========== BUSCAR SALDO ATUAL (CONFIGURAÇÃO DA EMPRESA) ==========
     # O saldo atual vem da configuração da empresa ou é calculado
-    company = await db.companies.find_one({"id": company_id}, {"_id": 0, "saldo_inicial": 1})
+    company = await get_company_cached(company_id)
     saldo_inicial = company.get("saldo_inicial", 0) if company else 0
     
     # Calcular saldo atual baseado em lançamentos realizados até hoje
@@ -6038,134 +7410,109 @@ async def get_fluxo_caixa_dashboard(
                 return True
         return False
     
-    # Buscar contas a RECEBER
-    contas_receber = await db.contas.find({
-        "company_id": company_id,
-        "tipo": "RECEBER",
-        "$or": [
-            {"data_vencimento": {"$gte": hoje_str, "$lte": data_fim_str}},
-            {"status": "ATRASADO"},
-            {"$and": [
-                {"data_vencimento": {"$lt": hoje_str}},
-                {"status": {"$in": ["PENDENTE", "PARCIAL"]}}
-            ]}
-        ]
-    }, {"_id": 0}).to_list(1000)
-    
-    # Buscar contas a PAGAR
-    contas_pagar = await db.contas.find({
-        "company_id": company_id,
-        "tipo": "PAGAR",
-        "$or": [
-            {"data_vencimento": {"$gte": hoje_str, "$lte": data_fim_str}},
-            {"status": "ATRASADO"},
-            {"$and": [
-                {"data_vencimento": {"$lt": hoje_str}},
-                {"status": {"$in": ["PENDENTE", "PARCIAL"]}}
-            ]}
-        ]
-    }, {"_id": 0}).to_list(1000)
-    
-    # ========== CALCULAR CARDS ==========
+    # ========== PERCORRER CONTAS E LANÇAMENTOS (FOLD SOBRE O CURSOR) ==========
     hoje_plus_7 = (hoje + timedelta(days=7)).strftime("%Y-%m-%d")
     hoje_plus_30 = (hoje + timedelta(days=30)).strftime("%Y-%m-%d")
     
-    a_receber_7d = 0
-    a_receber_30d = 0
-    a_pagar_7d = 0
-    a_pagar_30d = 0
-    atrasados_receber = 0
-    atrasados_pagar = 0
+    # Cards e ações por tipo de conta (apenas títulos em aberto)
+    cards = {
+        tipo: {"7d": 0, "30d": 0, "atrasados": 0}
+        for tipo in ("RECEBER", "PAGAR")
+    }
+    acoes = {
+        tipo: {"proximos": [], "atrasados": []}
+        for tipo in ("RECEBER", "PAGAR")
+    }
     
-    for c in contas_receber:
-        if c.get("status") in ["PAGO", "RECEBIDO"]:
-            continue
-        valor = c.get("valor", 0)
-        data_venc = c.get("data_vencimento", "")
-        
-        if data_venc < hoje_str:
-            atrasados_receber += valor
-        elif data_venc <= hoje_plus_7:
-            a_receber_7d += valor
-            a_receber_30d += valor
-        elif data_venc <= hoje_plus_30:
-            a_receber_30d += valor
-    
-    for c in contas_pagar:
-        if c.get("status") in ["PAGO", "RECEBIDO"]:
-            continue
-        valor = c.get("valor", 0)
-        data_venc = c.get("data_vencimento", "")
-        
-        if data_venc < hoje_str:
-            atrasados_pagar += valor
-        elif data_venc <= hoje_plus_7:
-            a_pagar_7d += valor
-            a_pagar_30d += valor
-        elif data_venc <= hoje_plus_30:
-            a_pagar_30d += valor
-    
-    # ========== GERAR SÉRIE DIÁRIA DO SALDO ==========
     # Agrupar por dia - CONTAS A PAGAR/RECEBER
     entradas_por_dia = {}
     saidas_por_dia = {}
     
     # ===== INCLUIR LANÇAMENTOS (TRANSACTIONS) NO GRÁFICO =====
-    # Buscar lançamentos realizados no período
-    lancamentos = await db.transactions.find({
-        "company_id": company_id,
-        "status": "realizado",
-        "cancelled": {"$ne": True},
-        "date": {"$gte": hoje_str, "$lte": data_fim_str}
-    }, {"_id": 0, "type": 1, "amount": 1, "date": 1}).to_list(2000)
+    # Lançamentos realizados no período, somados por dia no banco
+    pipeline_lancamentos = [
+        {"$match": {
+            "company_id": company_id,
+            "status": "realizado",
+            "cancelled": {"$ne": True},
+            "date": {"$gte": hoje_str, "$lte": data_fim_str}
+        }},
+        {"$group": {
+            "_id": {"dia": {"$substrCP": ["$date", 0, 10]}, "type": "$type"},
+            "total": {"$sum": "$amount"}
+        }}
+    ]
     
-    # Adicionar lançamentos ao gráfico
-    for lanc in lancamentos:
-        data_ref = lanc.get("date", "")[:10]
-        valor = lanc.get("amount", 0)
-        tipo = lanc.get("type", "")
+    async for r in db.transactions.aggregate(pipeline_lancamentos):
+        data_ref = r["_id"]["dia"]
+        tipo = r["_id"].get("type", "")
         
         if tipo == "receita":
-            entradas_por_dia[data_ref] = entradas_por_dia.get(data_ref, 0) + valor
+            entradas_por_dia[data_ref] = entradas_por_dia.get(data_ref, 0) + r["total"]
         elif tipo in ["despesa", "custo"]:
-            saidas_por_dia[data_ref] = saidas_por_dia.get(data_ref, 0) + valor
-    
-    # ===== PROCESSAR CONTAS A RECEBER =====
-    for c in contas_receber:
-        if modo == "realizado" and c.get("status") not in ["PAGO", "RECEBIDO"]:
-            continue
-        if modo == "em_aberto" and c.get("status") in ["PAGO", "RECEBIDO"]:
-            continue
+            saidas_por_dia[data_ref] = saidas_por_dia.get(data_ref, 0) + r["total"]
+    
+    # ===== PROCESSAR CONTAS A RECEBER E A PAGAR =====
+    # Ordenadas por vencimento: as listas de ações guardam só os 5 primeiros.
+    # Vencidas em aberto: ATRASADO (varredura diária) ou PENDENTE ainda não varrida.
+    filtro_atrasadas = await filtro_contas_atrasadas(hoje_str, incluir_parciais=True)
+    for tipo_conta, por_dia in (("RECEBER", entradas_por_dia), ("PAGAR", saidas_por_dia)):
+        cursor = db.contas.find({
+            "company_id": company_id,
+            "tipo": tipo_conta,
+            "$or": [
+                {"data_vencimento": {"$gte": hoje_str, "$lte": data_fim_str}},
+                filtro_atrasadas
+            ]
+        }, {
+            "_id": 0, "id": 1, "tipo": 1, "descricao": 1, "categoria": 1, "valor": 1,
+            "status": 1, "data_vencimento": 1, "data_pagamento": 1
+        }).sort("data_vencimento", 1)
+        
+        async for c in cursor:
+            realizado = c.get("status") in ["PAGO", "RECEBIDO"]
+            valor = c.get("valor", 0)
+            data_venc = c.get("data_vencimento", "")
             
-        # Para projetado: usar data_pagamento se já realizado, senão data_vencimento
-        if c.get("status") in ["PAGO", "RECEBIDO"] and c.get("data_pagamento"):
-            data_ref = c.get("data_pagamento", c.get("data_vencimento", ""))[:10]
-        else:
-            data_ref = c.get("data_vencimento", "")[:10]
-        
-        # Para atrasados não pagos, considerar como "hoje" no modo projetado
-        if modo == "projetado" and data_ref < hoje_str and c.get("status") not in ["PAGO", "RECEBIDO"]:
-            data_ref = hoje_str
-        
-        if data_ref:
-            entradas_por_dia[data_ref] = entradas_por_dia.get(data_ref, 0) + c.get("valor", 0)
-    
-    for c in contas_pagar:
-        if modo == "realizado" and c.get("status") not in ["PAGO", "RECEBIDO"]:
-            continue
-        if modo == "em_aberto" and c.get("status") in ["PAGO", "RECEBIDO"]:
-            continue
+            # ===== CARDS E AÇÕES =====
+            if not realizado:
+                if data_venc < hoje_str:
+                    cards[tipo_conta]["atrasados"] += valor
+                    if len(acoes[tipo_conta]["atrasados"]) < 5:
+                        acoes[tipo_conta]["atrasados"].append(c)
+                elif data_venc <= hoje_plus_7:
+                    cards[tipo_conta]["7d"] += valor
+                    cards[tipo_conta]["30d"] += valor
+                    if len(acoes[tipo_conta]["proximos"]) < 5:
+                        acoes[tipo_conta]["proximos"].append(c)
+                elif data_venc <= hoje_plus_30:
+                    cards[tipo_conta]["30d"] += valor
             
-        if c.get("status") in ["PAGO", "RECEBIDO"] and c.get("data_pagamento"):
-            data_ref = c.get("data_pagamento", c.get("data_vencimento", ""))[:10]
-        else:
-            data_ref = c.get("data_vencimento", "")[:10]
-        
-        if modo == "projetado" and data_ref < hoje_str and c.get("status") not in ["PAGO", "RECEBIDO"]:
-            data_ref = hoje_str
-        
-        if data_ref:
-            saidas_por_dia[data_ref] = saidas_por_dia.get(data_ref, 0) + c.get("valor", 0)
+            # ===== SÉRIE DIÁRIA =====
+            if modo == "realizado" and not realizado:
+                continue
+            if modo == "em_aberto" and realizado:
+                continue
+            
+            # Para projetado: usar data_pagamento se já realizado, senão data_vencimento
+            if realizado and c.get("data_pagamento"):
+                data_ref = c.get("data_pagamento", c.get("data_vencimento", ""))[:10]
+            else:
+                data_ref = c.get("data_vencimento", "")[:10]
+            
+            # Para atrasados não pagos, considerar como "hoje" no modo projetado
+            if modo == "projetado" and data_ref < hoje_str and not realizado:
+                data_ref = hoje_str
+            
+            if data_ref:
+                por_dia[data_ref] = por_dia.get(data_ref, 0) + valor
+    
+    a_receber_7d = cards["RECEBER"]["7d"]
+    a_receber_30d = cards["RECEBER"]["30d"]
+    atrasados_receber = cards["RECEBER"]["atrasados"]
+    a_pagar_7d = cards["PAGAR"]["7d"]
+    a_pagar_30d = cards["PAGAR"]["30d"]
+    atrasados_pagar = cards["PAGAR"]["atrasados"]
     
     # Gerar série diária
     grafico_saldo = []
@@ -6214,28 +7561,11 @@ async def get_fluxo_caixa_dashboard(
     saldo_projetado_final = grafico_saldo[-1]["saldo"] if grafico_saldo else saldo_atual
     
     # ========== LISTA DE AÇÕES ==========
-    # Top 5 a pagar próximos 7 dias
-    proximos_pagar = sorted(
-        [c for c in contas_pagar if c.get("status") not in ["PAGO", "RECEBIDO"] and c.get("data_vencimento", "") >= hoje_str and c.get("data_vencimento", "") <= hoje_plus_7],
-        key=lambda x: x.get("data_vencimento", "")
-    )[:5]
-    
-    # Top 5 a receber próximos 7 dias
-    proximos_receber = sorted(
-        [c for c in contas_receber if c.get("status") not in ["PAGO", "RECEBIDO"] and c.get("data_vencimento", "") >= hoje_str and c.get("data_vencimento", "") <= hoje_plus_7],
-        key=lambda x: x.get("data_vencimento", "")
-    )[:5]
-    
-    # Atrasados (a pagar e receber)
-    lista_atrasados_pagar = sorted(
-        [c for c in contas_pagar if c.get("status") not in ["PAGO", "RECEBIDO"] and c.get("data_vencimento", "") < hoje_str],
-        key=lambda x: x.get("data_vencimento", "")
-    )[:5]
-    
-    lista_atrasados_receber = sorted(
-        [c for c in contas_receber if c.get("status") not in ["PAGO", "RECEBIDO"] and c.get("data_vencimento", "") < hoje_str],
-        key=lambda x: x.get("data_vencimento", "")
-    )[:5]
+    # Top 5 a pagar/receber nos próximos 7 dias e atrasados (já ordenados pelo cursor)
+    proximos_pagar = acoes["PAGAR"]["proximos"]
+    proximos_receber = acoes["RECEBER"]["proximos"]
+    lista_atrasados_pagar = acoes["PAGAR"]["atrasados"]
+    lista_atrasados_receber = acoes["RECEBER"]["atrasados"]
     
     # Formatar para o frontend
     def formatar_conta(c):
@@ -6291,6 +7621,7 @@ async def update_saldo_inicial(company_id: str, saldo_data: dict):
         {"id": company_id},
         {"$set": {"saldo_inicial": saldo_inicial}}
     )
+    invalidate_read_cache("companies", company_id)
     
     if result.modified_count == 0:
         # Pode ser que não mudou ou empresa não existe
@@ -6445,7 +7776,7 @@ async def get_dfc_relatorio(
     
     # ========== CALCULAR SALDO INICIAL ==========
     # Saldo inicial = saldo_inicial da empresa + movimentações até o dia anterior ao período
-    company = await db.companies.find_one({"id": company_id}, {"_id": 0, "saldo_inicial": 1})
+    company = await get_company_cached(company_id)
     saldo_base = company.get("saldo_inicial", 0) if company else 0
     
     # Movimentações realizadas ANTES do período
@@ -6477,12 +7808,16 @@ async def get_dfc_relatorio(
     saldo_inicial = saldo_base + receitas_antes - despesas_antes
     
     # ========== BUSCAR LANÇAMENTOS DO PERÍODO ==========
-    lancamentos = await db.transactions.find({
+    # Percorridos pelo cursor: os totais consideram todos os lançamentos
+    lancamentos = db.transactions.find({
         "company_id": company_id,
         "status": "realizado",
         "cancelled": {"$ne": True},
         "date": {"$gte": periodo_inicio, "$lte": periodo_fim}
-    }, {"_id": 0}).to_list(5000)
+    }, {
+        "_id": 0, "id": 1, "date": 1, "amount": 1, "type": 1,
+        "description": 1, "category_name": 1, "category_group": 1
+    })
     
     # ========== CLASSIFICAR E AGRUPAR ==========
     # Estrutura para armazenar os fluxos
@@ -6498,7 +7833,7 @@ async def get_dfc_relatorio(
     
     lancamentos_nao_classificados = 0
     
-    for lanc in lancamentos:
+    async for lanc in lancamentos:
         valor = lanc.get("amount", 0)
         tipo = lanc.get("type", "")
         categoria_nome = lanc.get("category_name", "") or lanc.get("description", "Sem Categoria")
@@ -6528,12 +7863,14 @@ async def get_dfc_relatorio(
         
         fluxos[grupo_dfc]["detalhes"][categoria_nome]["valor"] += valor
         fluxos[grupo_dfc]["detalhes"][categoria_nome]["quantidade"] += 1
-        fluxos[grupo_dfc]["detalhes"][categoria_nome]["lancamentos"].append({
-            "id": lanc.get("id"),
-            "data": lanc.get("date"),
-            "descricao": lanc.get("description", ""),
-            "valor": valor
-        })
+        # Só os 10 primeiros lançamentos de cada categoria vão para o retorno
+        if len(fluxos[grupo_dfc]["detalhes"][categoria_nome]["lancamentos"]) < 10:
+            fluxos[grupo_dfc]["detalhes"][categoria_nome]["lancamentos"].append({
+                "id": lanc.get("id"),
+                "data": lanc.get("date"),
+                "descricao": lanc.get("description", ""),
+                "valor": valor
+            })
     
     # ========== CALCULAR TOTAIS POR ATIVIDADE ==========
     operacional_entradas = fluxos["OPERACIONAL_ENTRADA"]["total"]
@@ -6559,7 +7896,7 @@ async def get_dfc_relatorio(
                 "categoria": cat,
                 "valor": round(info["valor"], 2),
                 "quantidade": info["quantidade"],
-                "lancamentos": info["lancamentos"][:10]  # Limitar a 10 para não sobrecarregar
+                "lancamentos": info["lancamentos"]  # Limitado a 10 ao percorrer o cursor
             }
             for cat, info in detalhes.items()
         ], key=lambda x: -x["valor"])
@@ -6674,7 +8011,7 @@ async def get_contas_pagar_por_categoria(company_id: str, mes: Optional[str] = N
         {"$match": {
             "company_id": company_id,
             "tipo": "PAGAR",
-            "data_vencimento": {"$regex": f"^{mes}"}
+            "data_vencimento": month_range(mes)
         }},
         {"$group": {
             "_id": "$categoria",
@@ -6713,7 +8050,7 @@ async def get_contas_receber_por_cliente(company_id: str, mes: Optional[str] = N
         {"$match": {
             "company_id": company_id,
             "tipo": "RECEBER",
-            "data_vencimento": {"$regex": f"^{mes}"}
+            "data_vencimento": month_range(mes)
         }},
         {"$group": {
             "_id": "$categoria",
@@ -6793,16 +8130,8 @@ async def get_dre_dashboard(company_id: str, meses: int = 12):
     mes_atual = hoje.strftime("%Y-%m")
     
     # ========== CONFIGURAÇÃO DE IMPOSTOS DA EMPRESA ==========
-    # Buscar configuração de markup para pegar alíquota de ISS
-    markup_config = await db.markup_profiles.find_one(
-        {"company_id": company_id, "year": hoje.year, "month": hoje.month},
-        {"_id": 0, "taxes": 1}
-    )
-    
-    # Alíquota padrão de ISS se não houver configuração
-    aliquota_iss = 0.03  # 3%
-    if markup_config and markup_config.get("taxes"):
-        aliquota_iss = markup_config["taxes"].get("iss_rate", 0.03)
+    # Alíquota de ISS da configuração de markup do mês (padrão 3%)
+    aliquota_iss = await get_aliquota_iss(company_id, hoje.year, hoje.month)
     
     # ========== BUSCAR CATEGORIAS DA EMPRESA ==========
     categorias = await db.expense_categories.find(
@@ -6825,9 +8154,62 @@ async def get_dre_dashboard(company_id: str, meses: int = 12):
         else:  # DESPESA
             categoria_map[cat_id] = mapear_categoria_dre(cat_name, cat_group)
     
+    # ========== JANELA DE MESES ==========
+    # Série histórica + mês anterior (usado nas variações), em uma única agregação
+    mes_anterior = (hoje - relativedelta(months=1)).strftime("%Y-%m")
+    meses_janela = {mes_atual, mes_anterior}
+    for i in range(meses):
+        meses_janela.add((hoje - relativedelta(months=i)).strftime("%Y-%m"))
+    meses_janela = sorted(meses_janela)
+    
+    # ========== AGREGAÇÃO ÚNICA: MÊS × TIPO × CATEGORIA ==========
+    # Um lançamento entra no mês de competência e no mês da data (se diferentes,
+    # conta nos dois, como na consulta com $or por mês)
+    mes_da_data = {"$substrCP": [{"$ifNull": ["$date", ""]}, 0, 7]}
+    pipeline = [
+        {"$match": {
+            "company_id": company_id,
+            "type": {"$in": ["receita", "custo", "despesa"]},
+            "status": "realizado",
+            "cancelled": {"$ne": True},
+            "$or": [
+                {"competence_month": {"$in": meses_janela}},
+                {"date": month_range(meses_janela[0], meses_janela[-1])}
+            ]
+        }},
+        {"$project": {
+            "_id": 0,
+            "amount": 1,
+            "type": 1,
+            "category_id": 1,
+            "category_name": 1,
+            "category_group": 1,
+            "meses": {"$setUnion": [
+                {"$cond": [{"$in": ["$competence_month", meses_janela]}, ["$competence_month"], []]},
+                {"$cond": [{"$in": [mes_da_data, meses_janela]}, [mes_da_data], []]}
+            ]}
+        }},
+        {"$unwind": "$meses"},
+        {"$group": {
+            "_id": {
+                "mes": "$meses",
+                "type": "$type",
+                "category_id": "$category_id",
+                "category_name": "$category_name",
+                "category_group": "$category_group"
+            },
+            "total": {"$sum": "$amount"},
+            "quantidade": {"$sum": 1}
+        }}
+    ]
+    
+    linhas_por_mes = {}
+    async for linha in db.transactions.aggregate(pipeline):
+        linhas_por_mes.setdefault(linha["_id"]["mes"], []).append(linha)
+    
     # ========== FUNÇÃO PARA CALCULAR DRE DE UM MÊS ==========
-    async def calcular_dre_mes(mes_ref: str):
-        """Calcula a DRE para um mês específico"""
+    def calcular_dre_mes(mes_ref: str):
+        """Calcula a DRE de um mês a partir das linhas agregadas"""
         
         # Inicializar valores
         receita_bruta = 0
@@ -6839,61 +8221,21 @@ async def get_dre_dashboard(company_id: str, meses: int = 12):
         impostos_estimados = False
         lancamentos_sem_categoria = 0
         
-        # ===== RECEITAS =====
-        # Fonte 1: Lançamentos realizados com competência no mês
-        receitas_lancamentos = await db.transactions.find({
-            "company_id": company_id,
-            "type": "receita",
-            "status": "realizado",
-            "cancelled": {"$ne": True},
-            "$or": [
-                {"competence_month": mes_ref},
-                {"date": {"$regex": f"^{mes_ref}"}}
-            ]
-        }, {"_id": 0, "amount": 1, "category_id": 1, "category_name": 1}).to_list(1000)
-        
-        for lanc in receitas_lancamentos:
-            receita_bruta += lanc.get("amount", 0)
-        
-        # Fonte 2: Contas a receber marcadas como RECEBIDO no mês
-        contas_recebidas = await db.contas.find({
-            "company_id": company_id,
-            "tipo": "RECEBER",
-            "status": "RECEBIDO",
-            "data_pagamento": {"$regex": f"^{mes_ref}"}
-        }, {"_id": 0, "valor": 1}).to_list(1000)
-        
-        # Somar contas recebidas (se não houver lançamento correspondente)
-        # Para evitar duplicação, verificamos se já existe lançamento
-        for conta in contas_recebidas:
-            # Simplificação: contas recebidas são contadas se não há lançamento
-            # Na prática, quando marcamos como RECEBIDO, já cria lançamento
-            pass
-        
-        # ===== CUSTOS E DESPESAS =====
-        # Fonte 1: Lançamentos de custo/despesa realizados
-        custos_despesas = await db.transactions.find({
-            "company_id": company_id,
-            "type": {"$in": ["custo", "despesa"]},
-            "status": "realizado",
-            "cancelled": {"$ne": True},
-            "$or": [
-                {"competence_month": mes_ref},
-                {"date": {"$regex": f"^{mes_ref}"}}
-            ]
-        }, {"_id": 0, "amount": 1, "category_id": 1, "category_name": 1, "category_group": 1, "type": 1}).to_list(1000)
-        
-        for lanc in custos_despesas:
-            valor = lanc.get("amount", 0)
-            cat_id = lanc.get("category_id")
-            cat_name = lanc.get("category_name", "")
-            cat_group = lanc.get("category_group")
-            tipo = lanc.get("type", "")
+        for linha in linhas_por_mes.get(mes_ref, []):
+            chave = linha["_id"]
+            valor = linha["total"]
+            tipo = chave.get("type", "")
+            
+            # ===== RECEITAS =====
+            if tipo == "receita":
+                receita_bruta += valor
+                continue
             
+            # ===== CUSTOS E DESPESAS =====
             # Determinar grupo da DRE
-            grupo_dre = categoria_map.get(cat_id)
+            grupo_dre = categoria_map.get(chave.get("category_id"))
             if not grupo_dre:
-                grupo_dre = mapear_categoria_dre(cat_name, cat_group)
+                grupo_dre = mapear_categoria_dre(chave.get("category_name", ""), chave.get("category_group"))
             
             # Se for tipo custo, vai para CSP
             if tipo == "custo":
@@ -6908,7 +8250,7 @@ async def get_dre_dashboard(company_id: str, meses: int = 12):
                 resultado_financeiro -= valor  # Despesa financeira é negativa
             elif grupo_dre == "NAO_CLASSIFICADO":
                 nao_classificado += valor
-                lancamentos_sem_categoria += 1
+                lancamentos_sem_categoria += linha["quantidade"]
             else:
                 despesa_administrativa += valor  # Default
         
@@ -6954,10 +8296,8 @@ async def get_dre_dashboard(company_id: str, meses: int = 12):
         }
     
     # ========== CALCULAR MÊS ATUAL E ANTERIOR ==========
-    dre_mes_atual = await calcular_dre_mes(mes_atual)
-    
-    mes_anterior = (hoje - relativedelta(months=1)).strftime("%Y-%m")
-    dre_mes_anterior = await calcular_dre_mes(mes_anterior)
+    dre_mes_atual = calcular_dre_mes(mes_atual)
+    dre_mes_anterior = calcular_dre_mes(mes_anterior)
     
     # ========== CALCULAR VARIAÇÕES ==========
     variacao_receita = dre_mes_atual["receita_liquida"] - dre_mes_anterior["receita_liquida"]
@@ -6981,7 +8321,7 @@ async def get_dre_dashboard(company_id: str, meses: int = 12):
     serie_historica = []
     for i in range(meses - 1, -1, -1):  # Do mais antigo ao mais recente
         mes_ref = (hoje - relativedelta(months=i)).strftime("%Y-%m")
-        dre_mes = await calcular_dre_mes(mes_ref)
+        dre_mes = calcular_dre_mes(mes_ref)
         
         # Formato simplificado para o gráfico
         mes_label = (hoje - relativedelta(months=i)).strftime("%b/%y")
@@ -7045,7 +8385,7 @@ async def get_dre_detalhada(company_id: str, mes: Optional[str] = None):
         "cancelled": {"$ne": True},
         "$or": [
             {"competence_month": mes},
-            {"date": {"$regex": f"^{mes}"}}
+            {"date": month_range(mes)}
         ]
     }, {"_id": 0}).to_list(2000)
     
@@ -7131,13 +8471,7 @@ async def get_dre_detalhada(company_id: str, mes: Optional[str] = None):
         detalhamento[grupo].sort(key=lambda x: x["valor"], reverse=True)
     
     # Buscar configuração de ISS
-    markup_config = await db.markup_profiles.find_one(
-        {"company_id": company_id},
-        {"_id": 0, "taxes": 1}
-    )
-    aliquota_iss = 0.03
-    if markup_config and markup_config.get("taxes"):
-        aliquota_iss = markup_config["taxes"].get("iss_rate", 0.03)
+    aliquota_iss = await get_aliquota_iss(company_id)
     
     # Calcular DRE completa
     impostos = totais["receita_bruta"] * aliquota_iss
@@ -7220,6 +8554,31 @@ async def admin_stats(user_id: str):
         "total_companies": total_companies
     }
 
+@api_router.get("/admin/indexes")
+async def admin_indexes_status(user_id: str):
+    """Progresso do provisionamento de índices do MongoDB"""
+    await verify_admin(user_id)
+    return index_build_status
+
+@api_router.post("/admin/indexes/rebuild")
+async def admin_indexes_rebuild(user_id: str):
+    """Reexecutar a reconciliação de índices"""
+    await verify_admin(user_id)
+    if _index_build_task is not None and not _index_build_task.done():
+        raise HTTPException(status_code=409, detail="Provisionamento de índices já em andamento")
+    start_index_build()
+    return {"message": "Provisionamento de índices iniciado"}
+
+@api_router.post("/admin/monthly-summaries/rebuild")
+async def admin_rebuild_monthly_summaries(user_id: str, company_id: Optional[str] = None):
+    """Reconstruir os resumos mensais de uma empresa (ou de todas)"""
+    await verify_admin(user_id)
+    company_ids = [company_id] if company_id else await db.transactions.distinct("company_id")
+    total = 0
+    for cid in company_ids:
+        total += await rebuild_monthly_summaries(cid)
+    return {"message": "Resumos mensais reconstruídos", "companies": len(company_ids), "summaries": total}
+
 @api_router.get("/admin/users")
 async def admin_users(user_id: str):
     await verify_admin(user_id)
@@ -7448,25 +8807,15 @@ async def get_service_price_item(item_id: str):
 
 async def gerar_codigo_servico(company_id: str):
     """Gerar código automático sequencial para serviço (formato: SRV-0001)"""
-    # Buscar último serviço com código automático
-    ultimo_servico = await db.service_price_table.find_one(
-        {
-            "company_id": company_id,
-            "code": {"$regex": r"^SRV-\d+$"}
-        },
-        sort=[("created_at", -1)]
+    proximo_numero = await next_sequence(
+        f"servico:{company_id}:SRV",
+        lambda: max_sequence_number(
+            db.service_price_table,
+            {"company_id": company_id, "code": {"$regex": r"^SRV-\d+$"}},
+            "code"
+        )
     )
     
-    if ultimo_servico and ultimo_servico.get('code'):
-        try:
-            # Extrair número do último código
-            ultimo_numero = int(ultimo_servico['code'].split('-')[-1])
-            proximo_numero = ultimo_numero + 1
-        except:
-            proximo_numero = 1
-    else:
-        proximo_numero = 1
-    
     return f"SRV-{proximo_numero:04d}"
 
 @api_router.post("/service-price-table")
@@ -7507,6 +8856,9 @@ async def create_service_price(data: ServicePriceCreate):
         service_code = None
         if data.code:
             service_code = data.code.strip().upper()
+            # Código manual no formato automático: avançar a sequência
+            if re.match(r"^SRV-\d+$", service_code):
+                await bump_sequence(f"servico:{data.company_id}:SRV", int(service_code.split("-")[-1]))
         else:
             # Código automático
             service_code = await gerar_codigo_servico(data.company_id)
@@ -7635,117 +8987,339 @@ async def delete_service_price(item_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+PRICE_TABLE_IMPORT_CHUNK_SIZE = int(os.environ.get("PRICE_TABLE_IMPORT_CHUNK_SIZE", "1000"))
+
+
+async def bulk_import_service_prices(company_id: str, items: List[ServicePriceImportItem], on_progress=None) -> dict:
+    """
+    Importar itens na tabela de preços em lote.
+    Carrega as chaves existentes (descrição, unidade, categoria) em uma consulta,
+    valida em memória e grava com insert_many não ordenado em blocos.
+    on_progress(processados, total) é chamado após cada bloco gravado.
+    """
+    created = 0
+    skipped = 0
+    errors = []
+    
+    # Chaves já cadastradas para a empresa
+    existing_keys = set()
+    async for doc in db.service_price_table.find(
+        {"company_id": company_id},
+        {"_id": 0, "description": 1, "unit": 1, "category": 1}
+    ):
+        existing_keys.add((doc.get("description"), doc.get("unit"), doc.get("category")))
+    
+    pending = []  # (linha, documento)
+    maior_codigo_srv = 0  # Códigos SRV-NNNN informados no arquivo
+    
+    async def flush():
+        nonlocal created
+        if not pending:
+            return
+        try:
+            result = await db.service_price_table.insert_many([doc for _, doc in pending], ordered=False)
+            created += len(result.inserted_ids)
+        except BulkWriteError as e:
+            created += e.details.get("nInserted", 0)
+            for write_error in e.details.get("writeErrors", []):
+                linha = pending[write_error["index"]][0]
+                errors.append(f"Linha {linha}: {write_error.get('errmsg', 'erro ao gravar')}")
+        pending.clear()
+    
+    for idx, item in enumerate(items):
+        try:
+            # Validar unidade
+            if item.unit not in PRICE_TABLE_UNITS:
+                errors.append(f"Linha {idx + 1}: Unidade inválida '{item.unit}'")
+                continue
+            
+            # Validar preço
+            if item.pu1_base_price <= 0:
+                errors.append(f"Linha {idx + 1}: Preço deve ser maior que 0")
+                continue
+            
+            description = item.description.strip().upper()
+            if len(description) < 3:
+                errors.append(f"Linha {idx + 1}: Descrição muito curta")
+                continue
+            
+            # Verificar duplicidade (no banco ou em linhas anteriores do arquivo)
+            if (description, item.unit, item.category) in existing_keys:
+                skipped += 1
+                continue
+            
+            # Criar item
+            new_item = ServicePrice(
+                company_id=company_id,
+                code=item.code.strip().upper() if item.code else None,
+                description=description,
+                category=item.category.strip() if item.category else None,
+                unit=item.unit,
+                pu1_base_price=round(item.pu1_base_price, 2),
+                active=item.active
+            )
+            
+            doc = new_item.model_dump()
+            doc['created_at'] = doc['created_at'].isoformat()
+            doc['updated_at'] = doc['updated_at'].isoformat()
+            
+            existing_keys.add((doc['description'], doc['unit'], doc['category']))
+            pending.append((idx + 1, doc))
+            if doc['code'] and re.match(r"^SRV-\d+$", doc['code']):
+                maior_codigo_srv = max(maior_codigo_srv, int(doc['code'].split("-")[-1]))
+            
+        except Exception as e:
+            errors.append(f"Linha {idx + 1}: {str(e)}")
+        
+        if len(pending) >= PRICE_TABLE_IMPORT_CHUNK_SIZE:
+            await flush()
+            if on_progress:
+                await on_progress(idx + 1, len(items))
+    
+    await flush()
+    if maior_codigo_srv:
+        await bump_sequence(f"servico:{company_id}:SRV", maior_codigo_srv)
+    if on_progress:
+        await on_progress(len(items), len(items))
+    
+    return {
+        "message": f"Importação concluída: {created} criados, {skipped} ignorados (duplicados)",
+        "created": created,
+        "skipped": skipped,
+        "errors": errors
+    }
+
+
 @api_router.post("/service-price-table/{company_id}/import")
 async def import_service_price_table(company_id: str, items: List[ServicePriceImportItem]):
     """Importar itens em lote para a tabela de preços"""
     try:
-        created = 0
-        skipped = 0
-        errors = []
-        
-        for idx, item in enumerate(items):
-            try:
-                # Validar unidade
-                if item.unit not in PRICE_TABLE_UNITS:
-                    errors.append(f"Linha {idx + 1}: Unidade inválida '{item.unit}'")
-                    continue
-                
-                # Validar preço
-                if item.pu1_base_price <= 0:
-                    errors.append(f"Linha {idx + 1}: Preço deve ser maior que 0")
-                    continue
-                
-                description = item.description.strip().upper()
-                if len(description) < 3:
-                    errors.append(f"Linha {idx + 1}: Descrição muito curta")
-                    continue
-                
-                # Verificar duplicidade
-                existing = await db.service_price_table.find_one({
-                    "company_id": company_id,
-                    "description": description,
-                    "unit": item.unit,
-                    "category": item.category
-                })
-                
-                if existing:
-                    skipped += 1
-                    continue
-                
-                # Criar item
-                new_item = ServicePrice(
-                    company_id=company_id,
-                    code=item.code.strip().upper() if item.code else None,
-                    description=description,
-                    category=item.category.strip() if item.category else None,
-                    unit=item.unit,
-                    pu1_base_price=round(item.pu1_base_price, 2),
-                    active=item.active
-                )
-                
-                doc = new_item.model_dump()
-                doc['created_at'] = doc['created_at'].isoformat()
-                doc['updated_at'] = doc['updated_at'].isoformat()
-                
-                await db.service_price_table.insert_one(doc)
-                created += 1
-                
-            except Exception as e:
-                errors.append(f"Linha {idx + 1}: {str(e)}")
-        
-        return {
-            "message": f"Importação concluída: {created} criados, {skipped} ignorados (duplicados)",
-            "created": created,
-            "skipped": skipped,
-            "errors": errors
-        }
+        return await bulk_import_service_prices(company_id, items)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+async def run_import_tabela_precos_job(job: dict, on_progress) -> dict:
+    """Handler do job de importação da tabela de preços"""
+    items = [ServicePriceImportItem(**item) for item in job["payload"]["items"]]
+    return await bulk_import_service_prices(job["company_id"], items, on_progress)
+
+JOB_HANDLERS["importar_tabela_precos"] = run_import_tabela_precos_job
+
+
+@api_router.post("/service-price-table/{company_id}/import/jobs")
+async def import_service_price_table_job(company_id: str, items: List[ServicePriceImportItem]):
+    """Importar a tabela de preços em segundo plano; acompanhar em GET /api/jobs/{job_id}"""
+    if not items:
+        raise HTTPException(status_code=400, detail="Nenhum item para importar")
+    
+    job = await enqueue_job(
+        "importar_tabela_precos",
+        company_id,
+        {"items": [item.model_dump() for item in items]},
+        total=len(items)
+    )
+    return {"message": "Importação iniciada", "job_id": job["id"], "job": job}
+
 @api_router.get("/service-price-table/units/list")
 async def get_service_price_units():
     """Retornar lista de unidades disponíveis"""
     return {"units": PRICE_TABLE_UNITS}
 
 # ========== EXPORTAÇÃO ==========
+# As exportações percorrem o cursor sem carregar a coleção em memória:
+# CSV é gerado em blocos direto na resposta; XLSX usa o modo write-only do
+# openpyxl (linhas vão para disco) e o arquivo é enviado em blocos.
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+}
+
+# Entidades exportáveis: coleção, campo(s) da empresa, campo de data do filtro
+# de período e colunas (cabeçalho, campo ou tupla de campos alternativos)
+EXPORT_ENTITIES = {
+    "lancamentos": {
+        "collection": "transactions",
+        "date_field": "date",
+        "title": "Lançamentos",
+        "columns": [
+            ("Data", "date"),
+            ("Tipo", "type"),
+            ("Descrição", "description"),
+            ("Categoria", ("category", "category_name")),
+            ("Valor", "amount"),
+            ("Status", "status"),
+        ],
+    },
+    "contas": {
+        "collection": "contas",
+        "date_field": "data_vencimento",
+        "title": "Contas",
+        "columns": [
+            ("Tipo", "tipo"),
+            ("Descrição", "descricao"),
+            ("Categoria", "categoria"),
+            ("Fornecedor", "fornecedor_nome"),
+            ("Emissão", "data_emissao"),
+            ("Vencimento", "data_vencimento"),
+            ("Pagamento", "data_pagamento"),
+            ("Valor", "valor"),
+            ("Status", "status"),
+            ("Forma de Pagamento", "forma_pagamento"),
+        ],
+    },
+    "orcamentos": {
+        "collection": "orcamentos",
+        "date_field": "created_at",
+        "title": "Orçamentos",
+        "columns": [
+            ("Número", "numero_orcamento"),
+            ("Data", "created_at"),
+            ("Cliente", "cliente_nome"),
+            ("Vendedor", "vendedor_nome"),
+            ("Descrição", "descricao_servico_ou_produto"),
+            ("Tipo", "tipo"),
+            ("Valor", ("preco_praticado", "valor_total", "total")),
+            ("Status", "status"),
+        ],
+    },
+    "tabela_precos": {
+        "collection": "service_price_table",
+        "date_field": None,
+        "sort_field": "code",
+        "title": "Tabela de Preços",
+        "columns": [
+            ("Código", "code"),
+            ("Descrição", "description"),
+            ("Categoria", "category"),
+            ("Unidade", "unit"),
+            ("Preço Base (PU1)", "pu1_base_price"),
+            ("Ativo", "active"),
+        ],
+    },
+}
+
+
+def export_period_filter(month: Optional[str], data_inicio: Optional[str], data_fim: Optional[str]) -> Optional[dict]:
+    """Filtro de período da exportação: mês (YYYY-MM) ou intervalo de datas (YYYY-MM-DD, inclusivo)"""
+    if month:
+        return month_range(month)
+    if not data_inicio and not data_fim:
+        return None
+    
+    period = {}
+    try:
+        if data_inicio:
+            period["$gte"] = datetime.strptime(data_inicio, "%Y-%m-%d").strftime("%Y-%m-%d")
+        if data_fim:
+            # $lt no dia seguinte também cobre datas com horário (created_at ISO)
+            dia_seguinte = datetime.strptime(data_fim, "%Y-%m-%d") + timedelta(days=1)
+            period["$lt"] = dia_seguinte.strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Datas inválidas. Use o formato YYYY-MM-DD")
+    return period
+
+
+def _export_value(doc: dict, field):
+    """Valor de uma coluna (tupla = primeiro campo preenchido)"""
+    if isinstance(field, tuple):
+        for f in field:
+            if doc.get(f) not in (None, ""):
+                return doc.get(f)
+        return None
+    value = doc.get(field)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return value
+
+
+async def _stream_export_csv(cursor, columns):
+    """Gerar o CSV em blocos conforme o cursor avança"""
+    buffer = StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    buffer.write("\ufeff")  # BOM para o Excel abrir em UTF-8
+    writer.writerow([header for header, _ in columns])
+    
+    async for doc in cursor:
+        writer.writerow([_export_value(doc, field) for _, field in columns])
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate(0)
+    
+    yield buffer.getvalue().encode("utf-8")
+
+
+async def _build_export_xlsx(cursor, columns, title: str) -> str:
+    """Gravar o XLSX em arquivo temporário (openpyxl write-only) e retornar o caminho"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=re.sub(r'[\\/*?:\[\]]', '-', title)[:31])
+    ws.append([header for header, _ in columns])
+    
+    async for doc in cursor:
+        ws.append([_export_value(doc, field) for _, field in columns])
+    
+    tmp = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
+    tmp.close()
+    try:
+        await asyncio.to_thread(wb.save, tmp.name)
+    except Exception:
+        os.remove(tmp.name)
+        raise
+    return tmp.name
+
 
 @api_router.get("/export/excel/{company_id}")
-async def export_excel(company_id: str, month: str):
-    transactions = await db.transactions.find({
-        "company_id": company_id,
-        "date": {"$regex": f"^{month}"}
-    }, {"_id": 0}).to_list(1000)
+async def export_excel(
+    company_id: str,
+    month: Optional[str] = None,
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    entidade: str = "lancamentos",
+    formato: str = "xlsx"
+):
+    """
+    Exportar lançamentos, contas, orçamentos ou tabela de preços em XLSX ou CSV.
+    Período por mês (month=YYYY-MM) ou intervalo (data_inicio/data_fim); sem período exporta tudo.
+    """
+    spec = EXPORT_ENTITIES.get(entidade)
+    if not spec:
+        raise HTTPException(status_code=400, detail=f"Entidade inválida. Use: {', '.join(EXPORT_ENTITIES)}")
+    if formato not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Formato inválido. Use: xlsx ou csv")
     
-    # Criar workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"Lançamentos {month}"
-    
-    # Headers
-    headers = ["Data", "Tipo", "Descrição", "Categoria", "Valor", "Status"]
-    ws.append(headers)
-    
-    # Dados
-    for t in transactions:
-        ws.append([
-            t['date'],
-            t['type'],
-            t['description'],
-            t['category'],
-            t['amount'],
-            t['status']
-        ])
-    
-    # Salvar em BytesIO
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
+    query = tenant_query(spec["collection"], company_id)
     
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename=lancamentos_{month}.xlsx"}
-    )
+    period = export_period_filter(month, data_inicio, data_fim)
+    if period and spec["date_field"]:
+        query[spec["date_field"]] = period
+    
+    columns = spec["columns"]
+    projection = {"_id": 0}
+    for _, field in columns:
+        for f in (field if isinstance(field, tuple) else (field,)):
+            projection[f] = 1
+    
+    sort_field = spec.get("sort_field") or spec["date_field"]
+    cursor = db[spec["collection"]].find(query, projection).sort(sort_field, 1).batch_size(EXPORT_BATCH_SIZE)
+    
+    periodo_nome = month or "_".join(filter(None, [data_inicio, data_fim])) or "completo"
+    # Mantém o nome antigo (lancamentos_YYYY-MM.xlsx) para a exportação mensal de lançamentos
+    filename = f"{entidade}_{periodo_nome}.{formato}"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    
+    if formato == "csv":
+        return StreamingResponse(_stream_export_csv(cursor, columns), media_type=EXPORT_FORMATS["csv"], headers=headers)
+    
+    title = f"{spec['title']} {month}" if month else spec["title"]
+    path = await _build_export_xlsx(cursor, columns, title)
+    # O arquivo temporário é apagado depois do envio, mesmo se o cliente desconectar
+    return FileResponse(path, media_type=EXPORT_FORMATS["xlsx"], headers=headers, background=BackgroundTask(os.remove, path))
 
 
 # ========== ROTAS: RELATÓRIOS ==========
@@ -7778,6 +9352,41 @@ def get_periodo_datas(periodo: str):
     return inicio.strftime('%Y-%m-%d'), fim.strftime('%Y-%m-%d')
 
 
+async def totais_transacoes_periodo(company_id: str, inicio: str, fim: str) -> dict:
+    """Somar receitas e despesas (despesa + custo) do período no banco"""
+    pipeline = [
+        {"$match": {
+            "company_id": company_id,
+            "type": {"$in": ["receita", "despesa", "custo"]},
+            "date": {"$gte": inicio, "$lte": fim}
+        }},
+        {"$group": {"_id": "$type", "total": {"$sum": "$amount"}}}
+    ]
+    totais = {"receitas": 0, "despesas": 0}
+    async for r in db.transactions.aggregate(pipeline):
+        if r["_id"] == "receita":
+            totais["receitas"] += r["total"]
+        else:
+            totais["despesas"] += r["total"]
+    return totais
+
+
+async def totais_orcamentos(company_id: str, query: dict) -> dict:
+    """Contar orçamentos, somar valor (valor_total ou total) e contar aprovados no banco"""
+    pipeline = [
+        {"$group": {
+            "_id": None,
+            "quantidade": {"$sum": 1},
+            "valor": {"$sum": {"$cond": ["$valor_total", "$valor_total", {"$ifNull": ["$total", 0]}]}},
+            "aprovados": {"$sum": {"$cond": [{"$eq": ["$status", "APROVADO"]}, 1, 0]}}
+        }}
+    ]
+    resultado = await tenant_aggregate("orcamentos", company_id, pipeline, query).to_list(1)
+    if not resultado:
+        return {"quantidade": 0, "valor": 0, "aprovados": 0}
+    return {k: resultado[0][k] for k in ("quantidade", "valor", "aprovados")}
+
+
 @api_router.get("/relatorios/contas-pagar/{company_id}")
 async def relatorio_contas_pagar(
     company_id: str,
@@ -7979,7 +9588,7 @@ async def relatorio_aging_pagar(company_id: str):
     contas = await db.contas.find({
         "company_id": company_id,
         "tipo": "PAGAR",
-        "status": {"$nin": ["PAGO", "CANCELADO"]}
+        "status": {"$in": CONTAS_STATUS_EM_ABERTO}
     }, {"_id": 0}).to_list(1000)
     
     # Definir faixas
@@ -8077,14 +9686,14 @@ async def relatorio_fluxo_projetado(company_id: str, dias: int = 30):
     fim = (hoje + timedelta(days=dias)).strftime('%Y-%m-%d')
     
     # Buscar saldo atual (da empresa ou calcular)
-    empresa = await db.companies.find_one({"id": company_id}, {"_id": 0})
+    empresa = await get_company_cached(company_id)
     saldo_atual = empresa.get('saldo_bancario', 0) if empresa else 0
     
     # Buscar contas a receber pendentes
     entradas = await db.contas.find({
         "company_id": company_id,
         "tipo": "RECEBER",
-        "status": {"$nin": ["RECEBIDO", "PAGO", "CANCELADO"]},
+        "status": {"$in": CONTAS_STATUS_EM_ABERTO},
         "data_vencimento": {"$lte": fim}
     }, {"_id": 0}).to_list(1000)
     
@@ -8092,7 +9701,7 @@ async def relatorio_fluxo_projetado(company_id: str, dias: int = 30):
     saidas = await db.contas.find({
         "company_id": company_id,
         "tipo": "PAGAR",
-        "status": {"$nin": ["PAGO", "CANCELADO"]},
+        "status": {"$in": CONTAS_STATUS_EM_ABERTO},
         "data_vencimento": {"$lte": fim}
     }, {"_id": 0}).to_list(1000)
     
@@ -8353,8 +9962,7 @@ async def relatorio_inadimplencia(company_id: str):
     contas_atrasadas = await db.contas.find({
         "company_id": company_id,
         "tipo": "RECEBER",
-        "status": {"$in": ["PENDENTE", "ATRASADO"]},
-        "data_vencimento": {"$lt": hoje_str}
+        **await filtro_contas_atrasadas(hoje_str)
     }, {"_id": 0}).to_list(5000)
     
     # Buscar clientes
@@ -8479,17 +10087,21 @@ async def relatorio_funil_orcamentos(company_id: str, periodo: str = 'mes'):
     
     fim = hoje.strftime('%Y-%m-%d')
     
-    # Buscar orçamentos no período
-    orcamentos = await db.orcamentos.find({
-        "company_id": company_id,
-        "created_at": {"$gte": inicio}
-    }, {"_id": 0}).to_list(5000)
+    # Contar orçamentos do período por status no banco
+    por_status = [
+        {"$group": {
+            "_id": "$status",
+            "quantidade": {"$sum": 1},
+            "valor": {"$sum": {"$cond": ["$valor_total", "$valor_total", {"$ifNull": ["$total", 0]}]}}
+        }}
+    ]
+    grupos = await tenant_aggregate(
+        "orcamentos", company_id, por_status, {"created_at": {"$gte": inicio}}
+    ).to_list(None)
     
-    # Se não encontrar com created_at, tentar com data
-    if not orcamentos:
-        orcamentos = await db.orcamentos.find({
-            "company_id": company_id
-        }, {"_id": 0}).to_list(5000)
+    # Se não encontrar com created_at, considerar todos
+    if not grupos:
+        grupos = await tenant_aggregate("orcamentos", company_id, por_status).to_list(None)
     
     # Definir status do funil
     status_order = ['rascunho', 'enviado', 'negociacao', 'aprovado', 'recusado']
@@ -8501,21 +10113,27 @@ async def relatorio_funil_orcamentos(company_id: str, periodo: str = 'mes'):
         'recusado': 'Recusado'
     }
     
+    # Status canônico -> etapa do funil (status desconhecido conta como rascunho)
+    etapa_por_status = {
+        'RASCUNHO': 'rascunho',
+        'ENVIADO': 'enviado',
+        'NEGOCIACAO': 'negociacao',
+        'APROVADO': 'aprovado',
+        'NAO_APROVADO': 'recusado'
+    }
+    
     # Contar por status
     funil = {s: {'quantidade': 0, 'valor': 0} for s in status_order}
     
-    total_orcamentos = len(orcamentos)
+    total_orcamentos = 0
     valor_total = 0
     
-    for orc in orcamentos:
-        status = orc.get('status', 'rascunho').lower()
-        if status not in funil:
-            status = 'rascunho'
-        
-        valor = orc.get('valor_total', 0) or orc.get('total', 0) or 0
-        funil[status]['quantidade'] += 1
-        funil[status]['valor'] += valor
-        valor_total += valor
+    for grupo in grupos:
+        status = etapa_por_status.get(grupo['_id'], 'rascunho')
+        funil[status]['quantidade'] += grupo['quantidade']
+        funil[status]['valor'] += grupo['valor']
+        total_orcamentos += grupo['quantidade']
+        valor_total += grupo['valor']
     
     # Calcular taxas de conversão
     funil_data = []
@@ -8590,34 +10208,26 @@ async def relatorio_orcamentos_periodo(company_id: str, periodo: str = 'mes'):
     else:  # ano
         meses = 12
     
-    # Buscar todos os orçamentos
-    orcamentos = await db.orcamentos.find({
-        "company_id": company_id
-    }, {"_id": 0}).to_list(10000)
+    # Agrupar por mês (YYYY-MM da data de criação) no banco
+    valor_orcamento = {"$cond": ["$valor_total", "$valor_total", {"$ifNull": ["$total", 0]}]}
+    aprovado = {"$eq": ["$status", "APROVADO"]}
+    grupos = await tenant_aggregate("orcamentos", company_id, [
+        {"$group": {
+            "_id": {"$substrCP": [{"$toString": {"$ifNull": ["$created_at", {"$ifNull": ["$data", ""]}]}}, 0, 7]},
+            "quantidade": {"$sum": 1},
+            "valor": {"$sum": valor_orcamento},
+            "aprovados": {"$sum": {"$cond": [aprovado, 1, 0]}},
+            "valor_aprovado": {"$sum": {"$cond": [aprovado, valor_orcamento, 0]}}
+        }}
+    ]).to_list(None)
     
-    # Agrupar por mês
     por_mes = defaultdict(lambda: {'quantidade': 0, 'valor': 0, 'aprovados': 0, 'valor_aprovado': 0})
     
-    for orc in orcamentos:
-        # Tentar pegar data de criação
-        data_str = orc.get('created_at', orc.get('data', ''))
-        if isinstance(data_str, str) and data_str:
-            try:
-                mes_ano = data_str[:7]  # YYYY-MM
-            except:
-                mes_ano = hoje.strftime('%Y-%m')
-        else:
-            mes_ano = hoje.strftime('%Y-%m')
-        
-        valor = orc.get('valor_total', 0) or orc.get('total', 0) or 0
-        status = orc.get('status', '').lower()
-        
-        por_mes[mes_ano]['quantidade'] += 1
-        por_mes[mes_ano]['valor'] += valor
-        
-        if status == 'aprovado':
-            por_mes[mes_ano]['aprovados'] += 1
-            por_mes[mes_ano]['valor_aprovado'] += valor
+    for grupo in grupos:
+        # Sem data de criação: conta no mês atual
+        mes_ano = grupo['_id'] or hoje.strftime('%Y-%m')
+        for campo in ('quantidade', 'valor', 'aprovados', 'valor_aprovado'):
+            por_mes[mes_ano][campo] += grupo[campo]
     
     # Ordenar por mês
     meses_ordenados = sorted(por_mes.keys(), reverse=True)[:12]
@@ -8699,9 +10309,7 @@ async def relatorio_servicos_materiais(company_id: str, periodo: str = 'mes'):
     fim = hoje.strftime('%Y-%m-%d')
     
     # Buscar orçamentos
-    orcamentos = await db.orcamentos.find({
-        "company_id": company_id
-    }, {"_id": 0}).to_list(10000)
+    orcamentos = await tenant_find("orcamentos", company_id).to_list(10000)
     
     # Calcular totais
     total_servicos = 0
@@ -8815,7 +10423,7 @@ async def relatorio_clientes_cadastro(company_id: str, status: str = None):
     clientes = await db.clientes.find(query, {"_id": 0}).to_list(5000)
     
     # Buscar orçamentos para calcular valores por cliente
-    orcamentos = await db.orcamentos.find({"company_id": company_id}, {"_id": 0}).to_list(10000)
+    orcamentos = await tenant_find("orcamentos", company_id).to_list(10000)
     
     # Mapear valores por cliente
     valores_cliente = {}
@@ -8886,16 +10494,13 @@ async def relatorio_clientes_recorrencia(company_id: str):
     clientes_dict = {c.get('id'): c.get('nome', 'Cliente') for c in clientes}
     
     # Buscar orçamentos aprovados (vendas)
-    orcamentos = await db.orcamentos.find({
-        "company_id": company_id,
-        "status": {"$in": ["aprovado", "Aprovado", "APROVADO", "finalizado", "Finalizado"]}
+    orcamentos = await tenant_find("orcamentos", company_id, {
+        "status": "APROVADO"
     }, {"_id": 0}).to_list(10000)
     
     # Se não houver orçamentos aprovados, buscar todos
     if not orcamentos:
-        orcamentos = await db.orcamentos.find({
-            "company_id": company_id
-        }, {"_id": 0}).to_list(10000)
+        orcamentos = await tenant_find("orcamentos", company_id).to_list(10000)
     
     # Agrupar por cliente
     compras_cliente = defaultdict(lambda: {
@@ -9026,8 +10631,7 @@ async def relatorio_clientes_inadimplencia(company_id: str):
     contas_atrasadas = await db.contas.find({
         "company_id": company_id,
         "tipo": "RECEBER",
-        "status": {"$in": ["PENDENTE", "ATRASADO"]},
-        "data_vencimento": {"$lt": hoje_str}
+        **await filtro_contas_atrasadas(hoje_str)
     }, {"_id": 0}).to_list(5000)
     
     # Agrupar por cliente
@@ -9126,70 +10730,49 @@ async def relatorio_top_indicadores(company_id: str):
     inicio_mes_ant = primeiro_dia_mes_passado.strftime('%Y-%m-%d')
     fim_mes_ant = ultimo_dia_mes_passado.strftime('%Y-%m-%d')
     
-    # Buscar transações do mês atual
-    receitas_mes = await db.transactions.find({
-        "company_id": company_id,
-        "type": "receita",
-        "date": {"$gte": inicio_mes, "$lte": fim_mes}
-    }, {"_id": 0}).to_list(5000)
-    
-    despesas_mes = await db.transactions.find({
-        "company_id": company_id,
-        "type": {"$in": ["despesa", "custo"]},
-        "date": {"$gte": inicio_mes, "$lte": fim_mes}
-    }, {"_id": 0}).to_list(5000)
-    
-    # Transações do mês anterior
-    receitas_ant = await db.transactions.find({
-        "company_id": company_id,
-        "type": "receita",
-        "date": {"$gte": inicio_mes_ant, "$lte": fim_mes_ant}
-    }, {"_id": 0}).to_list(5000)
-    
-    despesas_ant = await db.transactions.find({
-        "company_id": company_id,
-        "type": {"$in": ["despesa", "custo"]},
-        "date": {"$gte": inicio_mes_ant, "$lte": fim_mes_ant}
-    }, {"_id": 0}).to_list(5000)
+    # Totais de transações do mês atual e do anterior (somados no banco)
+    totais_mes = await totais_transacoes_periodo(company_id, inicio_mes, fim_mes)
+    totais_ant = await totais_transacoes_periodo(company_id, inicio_mes_ant, fim_mes_ant)
     
     # Calcular valores
-    total_receitas = sum(r.get('amount', 0) for r in receitas_mes)
-    total_despesas = sum(d.get('amount', 0) for d in despesas_mes)
+    total_receitas = totais_mes["receitas"]
+    total_despesas = totais_mes["despesas"]
     lucro_liquido = total_receitas - total_despesas
     
-    total_receitas_ant = sum(r.get('amount', 0) for r in receitas_ant)
-    total_despesas_ant = sum(d.get('amount', 0) for d in despesas_ant)
+    total_receitas_ant = totais_ant["receitas"]
+    total_despesas_ant = totais_ant["despesas"]
     lucro_ant = total_receitas_ant - total_despesas_ant
     
     # Buscar orçamentos
-    orcamentos = await db.orcamentos.find({
-        "company_id": company_id,
+    orcamentos = await totais_orcamentos(company_id, {
         "created_at": {"$gte": inicio_mes}
-    }, {"_id": 0}).to_list(1000)
+    })
     
-    orcamentos_ant = await db.orcamentos.find({
-        "company_id": company_id,
+    orcamentos_ant = await totais_orcamentos(company_id, {
         "created_at": {"$gte": inicio_mes_ant, "$lt": inicio_mes}
-    }, {"_id": 0}).to_list(1000)
+    })
     
-    total_orc = len(orcamentos)
-    valor_orc = sum(o.get('valor_total', 0) or o.get('total', 0) or 0 for o in orcamentos)
-    aprovados = len([o for o in orcamentos if o.get('status', '').lower() == 'aprovado'])
+    total_orc = orcamentos["quantidade"]
+    valor_orc = orcamentos["valor"]
+    aprovados = orcamentos["aprovados"]
     
-    total_orc_ant = len(orcamentos_ant) if orcamentos_ant else 1
+    total_orc_ant = orcamentos_ant["quantidade"] or 1
     
-    # Buscar clientes
-    clientes = await db.clientes.find({"empresa_id": company_id}, {"_id": 0}).to_list(1000)
-    total_clientes = len(clientes)
+    # Contar clientes
+    total_clientes = await db.clientes.count_documents({"empresa_id": company_id})
     
-    # Buscar inadimplência
-    contas_atrasadas = await db.contas.find({
-        "company_id": company_id,
-        "tipo": "RECEBER",
-        "status": {"$in": ["PENDENTE", "ATRASADO"]},
-        "data_vencimento": {"$lt": fim_mes}
-    }, {"_id": 0}).to_list(1000)
-    total_inadimplencia = sum(c.get('valor', 0) for c in contas_atrasadas)
+    # Somar inadimplência: a receber em aberto com vencimento até o fim do mês
+    # (inclui as PENDENTE que ainda vão vencer neste mês, não só as ATRASADO)
+    inadimplencia = await db.contas.aggregate([
+        {"$match": {
+            "company_id": company_id,
+            "tipo": "RECEBER",
+            "status": {"$in": ["PENDENTE", "ATRASADO"]},
+            "data_vencimento": {"$lt": fim_mes}
+        }},
+        {"$group": {"_id": None, "total": {"$sum": "$valor"}}}
+    ]).to_list(1)
+    total_inadimplencia = inadimplencia[0]["total"] if inadimplencia else 0
     
     # Calcular variações
     def calc_variacao(atual, anterior):
@@ -9333,8 +10916,7 @@ async def relatorio_alertas(company_id: str):
     contas_atrasadas = await db.contas.find({
         "company_id": company_id,
         "tipo": "RECEBER",
-        "status": {"$in": ["PENDENTE", "ATRASADO"]},
-        "data_vencimento": {"$lt": hoje_str}
+        **await filtro_contas_atrasadas(hoje_str)
     }, {"_id": 0}).to_list(100)
     
     if contas_atrasadas:
@@ -9361,9 +10943,8 @@ async def relatorio_alertas(company_id: str):
     
     # 3. Verificar orçamentos pendentes há muito tempo
     data_30dias = (hoje - timedelta(days=30)).strftime('%Y-%m-%d')
-    orcamentos_antigos = await db.orcamentos.find({
-        "company_id": company_id,
-        "status": {"$in": ["rascunho", "enviado", "Rascunho", "Enviado"]},
+    orcamentos_antigos = await tenant_find("orcamentos", company_id, {
+        "status": {"$in": ["RASCUNHO", "ENVIADO"]},
         "created_at": {"$lt": data_30dias}
     }, {"_id": 0}).to_list(100)
     
@@ -9409,7 +10990,7 @@ async def relatorio_alertas(company_id: str):
     
     # 5. Oportunidade: Clientes sem compra recente
     clientes = await db.clientes.find({"empresa_id": company_id}, {"_id": 0}).to_list(500)
-    orcamentos = await db.orcamentos.find({"company_id": company_id}, {"_id": 0}).to_list(5000)
+    orcamentos = await tenant_find("orcamentos", company_id).to_list(5000)
     
     clientes_com_compra = set()
     for o in orcamentos:
@@ -9479,34 +11060,29 @@ async def relatorio_comparativo(company_id: str):
     # Últimos 3 meses para média
     inicio_3m = (inicio_mes_atual - timedelta(days=90)).replace(day=1)
     
+    dados_cache = {}
+    
     async def get_dados_periodo(inicio, fim):
         inicio_str = inicio.strftime('%Y-%m-%d')
         fim_str = fim.strftime('%Y-%m-%d')
         
-        receitas = await db.transactions.find({
-            "company_id": company_id,
-            "type": "receita",
-            "date": {"$gte": inicio_str, "$lte": fim_str}
-        }, {"_id": 0}).to_list(5000)
-        
-        despesas = await db.transactions.find({
-            "company_id": company_id,
-            "type": {"$in": ["despesa", "custo"]},
-            "date": {"$gte": inicio_str, "$lte": fim_str}
-        }, {"_id": 0}).to_list(5000)
+        # O mês anterior também entra na média de 3 meses: calcular uma vez só
+        if (inicio_str, fim_str) in dados_cache:
+            return dados_cache[(inicio_str, fim_str)]
         
-        orcamentos = await db.orcamentos.find({
-            "company_id": company_id,
+        # Totais calculados no banco ($group), sem limite de documentos
+        transacoes = await totais_transacoes_periodo(company_id, inicio_str, fim_str)
+        orcamentos = await totais_orcamentos(company_id, {
             "created_at": {"$gte": inicio_str, "$lte": fim_str}
-        }, {"_id": 0}).to_list(1000)
+        })
         
-        total_receitas = sum(r.get('amount', 0) for r in receitas)
-        total_despesas = sum(d.get('amount', 0) for d in despesas)
-        total_orcamentos = len(orcamentos)
-        valor_orcamentos = sum(o.get('valor_total', 0) or o.get('total', 0) or 0 for o in orcamentos)
-        aprovados = len([o for o in orcamentos if o.get('status', '').lower() == 'aprovado'])
+        total_receitas = transacoes['receitas']
+        total_despesas = transacoes['despesas']
+        total_orcamentos = orcamentos['quantidade']
+        valor_orcamentos = orcamentos['valor']
+        aprovados = orcamentos['aprovados']
         
-        return {
+        dados_cache[(inicio_str, fim_str)] = {
             'receitas': total_receitas,
             'despesas': total_despesas,
             'lucro': total_receitas - total_despesas,
@@ -9516,6 +11092,7 @@ async def relatorio_comparativo(company_id: str):
             'aprovados': aprovados,
             'taxa_conversao': (aprovados / total_orcamentos * 100) if total_orcamentos > 0 else 0
         }
+        return dados_cache[(inicio_str, fim_str)]
     
     # Buscar dados de cada período
     dados_atual = await get_dados_periodo(inicio_mes_atual, fim_mes_atual)
@@ -9635,16 +11212,13 @@ async def relatorio_pareto(company_id: str, tipo: str = 'clientes'):
         clientes_dict = {c.get('id'): c.get('nome', 'Cliente') for c in clientes}
         
         # Buscar orçamentos aprovados
-        orcamentos = await db.orcamentos.find({
-            "company_id": company_id,
-            "status": {"$in": ["aprovado", "Aprovado", "APROVADO", "finalizado"]}
+        orcamentos = await tenant_find("orcamentos", company_id, {
+            "status": "APROVADO"
         }, {"_id": 0}).to_list(10000)
         
         # Se não tiver aprovados, buscar todos
         if not orcamentos:
-            orcamentos = await db.orcamentos.find({
-                "company_id": company_id
-            }, {"_id": 0}).to_list(10000)
+            orcamentos = await tenant_find("orcamentos", company_id).to_list(10000)
         
         # Agrupar por cliente
         valores_cliente = defaultdict(float)
@@ -9687,9 +11261,7 @@ async def relatorio_pareto(company_id: str, tipo: str = 'clientes'):
     
     elif tipo == 'servicos':
         # Buscar serviços dos orçamentos
-        orcamentos = await db.orcamentos.find({
-            "company_id": company_id
-        }, {"_id": 0}).to_list(10000)
+        orcamentos = await tenant_find("orcamentos", company_id).to_list(10000)
         
         valores_srv = defaultdict(float)
         for orc in orcamentos:
@@ -9775,7 +11347,7 @@ async def relatorio_aging_receber(company_id: str):
     contas = await db.contas.find({
         "company_id": company_id,
         "tipo": "RECEBER",
-        "status": {"$nin": ["RECEBIDO", "PAGO", "CANCELADO"]}
+        "status": {"$in": CONTAS_STATUS_EM_ABERTO}
     }, {"_id": 0}).to_list(1000)
     
     # Definir faixas
@@ -9928,7 +11500,7 @@ async def relatorio_despesas_categoria(
         mes_transacoes = await db.transactions.find({
             "company_id": company_id,
             "type": "despesa",
-            "date": {"$regex": f"^{mes_str}"}
+            "date": month_range(mes_str)
         }, {"_id": 0}).to_list(1000)
         
         com = 0
@@ -10770,10 +12342,10 @@ async def preview_importacao_plano_contas(empresa_id: str):
     }
 
 
-@api_router.post("/custos-fixos/importar/{empresa_id}")
-async def importar_do_plano_contas(empresa_id: str, categorias_ids: List[str] = Body(..., embed=True)):
+async def importar_categorias_plano_contas(empresa_id: str, categorias_ids: List[str], on_progress=None) -> dict:
     """
     Importar categorias selecionadas do Plano de Contas como Custos Fixos Recorrentes.
+    on_progress(processadas, total) é chamado a cada categoria.
     """
     if not categorias_ids:
         raise HTTPException(status_code=400, detail="Nenhuma categoria selecionada")
@@ -10783,7 +12355,7 @@ async def importar_do_plano_contas(empresa_id: str, categorias_ids: List[str] =
         "company_id": empresa_id,
         "id": {"$in": categorias_ids},
         "active": True
-    }, {"_id": 0}).to_list(100)
+    }, {"_id": 0}).to_list(len(categorias_ids))
     
     if not categorias:
         raise HTTPException(status_code=404, detail="Categorias não encontradas")
@@ -10808,7 +12380,10 @@ async def importar_do_plano_contas(empresa_id: str, categorias_ids: List[str] =
     custos_criados = []
     custos_ignorados = []
     
-    for cat in categorias:
+    for idx, cat in enumerate(categorias):
+        if on_progress:
+            await on_progress(idx, len(categorias))
+        
         # Verificar se já existe
         existente = await db.custos_fixos_recorrentes.find_one({
             "empresa_id": empresa_id,
@@ -10855,6 +12430,38 @@ async def importar_do_plano_contas(empresa_id: str, categorias_ids: List[str] =
     }
 
 
+@api_router.post("/custos-fixos/importar/{empresa_id}")
+async def importar_do_plano_contas(empresa_id: str, categorias_ids: List[str] = Body(..., embed=True)):
+    """
+    Importar categorias selecionadas do Plano de Contas como Custos Fixos Recorrentes.
+    """
+    return await importar_categorias_plano_contas(empresa_id, categorias_ids)
+
+
+async def run_importar_plano_contas_job(job: dict, on_progress) -> dict:
+    """Handler do job de importação do Plano de Contas"""
+    return await importar_categorias_plano_contas(
+        job["company_id"], job["payload"]["categorias_ids"], on_progress
+    )
+
+JOB_HANDLERS["importar_plano_contas"] = run_importar_plano_contas_job
+
+
+@api_router.post("/custos-fixos/importar/{empresa_id}/jobs")
+async def importar_do_plano_contas_job(empresa_id: str, categorias_ids: List[str] = Body(..., embed=True)):
+    """Importar do Plano de Contas em segundo plano; acompanhar em GET /api/jobs/{job_id}"""
+    if not categorias_ids:
+        raise HTTPException(status_code=400, detail="Nenhuma categoria selecionada")
+    
+    job = await enqueue_job(
+        "importar_plano_contas",
+        empresa_id,
+        {"categorias_ids": categorias_ids},
+        total=len(categorias_ids)
+    )
+    return {"message": "Importação iniciada", "job_id": job["id"], "job": job}
+
+
 # ========== ENDPOINT: GPS FINANCEIRO - DADOS COMPLETOS ==========
 
 @api_router.get("/gps-financeiro/{empresa_id}")
@@ -10925,7 +12532,7 @@ async def calcular_gps_financeiro(empresa_id: str, mes: Optional[str] = None):
         "company_id": empresa_id,
         "tipo": "RECEBER",
         "status": "PAGO",
-        "data_pagamento": {"$regex": f"^{mes}"}
+        "data_pagamento": month_range(mes)
     }, {"_id": 0, "valor": 1, "data_pagamento": 1}).to_list(1000)
     
     receita_realizada = sum(c["valor"] for c in contas_receber)
@@ -10940,10 +12547,9 @@ async def calcular_gps_financeiro(empresa_id: str, mes: Optional[str] = None):
     receita_prevista = 0
     
     # Orçamentos aprovados
-    orcamentos_aprovados = await db.orcamentos.find({
-        "empresa_id": empresa_id,
-        "status": {"$in": ["APROVADO", "aprovado"]},
-        "created_at": {"$regex": f"^{mes}"}
+    orcamentos_aprovados = await tenant_find("orcamentos", empresa_id, {
+        "status": "APROVADO",
+        "created_at": month_range(mes)
     }, {"_id": 0, "preco_praticado": 1}).to_list(100)
     
     receita_orcamentos = sum(orc.get("preco_praticado", 0) for orc in orcamentos_aprovados)
@@ -10953,7 +12559,7 @@ async def calcular_gps_financeiro(empresa_id: str, mes: Optional[str] = None):
         "company_id": empresa_id,
         "tipo": "RECEBER",
         "status": "PENDENTE",
-        "data_vencimento": {"$regex": f"^{mes}"}
+        "data_vencimento": month_range(mes)
     }, {"_id": 0, "valor": 1}).to_list(1000)
     
     receita_contas_pendentes = sum(c["valor"] for c in contas_pendentes)
@@ -11055,38 +12661,37 @@ async def calcular_gps_financeiro(empresa_id: str, mes: Optional[str] = None):
     }
 
 
-@api_router.post("/gps-financeiro/gerar-contas-pagar/{empresa_id}")
-async def gerar_contas_pagar_recorrentes(empresa_id: str, mes: Optional[str] = None):
+RECURRING_CONTAS_CHECK_INTERVAL = int(os.environ.get("RECURRING_CONTAS_CHECK_INTERVAL", "3600"))
+
+
+async def gerar_contas_recorrentes_empresa(empresa_id: str, mes: str) -> dict:
     """
-    Gerar contas a pagar automaticamente a partir dos custos fixos recorrentes.
-    Usado no início de cada mês ou quando solicitado.
+    Gerar as contas a pagar do mês a partir dos custos fixos recorrentes ativos.
+    Carrega os custo_fixo_id já gerados no mês em uma consulta e grava as
+    faltantes com um insert_many. O _id de cada conta é determinístico
+    (custo fixo + mês): execuções concorrentes não duplicam contas.
     """
     from datetime import datetime as dt
     
-    # Definir mês de geração
-    if not mes:
-        mes = dt.now().strftime("%Y-%m")
-    
-    ano, mes_num = int(mes.split("-")[0]), int(mes.split("-")[1])
-    
     # Buscar custos fixos recorrentes ativos
     custos_fixos = await db.custos_fixos_recorrentes.find(
         {"empresa_id": empresa_id, "status": "ativo"},
         {"_id": 0}
-    ).to_list(100)
+    ).to_list(None)
+    
+    # Custos que já têm conta gerada neste mês
+    ja_gerados = set(await db.contas.distinct("custo_fixo_id", {
+        "company_id": empresa_id,
+        "custo_fixo_id": {"$in": [c["id"] for c in custos_fixos]},
+        "data_vencimento": month_range(mes)
+    }))
     
+    novas_contas = []
     contas_geradas = []
     contas_existentes = 0
     
     for custo in custos_fixos:
-        # Verificar se já existe conta gerada para este custo neste mês
-        conta_existente = await db.contas.find_one({
-            "company_id": empresa_id,
-            "custo_fixo_id": custo["id"],
-            "data_vencimento": {"$regex": f"^{mes}"}
-        })
-        
-        if conta_existente:
+        if custo["id"] in ja_gerados:
             contas_existentes += 1
             continue
         
@@ -11102,6 +12707,7 @@ async def gerar_contas_pagar_recorrentes(empresa_id: str, mes: Optional[str] = N
         
         # Criar conta a pagar
         conta = Conta(
+            id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"custo_fixo:{custo['id']}:{mes}")),
             company_id=empresa_id,
             user_id="sistema",  # Gerado automaticamente
             tipo="PAGAR",
@@ -11116,17 +12722,31 @@ async def gerar_contas_pagar_recorrentes(empresa_id: str, mes: Optional[str] = N
         )
         
         doc = conta.model_dump()
+        doc["_id"] = doc["id"]
         doc["custo_fixo_id"] = custo["id"]  # Vínculo com o custo fixo original
         doc["created_at"] = doc["created_at"].isoformat()
         doc["updated_at"] = doc["updated_at"].isoformat()
         
-        await db.contas.insert_one(doc)
+        novas_contas.append(doc)
         contas_geradas.append({
             "descricao": custo["descricao"],
             "valor": valor,
             "vencimento": data_vencimento
         })
     
+    if novas_contas:
+        try:
+            await db.contas.insert_many(novas_contas, ordered=False)
+        except BulkWriteError as e:
+            # Duplicadas: outra execução gerou as mesmas contas ao mesmo tempo
+            duplicadas = {novas_contas[err["index"]]["custo_fixo_id"] for err in e.details.get("writeErrors", []) if err.get("code") == 11000}
+            if len(duplicadas) < len(e.details.get("writeErrors", [])):
+                raise
+            contas_existentes += len(duplicadas)
+            contas_geradas = [
+                g for g, d in zip(contas_geradas, novas_contas) if d["custo_fixo_id"] not in duplicadas
+            ]
+    
     return {
         "mes": mes,
         "contas_geradas": len(contas_geradas),
@@ -11135,6 +12755,81 @@ async def gerar_contas_pagar_recorrentes(empresa_id: str, mes: Optional[str] = N
     }
 
 
+async def gerar_contas_recorrentes_todas_empresas(mes: Optional[str] = None, empresas: Optional[List[str]] = None) -> dict:
+    """Gerar as contas recorrentes do mês para as empresas informadas (padrão: todas com custos fixos ativos)"""
+    if not mes:
+        mes = datetime.now().strftime("%Y-%m")
+    
+    if empresas is None:
+        empresas = await db.custos_fixos_recorrentes.distinct("empresa_id", {"status": "ativo"})
+    total_geradas = 0
+    falhas = []
+    
+    for empresa_id in empresas:
+        try:
+            resultado = await gerar_contas_recorrentes_empresa(empresa_id, mes)
+            total_geradas += resultado["contas_geradas"]
+        except Exception as e:
+            logger.error(f"❌ Erro ao gerar contas recorrentes da empresa {empresa_id}: {e}")
+            falhas.append(empresa_id)
+    
+    logger.info(f"✅ Contas recorrentes de {mes}: {total_geradas} geradas em {len(empresas)} empresas")
+    return {"mes": mes, "empresas": len(empresas), "contas_geradas": total_geradas, "falhas": falhas}
+
+
+async def gerar_contas_recorrentes_do_mes() -> dict:
+    """
+    Tarefa agendada: gerar as contas recorrentes do mês.
+    O mês só é dado como concluído em db.contas_recorrentes_runs depois de uma
+    execução terminada sem falhas; até lá cada execução tenta de novo (só as
+    empresas que falharam, se a anterior terminou). A geração é idempotente
+    (ids determinísticos), então execuções repetidas ou concorrentes não duplicam contas.
+    """
+    mes = datetime.now().strftime("%Y-%m")
+    run = await db.contas_recorrentes_runs.find_one({"_id": mes}, {"finished_at": 1, "resultado.falhas": 1})
+    empresas = None
+    if run and run.get("finished_at"):
+        falhas = (run.get("resultado") or {}).get("falhas") or []
+        if not falhas:
+            return {"mes": mes, "executado": False}
+        empresas = falhas
+    
+    agora = datetime.now(timezone.utc).isoformat()
+    await db.contas_recorrentes_runs.update_one(
+        {"_id": mes},
+        {"$set": {"started_at": agora}, "$unset": {"finished_at": ""}},
+        upsert=True
+    )
+    resultado = await gerar_contas_recorrentes_todas_empresas(mes, empresas)
+    await db.contas_recorrentes_runs.update_one(
+        {"_id": mes},
+        {"$set": {"finished_at": datetime.now(timezone.utc).isoformat(), "resultado": resultado}}
+    )
+    return {**resultado, "executado": True}
+
+
+@api_router.post("/gps-financeiro/gerar-contas-pagar/{empresa_id}")
+async def gerar_contas_pagar_recorrentes(empresa_id: str, mes: Optional[str] = None):
+    """
+    Gerar contas a pagar automaticamente a partir dos custos fixos recorrentes.
+    Usado no início de cada mês ou quando solicitado.
+    """
+    from datetime import datetime as dt
+    
+    # Definir mês de geração
+    if not mes:
+        mes = dt.now().strftime("%Y-%m")
+    
+    return await gerar_contas_recorrentes_empresa(empresa_id, mes)
+
+
+@api_router.post("/admin/gerar-contas-recorrentes")
+async def admin_gerar_contas_recorrentes(user_id: str, mes: Optional[str] = None):
+    """Gerar as contas recorrentes do mês para todas as empresas"""
+    await verify_admin(user_id)
+    return await gerar_contas_recorrentes_todas_empresas(mes)
+
+
 # ========== ROTAS: SUPERVISOR / CRONOGRAMA ==========
 
 @api_router.post("/supervisor/login")
@@ -11157,7 +12852,7 @@ async def supervisor_login(credentials: dict = Body(...)):
         raise HTTPException(status_code=401, detail="Credenciais inválidas ou supervisor inativo")
     
     # Buscar dados da empresa (pode estar em 'companies' ou 'empresas')
-    empresa = await db.companies.find_one({"id": funcionario["empresa_id"]}, {"_id": 0})
+    empresa = await get_company_cached(funcionario["empresa_id"])
     if not empresa:
         empresa = await db.empresas.find_one({"id": funcionario["empresa_id"]}, {"_id": 0})
     
@@ -11193,14 +12888,10 @@ async def listar_orcamentos_aprovados(supervisor_id: str):
     
     empresa_id = supervisor["empresa_id"]
     
-    # Buscar orçamentos aprovados (pode ser empresa_id ou company_id dependendo da versão)
-    orcamentos = await db.orcamentos.find({
-        "$or": [
-            {"empresa_id": empresa_id},
-            {"company_id": empresa_id}
-        ],
+    # Buscar orçamentos aprovados
+    orcamentos = await tenant_find("orcamentos", empresa_id, {
         "status": "APROVADO"
-    }, {"_id": 0}).sort("created_at", -1).to_list(100)
+    }).sort("created_at", -1).to_list(100)
     
     return orcamentos
 
@@ -11363,14 +13054,17 @@ async def upload_media_cronograma(
     
     # Gerar nome único
     ext = Path(file.filename).suffix if file.filename else (".jpg" if tipo == "image" else ".webm")
-    filename = f"cronograma_{tipo}_{uuid.uuid4()}{ext}"
-    
-    # Salvar arquivo
-    file_path = uploads_dir / filename
+    stem = f"cronograma_{tipo}_{uuid.uuid4()}"
     
     content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
+    if tipo == "image":
+        # Fotos: reduzir, remover metadados
+        filename, _ = await save_uploaded_image(content, uploads_dir, stem, ext, renditions=())
+    else:
+        # Salvar arquivo
+        filename = f"{stem}{ext}"
+        async with aiofiles.open(uploads_dir / filename, 'wb') as f:
+            await f.write(content)
     
     # Retornar URL - usar BACKEND_URL do ambiente com prefixo /api/uploads
     base_url = os.environ.get("BACKEND_URL", os.environ.get("REACT_APP_BACKEND_URL", ""))
@@ -11450,7 +13144,7 @@ async def gerar_link_supervisor(funcionario_id: str):
         raise HTTPException(status_code=400, detail="Configure o login do supervisor primeiro")
     
     # Buscar a empresa para obter o app_url e slug
-    empresa = await db.companies.find_one({"id": funcionario.get("empresa_id")}, {"_id": 0})
+    empresa = await get_company_cached(funcionario.get("empresa_id"))
     
     # Usar app_url da empresa se disponível, senão usar variável de ambiente
     if empresa and empresa.get("app_url"):
@@ -11633,26 +13327,49 @@ async def serve_cliente_manifest():
     return FileResponse(file_path, media_type="application/json")
 
 
-# ========== ENDPOINTS: APP DO VENDEDOR ==========
+# ========== SHELL DOS PWAs (VENDEDOR / SUPERVISOR) ==========
+# O HTML base fica em memória (relido quando o mtime do arquivo muda) e o
+# HTML de cada slug, já com o script da empresa, é guardado pronto e
+# pré-comprimido (gzip e, se disponível, brotli). O ETag permite que o
+# navegador revalide com If-None-Match e receba 304 sem corpo.
 
-# ===== ROTAS COM SLUG (Multi-tenant) =====
+PWA_SHELL_CACHE_MAX_ENTRIES = int(os.environ.get("PWA_SHELL_CACHE_MAX_ENTRIES", "500"))
 
-@api_router.get("/app/{slug}/vendedor")
-async def serve_vendedor_app_by_slug(slug: str):
-    """Servir página PWA do vendedor com validação de empresa"""
-    # Verificar se empresa existe
-    empresa = await db.companies.find_one({"slug": slug}, {"_id": 0})
-    if not empresa:
-        raise HTTPException(status_code=404, detail="Empresa não encontrada")
-    
-    file_path = static_dir / "vendedor.html"
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Página não encontrada")
-    
-    # Ler o HTML e injetar o slug da empresa
-    async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
-        html_content = await f.read()
+_pwa_templates = {}  # arquivo -> {"mtime", "html"}
+_pwa_shells = OrderedDict()  # (arquivo, slug) -> HTML renderizado e variantes comprimidas
+pwa_shell_stats = {"hits": 0, "misses": 0, "not_modified": 0, "template_reloads": 0}
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Se o If-None-Match da requisição corresponde ao ETag (comparação fraca)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+async def _pwa_template(file_name: str) -> Optional[tuple]:
+    """(mtime, HTML) do arquivo base, relido só quando o arquivo muda"""
+    file_path = static_dir / file_name
+    try:
+        mtime = file_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
     
+    cached = _pwa_templates.get(file_name)
+    if cached is None or cached["mtime"] != mtime:
+        async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
+            html = await f.read()
+        cached = {"mtime": mtime, "html": html}
+        _pwa_templates[file_name] = cached
+        pwa_shell_stats["template_reloads"] += 1
+    return cached["mtime"], cached["html"]
+
+
+def _render_pwa_shell(html_content: str, slug: str, empresa: dict) -> dict:
+    """Injetar o script da empresa e preparar as variantes comprimidas"""
     # Injetar script com dados da empresa no início do body
     empresa_script = f'''<script>
     window.EMPRESA_SLUG = "{slug}";
@@ -11660,37 +13377,80 @@ async def serve_vendedor_app_by_slug(slug: str):
     window.EMPRESA_NOME = "{empresa.get('name', '')}";
     </script>'''
     
-    html_content = html_content.replace('<body>', f'<body>\n{empresa_script}')
-    
-    return HTMLResponse(content=html_content, media_type="text/html")
+    body = html_content.replace('<body>', f'<body>\n{empresa_script}').encode('utf-8')
+    return {
+        "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        "identity": body,
+        "gzip": gzip.compress(body, compresslevel=9),
+        "br": brotli.compress(body, quality=11) if brotli else None,
+    }
 
 
-@api_router.get("/app/{slug}/supervisor")
-async def serve_supervisor_app_by_slug(slug: str):
-    """Servir página PWA do supervisor com validação de empresa"""
+async def serve_pwa_shell(request: Request, slug: str, file_name: str) -> Response:
+    """Responder o shell do PWA da empresa (cache em memória, ETag/304, gzip/brotli)"""
     # Verificar se empresa existe
-    empresa = await db.companies.find_one({"slug": slug}, {"_id": 0})
+    empresa = await get_company_by_slug(slug)
     if not empresa:
         raise HTTPException(status_code=404, detail="Empresa não encontrada")
     
-    file_path = static_dir / "supervisor.html"
-    if not file_path.exists():
+    template = await _pwa_template(file_name)
+    if template is None:
         raise HTTPException(status_code=404, detail="Página não encontrada")
-    
-    # Ler o HTML e injetar o slug da empresa
-    async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
-        html_content = await f.read()
-    
-    # Injetar script com dados da empresa no início do body
-    empresa_script = f'''<script>
-    window.EMPRESA_SLUG = "{slug}";
-    window.EMPRESA_ID = "{empresa.get('id', '')}";
-    window.EMPRESA_NOME = "{empresa.get('name', '')}";
-    </script>'''
-    
-    html_content = html_content.replace('<body>', f'<body>\n{empresa_script}')
-    
-    return HTMLResponse(content=html_content, media_type="text/html")
+    mtime, html_content = template
+    
+    # A versão renderizada vale enquanto o arquivo e os dados injetados não mudarem
+    version = (mtime, empresa.get('id'), empresa.get('name'))
+    key = (file_name, slug)
+    shell = _pwa_shells.get(key)
+    if shell is not None and shell["version"] == version:
+        _pwa_shells.move_to_end(key)
+        pwa_shell_stats["hits"] += 1
+    else:
+        pwa_shell_stats["misses"] += 1
+        shell = {"version": version, **_render_pwa_shell(html_content, slug, empresa)}
+        _pwa_shells[key] = shell
+        while len(_pwa_shells) > PWA_SHELL_CACHE_MAX_ENTRIES:
+            _pwa_shells.popitem(last=False)
+    
+    # no-cache: o navegador guarda o shell, mas revalida (304) a cada abertura
+    headers = {"ETag": shell["etag"], "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request, shell["etag"]):
+        pwa_shell_stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    
+    accept_encoding = request.headers.get("accept-encoding", "")
+    content = shell["identity"]
+    if shell["br"] is not None and "br" in accept_encoding:
+        content = shell["br"]
+        headers["Content-Encoding"] = "br"
+    elif "gzip" in accept_encoding:
+        content = shell["gzip"]
+        headers["Content-Encoding"] = "gzip"
+    
+    return Response(content=content, media_type="text/html; charset=utf-8", headers=headers)
+
+
+@api_router.get("/admin/pwa-shell-cache")
+async def admin_pwa_shell_cache_stats(user_id: str):
+    """Métricas do cache de shells dos PWAs"""
+    await verify_admin(user_id)
+    return {**pwa_shell_stats, "entries": len(_pwa_shells), "brotli": brotli is not None}
+
+
+# ========== ENDPOINTS: APP DO VENDEDOR ==========
+
+# ===== ROTAS COM SLUG (Multi-tenant) =====
+
+@api_router.get("/app/{slug}/vendedor")
+async def serve_vendedor_app_by_slug(slug: str, request: Request):
+    """Servir página PWA do vendedor com validação de empresa"""
+    return await serve_pwa_shell(request, slug, "vendedor.html")
+
+
+@api_router.get("/app/{slug}/supervisor")
+async def serve_supervisor_app_by_slug(slug: str, request: Request):
+    """Servir página PWA do supervisor com validação de empresa"""
+    return await serve_pwa_shell(request, slug, "supervisor.html")
 
 
 @api_router.get("/app/{slug}/info")
@@ -11776,7 +13536,7 @@ async def vendedor_login(credentials: dict = Body(...)):
             raise HTTPException(status_code=403, detail="Acesso permitido apenas para vendedores")
     
     # Buscar empresa
-    empresa = await db.companies.find_one({"id": funcionario["empresa_id"]}, {"_id": 0})
+    empresa = await get_company_cached(funcionario["empresa_id"])
     
     # Se slug foi fornecido, validar que o funcionário pertence a essa empresa
     if empresa_slug and empresa:
@@ -12080,15 +13840,20 @@ async def upload_media_vendedor(file: UploadFile = File(...)):
         upload_dir = Path(ROOT_DIR) / "uploads" / "vendedor"
         upload_dir.mkdir(parents=True, exist_ok=True)
         
-        # Gerar nome único
+        # Gerar nome único (áudio com prefixo, para ser servido como audio/*)
         ext = Path(file.filename).suffix.lower() if file.filename else ".bin"
-        filename = f"{uuid.uuid4()}{ext}"
-        file_path = upload_dir / filename
+        is_audio = (file.content_type or "").startswith("audio/")
+        stem = f"audio_{uuid.uuid4()}" if is_audio else str(uuid.uuid4())
         
-        # Salvar arquivo
         content = await file.read()
-        async with aiofiles.open(file_path, 'wb') as f:
-            await f.write(content)
+        if (file.content_type or "").startswith("image/"):
+            # Fotos: reduzir, remover metadados
+            filename, _ = await save_uploaded_image(content, upload_dir, stem, ext, renditions=())
+        else:
+            # Salvar arquivo
+            filename = f"{stem}{ext}"
+            async with aiofiles.open(upload_dir / filename, 'wb') as f:
+                await f.write(content)
         
         # Retornar URL
         base_url = os.environ.get("REACT_APP_BACKEND_URL", "")
@@ -12100,20 +13865,130 @@ async def upload_media_vendedor(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@api_router.get("/uploads/vendedor/{filename}")
-async def serve_vendedor_upload(filename: str):
-    """Servir arquivos de upload do vendedor"""
-    file_path = Path(ROOT_DIR) / "uploads" / "vendedor" / filename
+# ===== ARQUIVOS DE UPLOAD (CACHE HTTP E RANGE) =====
+# Os nomes dos uploads são únicos (uuid) e nunca são regravados, então o
+# navegador pode guardá-los indefinidamente. ETag + If-None-Match evitam
+# baixar de novo quando o cache é revalidado, e Range permite avançar no
+# áudio do diário sem baixar o arquivo inteiro.
+
+UPLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"
+UPLOAD_RANGE_CHUNK_SIZE = 64 * 1024
+
+# Tipos por extensão, resolvidos uma vez (mimetypes não conhece alguns formatos de áudio)
+UPLOAD_CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".svg": "image/svg+xml",
+    ".pdf": "application/pdf",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".aac": "audio/aac",
+    ".ogg": "audio/ogg",
+    ".oga": "audio/ogg",
+    ".opus": "audio/ogg",
+    ".wav": "audio/wav",
+    ".webm": "video/webm",
+    ".mp4": "video/mp4",
+    ".mov": "video/quicktime",
+}
+
+# Prefixos dados no upload aos arquivos de áudio (cronograma e vendedor)
+UPLOAD_AUDIO_PREFIXES = ("cronograma_audio_", "audio_")
+
+
+def upload_content_type(filename: str) -> str:
+    """Content-type do upload pela extensão; áudio gravado em contêiner de vídeo (.webm, .mp4) é audio/*"""
+    ext = Path(filename).suffix.lower()
+    if ext not in UPLOAD_CONTENT_TYPES:
+        UPLOAD_CONTENT_TYPES[ext] = mimetypes.guess_type(f"arquivo{ext}")[0] or "application/octet-stream"
+    content_type = UPLOAD_CONTENT_TYPES[ext]
+    if content_type.startswith("video/") and filename.startswith(UPLOAD_AUDIO_PREFIXES):
+        return "audio/" + content_type.split("/", 1)[1]
+    return content_type
+
+
+def parse_byte_range(header: Optional[str], size: int) -> Optional[tuple]:
+    """(início, fim) inclusivos de um Range 'bytes=' simples; None para servir o arquivo inteiro"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_str, _, end_str = header[6:].strip().partition("-")
+    try:
+        if not start_str:
+            # Sufixo: os últimos N bytes
+            length = int(end_str)
+            if length <= 0:
+                return None
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+    except ValueError:
+        return None
     
-    if not file_path.exists():
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Intervalo inválido",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, min(end, size - 1)
+
+
+async def _stream_file_range(path: Path, start: int, length: int):
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(UPLOAD_RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve_upload_file(request: Request, file_path: Path) -> Response:
+    """Responder um upload com cache imutável, ETag/304 e Range (206)"""
+    try:
+        stat_result = file_path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Arquivo não encontrado")
+    if not file_path.is_file():
         raise HTTPException(status_code=404, detail="Arquivo não encontrado")
     
-    import mimetypes
-    content_type, _ = mimetypes.guess_type(str(file_path))
-    if not content_type:
-        content_type = 'application/octet-stream'
+    etag = f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+    headers = {"ETag": etag, "Cache-Control": UPLOAD_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    content_type = upload_content_type(file_path.name)
+    
+    # If-Range com outro ETag: o arquivo mudou, responder inteiro
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range.strip() == etag:
+        byte_range = parse_byte_range(request.headers.get("range"), stat_result.st_size)
+    
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            _stream_file_range(file_path, start, end - start + 1),
+            status_code=206,
+            media_type=content_type,
+            headers=headers
+        )
     
-    return FileResponse(file_path, media_type=content_type)
+    return FileResponse(file_path, media_type=content_type, headers=headers, stat_result=stat_result)
+
+
+@api_router.get("/uploads/vendedor/{filename}")
+async def serve_vendedor_upload(filename: str, request: Request):
+    """Servir arquivos de upload do vendedor"""
+    return serve_upload_file(request, Path(ROOT_DIR) / "uploads" / "vendedor" / filename)
 
 
 @api_router.get("/funcionario/{funcionario_id}/link-vendedor")
@@ -12127,7 +14002,7 @@ async def gerar_link_vendedor(funcionario_id: str):
         raise HTTPException(status_code=400, detail="Configure o login do vendedor primeiro")
     
     # Buscar a empresa para obter o app_url e slug
-    empresa = await db.companies.find_one({"id": funcionario.get("empresa_id")}, {"_id": 0})
+    empresa = await get_company_cached(funcionario.get("empresa_id"))
     
     # Usar app_url da empresa se disponível, senão usar variável de ambiente
     if empresa and empresa.get("app_url"):
@@ -12173,20 +14048,197 @@ uploads_dir = Path(ROOT_DIR) / "uploads"
 uploads_dir.mkdir(exist_ok=True)
 
 @api_router.get("/uploads/{filename}")
-async def serve_upload(filename: str):
+async def serve_upload(filename: str, request: Request):
     """Servir arquivos de upload com content-type correto"""
-    file_path = uploads_dir / filename
-    
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Arquivo não encontrado")
-    
-    # Detectar content-type baseado na extensão
-    import mimetypes
-    content_type, _ = mimetypes.guess_type(str(file_path))
-    if not content_type:
-        content_type = 'application/octet-stream'
-    
-    return FileResponse(file_path, media_type=content_type)
+    return serve_upload_file(request, uploads_dir / filename)
+
+
+# ========== AGENDADOR DE TAREFAS PERIÓDICAS ==========
+# Manutenções que antes só aconteciam sob demanda rodam em um loop asyncio.
+# Com várias réplicas, apenas a líder executa: a liderança é um documento
+# em db.scheduler_locks renovado a cada ciclo (expira se a líder cair).
+# Cada execução é registrada em db.scheduler_runs com duração e resultado.
+
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_TICK_SECONDS = int(os.environ.get("SCHEDULER_TICK_SECONDS", "60"))
+SCHEDULER_LOCK_TTL_SECONDS = int(os.environ.get("SCHEDULER_LOCK_TTL_SECONDS", "180"))
+SCHEDULER_LOCK_ID = "scheduler"
+
+_scheduler_instance_id = str(uuid.uuid4())
+_scheduler_task: Optional[asyncio.Task] = None
+scheduler_stats = {"is_leader": False, "last_tick_at": None}
+
+
+async def expirar_trials_vencidos() -> dict:
+    """Marcar como expired os trials com trial_end no passado (mesma regra de check_and_update_trial_status)"""
+    result = await db.subscriptions.update_many(
+        {"status": "trial", "trial_end": {"$lt": datetime.now(timezone.utc).isoformat()}},
+        {"$set": {"status": "expired"}}
+    )
+    return {"expirados": result.modified_count}
+
+
+async def marcar_contas_atrasadas() -> dict:
+    """Varredura diária PENDENTE -> ATRASADO (no-op se já feita hoje)"""
+    return {"atrasadas": await varrer_contas_atrasadas()}
+
+
+async def fechar_meses_markup() -> dict:
+    """
+    Fechar os perfis de markup de meses anteriores que nunca foram fechados
+    (como close_markup_month). Meses já fechados alguma vez (closed_at) ou
+    reabertos pelo usuário (reopened_at) ficam como estão.
+    """
+    hoje = datetime.now()
+    agora = datetime.now(timezone.utc).isoformat()
+    result = await db.markup_profiles.update_many(
+        {
+            "is_closed": {"$ne": True},
+            "closed_at": {"$exists": False},
+            "reopened_at": {"$exists": False},
+            "$or": [
+                {"year": {"$lt": hoje.year}},
+                {"year": hoje.year, "month": {"$lt": hoje.month}}
+            ]
+        },
+        {"$set": {"is_closed": True, "closed_at": agora, "updated_at": agora}}
+    )
+    return {"fechados": result.modified_count}
+
+
+# nome -> (intervalo em segundos, async função sem argumentos que retorna um dict)
+SCHEDULED_TASKS = {
+    "expirar_trials": (3600, expirar_trials_vencidos),
+    "contas_atrasadas": (3600, marcar_contas_atrasadas),
+    "contas_recorrentes": (RECURRING_CONTAS_CHECK_INTERVAL, gerar_contas_recorrentes_do_mes),
+    "fechar_meses_markup": (6 * 3600, fechar_meses_markup),
+    "recuperar_jobs": (300, recuperar_jobs_pendentes),
+}
+
+
+async def acquire_scheduler_lock() -> bool:
+    """Assumir ou renovar a liderança do agendador"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.scheduler_locks.find_one_and_update(
+            {
+                "_id": SCHEDULER_LOCK_ID,
+                "$or": [{"owner": _scheduler_instance_id}, {"expires_at": {"$lt": now}}]
+            },
+            {"$set": {
+                "owner": _scheduler_instance_id,
+                "expires_at": now + timedelta(seconds=SCHEDULER_LOCK_TTL_SECONDS),
+                "renewed_at": now
+            }},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Lock válido de outra instância (o upsert tentou inserir o mesmo _id)
+        return False
+
+
+async def run_scheduled_task(name: str, trigger: str = "agendado") -> dict:
+    """Executar uma tarefa agendada e registrar a execução"""
+    interval, fn = SCHEDULED_TASKS[name]
+    started_at = datetime.now(timezone.utc)
+    inicio = time.monotonic()
+    run = {
+        "id": str(uuid.uuid4()),
+        "task": name,
+        "trigger": trigger,
+        "instance_id": _scheduler_instance_id,
+        "started_at": started_at.isoformat(),
+    }
+    try:
+        run["result"] = await fn()
+        run["status"] = "sucesso"
+    except Exception as e:
+        logger.error(f"❌ Tarefa agendada {name} falhou: {e}")
+        run["status"] = "erro"
+        run["error"] = str(e)
+    
+    run["duration_ms"] = round((time.monotonic() - inicio) * 1000, 1)
+    run["finished_at"] = datetime.now(timezone.utc).isoformat()
+    await db.scheduler_runs.insert_one(dict(run))
+    await db.scheduler_state.update_one(
+        {"_id": name},
+        {"$set": {
+            "last_run_at": started_at,
+            "last_status": run["status"],
+            "last_duration_ms": run["duration_ms"],
+            "next_run_at": started_at + timedelta(seconds=interval)
+        }},
+        upsert=True
+    )
+    return run
+
+
+async def _scheduler_loop():
+    """Loop do agendador: a cada ciclo renova a liderança e roda as tarefas vencidas"""
+    while True:
+        try:
+            scheduler_stats["last_tick_at"] = datetime.now(timezone.utc).isoformat()
+            scheduler_stats["is_leader"] = await acquire_scheduler_lock()
+            if scheduler_stats["is_leader"]:
+                now = datetime.now(timezone.utc)
+                states = {
+                    st["_id"]: st
+                    async for st in db.scheduler_state.find({"_id": {"$in": list(SCHEDULED_TASKS)}})
+                }
+                for name in SCHEDULED_TASKS:
+                    next_run_at = states.get(name, {}).get("next_run_at")
+                    if next_run_at and next_run_at.replace(tzinfo=timezone.utc) > now:
+                        continue
+                    await run_scheduled_task(name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"⚠️ Erro no agendador: {e}")
+        await asyncio.sleep(SCHEDULER_TICK_SECONDS)
+
+
+@app.on_event("startup")
+async def start_scheduler():
+    global _scheduler_task
+    if SCHEDULER_ENABLED:
+        _scheduler_task = asyncio.create_task(_scheduler_loop())
+
+
+@api_router.get("/admin/scheduler")
+async def admin_scheduler_status(user_id: str, limit: int = 20):
+    """Estado do agendador: liderança, próxima execução de cada tarefa e últimas execuções"""
+    await verify_admin(user_id)
+    lock = await db.scheduler_locks.find_one({"_id": SCHEDULER_LOCK_ID})
+    states = await db.scheduler_state.find({}).to_list(None)
+    runs = await db.scheduler_runs.find({}, {"_id": 0}).sort("started_at", -1).to_list(limit)
+    return {
+        "enabled": SCHEDULER_ENABLED,
+        "instance_id": _scheduler_instance_id,
+        **scheduler_stats,
+        "leader": lock.get("owner") if lock else None,
+        "lock_expires_at": lock["expires_at"].isoformat() if lock else None,
+        "tasks": {
+            name: {
+                "interval_seconds": interval,
+                **{k: (v.isoformat() if isinstance(v, datetime) else v)
+                   for k, v in next((st for st in states if st["_id"] == name), {}).items() if k != "_id"}
+            }
+            for name, (interval, _) in SCHEDULED_TASKS.items()
+        },
+        "runs": runs
+    }
+
+
+@api_router.post("/admin/scheduler/{task_name}/run")
+async def admin_run_scheduled_task(task_name: str, user_id: str):
+    """Executar uma tarefa agendada imediatamente"""
+    await verify_admin(user_id)
+    if task_name not in SCHEDULED_TASKS:
+        raise HTTPException(status_code=404, detail="Tarefa não encontrada")
+    run = await run_scheduled_task(task_name, trigger="manual")
+    run.pop("_id", None)
+    return run
 
 
 # ========== INCLUIR ROUTER ==========
@@ -12215,4 +14267,12 @@ app.add_middleware(
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    for task in _job_worker_tasks:
+        task.cancel()
+    if _scheduler_task is not None:
+        _scheduler_task.cancel()
+    if _index_build_task is not None:
+        _index_build_task.cancel()
+    await mercado_pago.close()
+    client.close()
+    discard_pdf_render_pool()
\ No newline at end of file
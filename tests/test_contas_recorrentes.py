@@ -0,0 +1,108 @@
+"""Testes da tarefa mensal de contas recorrentes (server.gerar_contas_recorrentes_do_mes)."""
+
+import asyncio
+import copy
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("motor")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_lucro_liquido")
+
+import server  # noqa: E402
+
+
+class FakeCollection:
+    """Coleção em memória com o mínimo usado pela tarefa (find_one, update_one, distinct)"""
+
+    def __init__(self, docs=None):
+        self.docs = {doc["_id"]: doc for doc in docs or []}
+
+    async def find_one(self, query, projection=None):
+        doc = self.docs.get(query["_id"])
+        return copy.deepcopy(doc) if doc else None
+
+    async def update_one(self, query, update, upsert=False):
+        doc = self.docs.get(query["_id"])
+        if doc is None:
+            if not upsert:
+                return
+            doc = self.docs[query["_id"]] = {"_id": query["_id"]}
+        doc.update(copy.deepcopy(update.get("$set", {})))
+        for field in update.get("$unset", {}):
+            doc.pop(field, None)
+
+    async def distinct(self, field, query=None):
+        return sorted({doc[field] for doc in self.docs.values()})
+
+
+class FakeDb:
+    def __init__(self):
+        self.contas_recorrentes_runs = FakeCollection()
+        self.custos_fixos_recorrentes = FakeCollection([
+            {"_id": "c1", "empresa_id": "empresa-a", "status": "ativo"},
+            {"_id": "c2", "empresa_id": "empresa-b", "status": "ativo"},
+        ])
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(server, "db", db)
+    return db
+
+
+def test_failed_company_is_retried_on_next_run(fake_db, monkeypatch):
+    geradas = []
+    falhar = {"empresa-b"}
+
+    async def gerar_empresa(empresa_id, mes):
+        if empresa_id in falhar:
+            raise RuntimeError("Mongo indisponível")
+        geradas.append(empresa_id)
+        return {"mes": mes, "contas_geradas": 1, "contas_existentes": 0, "detalhes": []}
+
+    monkeypatch.setattr(server, "gerar_contas_recorrentes_empresa", gerar_empresa)
+
+    primeira = asyncio.run(server.gerar_contas_recorrentes_do_mes())
+    assert primeira["executado"] is True
+    assert primeira["falhas"] == ["empresa-b"]
+    assert geradas == ["empresa-a"]
+
+    # A empresa volta a funcionar: a próxima execução gera só o que faltou
+    falhar.clear()
+    segunda = asyncio.run(server.gerar_contas_recorrentes_do_mes())
+    assert segunda["executado"] is True
+    assert segunda["falhas"] == []
+    assert geradas == ["empresa-a", "empresa-b"]
+
+    # Mês concluído sem falhas: não executa de novo
+    terceira = asyncio.run(server.gerar_contas_recorrentes_do_mes())
+    assert terceira["executado"] is False
+    assert geradas == ["empresa-a", "empresa-b"]
+
+
+def test_interrupted_run_is_resumed(fake_db, monkeypatch):
+    geradas = []
+
+    async def gerar_empresa(empresa_id, mes):
+        geradas.append(empresa_id)
+        return {"mes": mes, "contas_geradas": 1, "contas_existentes": 0, "detalhes": []}
+
+    monkeypatch.setattr(server, "gerar_contas_recorrentes_empresa", gerar_empresa)
+
+    # Execução anterior registrada mas sem finished_at (processo reiniciado no meio)
+    mes = server.datetime.now().strftime("%Y-%m")
+    asyncio.run(fake_db.contas_recorrentes_runs.update_one(
+        {"_id": mes}, {"$set": {"started_at": "2026-01-01T00:00:00+00:00"}}, upsert=True
+    ))
+
+    resultado = asyncio.run(server.gerar_contas_recorrentes_do_mes())
+    assert resultado["executado"] is True
+    assert geradas == ["empresa-a", "empresa-b"]
@@ -0,0 +1,250 @@
+"""Testes do gateway de IA (backend/llm_gateway.py) com backends locais, sem rede."""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import llm_gateway  # noqa: E402
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Gateway com estado limpo e backend fake"""
+    monkeypatch.setattr(llm_gateway, "LLM_BACKEND", "fake")
+    monkeypatch.setattr(llm_gateway, "_llm_cache", llm_gateway.OrderedDict())
+    monkeypatch.setattr(llm_gateway, "_llm_inflight", {})
+    monkeypatch.setattr(llm_gateway, "_llm_company_slots", {})
+    monkeypatch.setattr(llm_gateway, "llm_stats", {k: 0 for k in llm_gateway.llm_stats})
+    return llm_gateway
+
+
+def use_backend(monkeypatch, gateway, backend):
+    """Registrar um backend de teste e torná-lo o ativo"""
+    monkeypatch.setitem(gateway.LLM_BACKENDS, "teste", backend)
+    monkeypatch.setattr(gateway, "LLM_BACKEND", "teste")
+
+
+def test_fake_backend_is_deterministic(gateway):
+    async def run():
+        first = await gateway.llm_complete("prompt", "sistema", "sessao")
+        gateway._llm_cache.clear()
+        second = await gateway.llm_complete("prompt", "sistema", "sessao")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert first.startswith("[resposta simulada")
+    assert gateway.llm_stats["calls"] == 2
+
+
+def test_cache_hit_skips_backend(gateway):
+    key = gateway.llm_cache_key("term", "ebitda", "construção")
+
+    async def run():
+        first = await gateway.llm_complete("prompt A", "sistema", "s1", cache_key=key)
+        # Prompt diferente com a mesma chave explícita: resposta do cache
+        second = await gateway.llm_complete("prompt B", "sistema", "s2", cache_key=key)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert gateway.llm_stats["calls"] == 1
+    assert gateway.llm_stats["hits"] == 1
+    assert gateway.llm_stats["misses"] == 1
+
+
+def test_cache_expires_after_ttl(gateway, monkeypatch):
+    monkeypatch.setattr(gateway, "LLM_CACHE_TTL_SECONDS", -1)
+
+    async def run():
+        await gateway.llm_complete("prompt", "sistema", "s")
+        await gateway.llm_complete("prompt", "sistema", "s")
+
+    asyncio.run(run())
+    assert gateway.llm_stats["calls"] == 2
+    assert gateway.llm_stats["hits"] == 0
+
+
+def test_identical_inflight_prompts_are_coalesced(gateway, monkeypatch):
+    calls = 0
+
+    async def slow_backend(prompt, system_message, session_id):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return f"resposta {calls}"
+
+    use_backend(monkeypatch, gateway, slow_backend)
+
+    async def run():
+        return await asyncio.gather(*[
+            gateway.llm_complete("mesmo prompt", "sistema", "s", company_id="empresa-1")
+            for _ in range(3)
+        ])
+
+    results = asyncio.run(run())
+    assert results == ["resposta 1"] * 3
+    assert calls == 1
+    assert gateway.llm_stats["coalesced"] == 2
+    assert not gateway._llm_inflight
+
+
+def test_backend_error_reaches_followers_and_is_not_cached(gateway, monkeypatch):
+    async def failing_backend(prompt, system_message, session_id):
+        await asyncio.sleep(0.01)
+        raise RuntimeError("modelo indisponível")
+
+    use_backend(monkeypatch, gateway, failing_backend)
+
+    async def run():
+        return await asyncio.gather(
+            gateway.llm_complete("prompt", "sistema", "s"),
+            gateway.llm_complete("prompt", "sistema", "s"),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert gateway.llm_stats["errors"] == 1
+    assert not gateway._llm_cache
+
+
+def test_cancelled_leader_releases_followers(gateway, monkeypatch):
+    async def hanging_backend(prompt, system_message, session_id):
+        await asyncio.sleep(3600)
+
+    use_backend(monkeypatch, gateway, hanging_backend)
+
+    async def run():
+        leader = asyncio.create_task(gateway.llm_complete("prompt", "sistema", "s"))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(gateway.llm_complete("prompt", "sistema", "s"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        # Sem o cancelamento do future, o seguidor ficaria esperando para sempre
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(follower, timeout=1)
+
+    asyncio.run(run())
+    assert not gateway._llm_inflight
+
+
+def test_concurrency_is_limited_per_company(gateway, monkeypatch):
+    monkeypatch.setattr(gateway, "LLM_MAX_CONCURRENCY_PER_COMPANY", 2)
+    running = {}
+    peak = {}
+
+    async def tracking_backend(prompt, system_message, session_id):
+        company = session_id
+        running[company] = running.get(company, 0) + 1
+        peak[company] = max(peak.get(company, 0), running[company])
+        await asyncio.sleep(0.02)
+        running[company] -= 1
+        return prompt
+
+    use_backend(monkeypatch, gateway, tracking_backend)
+
+    async def run():
+        await asyncio.gather(*[
+            gateway.llm_complete(f"prompt {company} {i}", "sistema", company, company_id=company)
+            for company in ("empresa-1", "empresa-2")
+            for i in range(5)
+        ])
+
+    asyncio.run(run())
+    assert peak == {"empresa-1": 2, "empresa-2": 2}
+    assert gateway.llm_stats["calls"] == 10
+
+
+def collect(stream):
+    async def run():
+        return [chunk async for chunk in stream]
+    return run()
+
+
+def test_stream_caches_full_response(gateway):
+    async def run():
+        chunks = await collect(gateway.llm_stream("prompt", "sistema", "s"))
+        text = await gateway.llm_complete("prompt", "sistema", "s")
+        return chunks, text
+
+    chunks, text = asyncio.run(run())
+    assert len(chunks) > 1
+    assert "".join(chunks) == text
+    assert gateway.llm_stats["calls"] == 1
+    assert gateway.llm_stats["hits"] == 1
+
+
+def test_stream_is_coalesced_with_complete(gateway, monkeypatch):
+    calls = 0
+
+    async def slow_stream(prompt, system_message, session_id):
+        nonlocal calls
+        calls += 1
+        for word in ("uma ", "resposta ", "longa"):
+            await asyncio.sleep(0.02)
+            yield word
+
+    monkeypatch.setitem(gateway.LLM_STREAM_BACKENDS, "fake", slow_stream)
+
+    async def run():
+        stream = asyncio.create_task(collect(gateway.llm_stream("prompt", "sistema", "s")))
+        await asyncio.sleep(0.01)
+        text = await gateway.llm_complete("prompt", "sistema", "s")
+        return await stream, text
+
+    chunks, text = asyncio.run(run())
+    assert text == "uma resposta longa" == "".join(chunks)
+    assert calls == 1
+    assert gateway.llm_stats["coalesced"] == 1
+    assert not gateway._llm_inflight
+
+
+def test_stream_times_out(gateway, monkeypatch):
+    monkeypatch.setattr(gateway, "LLM_TIMEOUT_SECONDS", 0.05)
+    closed = False
+
+    async def stalled_stream(prompt, system_message, session_id):
+        nonlocal closed
+        try:
+            yield "início "
+            await asyncio.sleep(3600)
+            yield "nunca"
+        finally:
+            closed = True
+
+    monkeypatch.setitem(gateway.LLM_STREAM_BACKENDS, "fake", stalled_stream)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(collect(gateway.llm_stream("prompt", "sistema", "s")))
+    assert closed
+    assert gateway.llm_stats["errors"] == 1
+    assert not gateway._llm_cache
+    assert not gateway._llm_inflight
+
+
+def test_abandoned_stream_releases_followers(gateway, monkeypatch):
+    async def slow_stream(prompt, system_message, session_id):
+        for word in ("a ", "b ", "c"):
+            await asyncio.sleep(0.02)
+            yield word
+
+    monkeypatch.setitem(gateway.LLM_STREAM_BACKENDS, "fake", slow_stream)
+
+    async def run():
+        stream = gateway.llm_stream("prompt", "sistema", "s")
+        await stream.__anext__()
+        follower = asyncio.create_task(gateway.llm_complete("prompt", "sistema", "s"))
+        await asyncio.sleep(0)
+        # Cliente desconectou no meio da resposta
+        await stream.aclose()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(follower, timeout=1)
+
+    asyncio.run(run())
+    assert not gateway._llm_cache
+    assert not gateway._llm_inflight